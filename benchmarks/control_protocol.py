@@ -0,0 +1,138 @@
+"""Throughput of the control channel encodings over an os.openpty pair.
+
+Compares JSON lines with length prefixed frames, one message per write and
+batched, for small control messages and for 64KB chunks of file data, then
+measures request/reply round trips against the real agent loop.
+
+    python benchmarks/control_protocol.py --messages 20000
+"""
+import argparse
+import base64
+import contextlib
+import json
+import os
+import pty
+import threading
+import time
+import tty
+
+from macos_virt.service import protocol, service
+
+
+class Port:
+    """Buffered reads and complete writes on one end of a pty, like pyserial."""
+
+    def __init__(self, fd):
+        self.reader = os.fdopen(fd, "rb")
+        self.writer = os.fdopen(os.dup(fd), "wb")
+
+    def write(self, data):
+        self.writer.write(data)
+        self.writer.flush()
+
+    def read(self, size=1):
+        return self.reader.read(size)
+
+    def readline(self):
+        return self.reader.readline()
+
+
+def open_pair():
+    primary, secondary = pty.openpty()
+    tty.setraw(secondary)
+    return Port(primary), Port(secondary)
+
+
+def small_message(number):
+    return {"message_type": "status", "seq": number, "fields": ["cpu_usage", "uptime"]}
+
+
+def chunk_message(number, data, binary):
+    return {"message_type": "file_write", "seq": number, "offset": number * len(data),
+            "crc32": 0, "data": data if binary else base64.b64encode(data).decode()}
+
+
+def run(messages, make_message, write):
+    reader, writer = open_pair()
+    count = len(messages)
+
+    def produce():
+        write(writer, [make_message(message) for message in messages])
+
+    start = time.perf_counter()
+    thread = threading.Thread(target=produce)
+    thread.start()
+    received = 0
+    while received < count:
+        decoded, _ = protocol.read_messages(reader)
+        received += len(decoded)
+    elapsed = time.perf_counter() - start
+    thread.join()
+    return count / elapsed
+
+
+def json_lines(writer, messages):
+    for message in messages:
+        writer.write((json.dumps(message) + "\r\n").encode())
+
+
+def frames(writer, messages):
+    for message in messages:
+        writer.write(protocol.encode_frame(message))
+
+
+def batched(size):
+    def write(writer, messages):
+        for start in range(0, len(messages), size):
+            writer.write(protocol.encode_frame(messages[start:start + size]))
+    return write
+
+
+def agent_round_trips(host, count, batch):
+    channel = protocol.Channel(host, framed=batch > 1)
+    request = {"message_type": "status", "fields": ["cpu_count"]}
+    start = time.perf_counter()
+    done = 0
+    while done < count:
+        channel.send_batch([request] * batch)
+        for _ in range(batch):
+            channel.receive()
+        done += batch
+    return done / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--chunks", type=int, default=1000)
+    args = parser.parse_args()
+
+    small = range(args.messages)
+    print(f"{'small messages':<28} {'msgs/s':>10}")
+    for name, write in (("json lines", json_lines), ("frames", frames),
+                        ("frames, batches of 64", batched(64))):
+        print(f"{name:<28} {run(small, small_message, write):10.0f}")
+
+    data = os.urandom(64 * 1024)
+    chunks = range(args.chunks)
+    print(f"\n{'64KB chunks':<28} {'MB/s':>10}")
+    for name, write, binary in (("json lines, base64", json_lines, False),
+                                ("frames, json base64", frames, False),
+                                ("frames, binary", frames, True)):
+        rate = run(chunks, lambda n: chunk_message(n, data, binary), write)
+        print(f"{name:<28} {rate * len(data) / (1024 * 1024):10.1f}")
+
+    host, guest = open_pair()
+    # The agent owns the other end of the pty, the way it owns /dev/hvc1.
+    service.ser = guest
+    threading.Thread(target=service.serve, daemon=True).start()
+    print(f"\n{'agent status round trips':<28} {'msgs/s':>10}")
+    for name, batch in (("json lines", 1), ("frames, batches of 32", 32)):
+        # The agent logs every status request to stdout.
+        with contextlib.redirect_stdout(open(os.devnull, "w")):
+            rate = agent_round_trips(host, args.messages // 10, batch)
+        print(f"{name:<28} {rate:10.0f}")
+
+
+if __name__ == "__main__":
+    main()
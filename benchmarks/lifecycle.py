@@ -0,0 +1,92 @@
+"""Create, start, status and stop latency with 1 to 100 simulated VMs.
+
+Runs on any platform: VMs are booted by the simulator runner backend in a
+throwaway configuration directory, so nothing touches real VMs.
+
+    python benchmarks/lifecycle.py --counts 1 10 100 --boot-delay 1
+"""
+import argparse
+import contextlib
+import os
+import statistics
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import yaml
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - start
+
+
+def summarize(name, count, wall, latencies):
+    latencies = sorted(latencies)
+    p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+    print(f"{count:>5} {name:<10} {wall:8.2f}s wall {statistics.median(latencies) * 1000:9.1f}ms"
+          f" median {p95 * 1000:9.1f}ms p95")
+
+
+def run_phase(pool, name, count, fn, names):
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(open(os.devnull, "w")):
+        latencies = list(pool.map(lambda vm: timed(fn, vm), names))
+    summarize(name, count, time.perf_counter() - start, latencies)
+
+
+def benchmark(count, workers):
+    from macos_virt.controller import Controller, VMManager
+
+    names = [f"bench-{count}-{number}" for number in range(count)]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        try:
+            run_phase(pool, "create", count,
+                      lambda name: VMManager(name).create("ubuntu-20.04", 1, 512, 100), names)
+            run_phase(pool, "status", count,
+                      lambda name: VMManager(name).get_status_obj(fresh=True), names)
+            start = time.perf_counter()
+            Controller.vm_summaries(live=True, timeout=30)
+            summarize("ls --live", count, time.perf_counter() - start,
+                      [time.perf_counter() - start])
+            run_phase(pool, "stop", count,
+                      lambda name: VMManager(name).stop(wait=True), names)
+            run_phase(pool, "start", count, lambda name: VMManager(name).start(), names)
+            run_phase(pool, "stop", count,
+                      lambda name: VMManager(name).stop(wait=True), names)
+        finally:
+            with contextlib.redirect_stdout(open(os.devnull, "w")):
+                for name in names:
+                    vm = VMManager(name)
+                    if vm.is_running():
+                        vm.stop(force=True)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--counts", type=int, nargs="+", default=[1, 10, 50, 100])
+    parser.add_argument("--workers", type=int, default=16)
+    parser.add_argument("--boot-delay", type=float, default=1.0)
+    parser.add_argument("--reply-delay", type=float, default=0.0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as config_home:
+        # Must be set before macos_virt is imported, paths are resolved at import.
+        os.environ["XDG_CONFIG_HOME"] = config_home
+        os.environ["MACOS_VIRT_RUNNER"] = "simulator"
+        os.makedirs(os.path.join(config_home, "macos-virt"))
+        with open(os.path.join(config_home, "macos-virt/settings.yaml"), "w") as f:
+            yaml.dump({
+                "simulator": {"boot_delay": args.boot_delay,
+                              "reply_delay": args.reply_delay},
+                "admission": {"policy": "warn", "host_cpus": 1000,
+                              "host_memory_mb": 1024 * 1024},
+            }, f)
+        print(f"{'VMs':>5} {'operation':<10}")
+        for count in args.counts:
+            benchmark(count, args.workers)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""Stress per-VM locking with processes racing on the same simulated VMs.
+
+Each worker process loops over random start, stop, status, resource updates
+and forward changes against a few VMs. Afterwards every vm.json must parse
+and no VM may have more than one runner. Linux only, it inspects /proc.
+
+    python benchmarks/lock_stress.py --processes 8 --seconds 30
+"""
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import random
+import tempfile
+import time
+from collections import Counter
+
+import yaml
+
+
+def worker(names, seconds, seed, results):
+    from macos_virt.controller import BaseError, VMManager
+
+    random.seed(seed)
+    outcomes = Counter()
+    operations = {
+        "start": lambda vm: vm.start(),
+        "stop": lambda vm: vm.stop(wait=True, timeout=30),
+        "status": lambda vm: vm.get_status_obj(fresh=True, timeout=5),
+        "resize": lambda vm: vm.update_resources(random.choice([512, 1024]), 1),
+        "forward": lambda vm: vm.add_forward(random.randint(20000, 20100), 22),
+    }
+    deadline = time.time() + seconds
+    with contextlib.redirect_stdout(open(os.devnull, "w")):
+        while time.time() < deadline:
+            name = random.choice(names)
+            operation = random.choice(list(operations))
+            try:
+                operations[operation](VMManager(name))
+                outcomes[f"{operation} ok"] += 1
+            except (BaseError, Exception) as e:
+                outcomes[f"{operation} {type(e).__name__}"] += 1
+    results.put(outcomes)
+
+
+def runners_by_vm():
+    running = Counter()
+    for pid in filter(str.isdigit, os.listdir("/proc")):
+        try:
+            cmdline = open(f"/proc/{pid}/cmdline", "rb").read()
+            if b"macos_virt.simulator" in cmdline:
+                running[os.path.basename(os.readlink(f"/proc/{pid}/cwd"))] += 1
+        except OSError:
+            continue
+    return running
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--processes", type=int, default=8)
+    parser.add_argument("--vms", type=int, default=2)
+    parser.add_argument("--seconds", type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as config_home:
+        os.environ["XDG_CONFIG_HOME"] = config_home
+        os.environ["MACOS_VIRT_RUNNER"] = "simulator"
+        os.makedirs(os.path.join(config_home, "macos-virt"))
+        with open(os.path.join(config_home, "macos-virt/settings.yaml"), "w") as f:
+            yaml.dump({"simulator": {"boot_delay": 0.5},
+                       "locks": {"timeout": 5}}, f)
+        from macos_virt.controller import VMManager
+
+        names = [f"stress-{number}" for number in range(args.vms)]
+        with contextlib.redirect_stdout(open(os.devnull, "w")):
+            for name in names:
+                VMManager(name).create("ubuntu-20.04", 1, 512, 100)
+
+        results = multiprocessing.Queue()
+        processes = [
+            multiprocessing.Process(target=worker, args=(names, args.seconds, seed, results))
+            for seed in range(args.processes)
+        ]
+        for process in processes:
+            process.start()
+        totals = Counter()
+        for _ in processes:
+            totals.update(results.get())
+        for process in processes:
+            process.join()
+
+        duplicates = {name: count for name, count in runners_by_vm().items() if count > 1}
+        corrupt = []
+        for name in names:
+            vm = VMManager(name)
+            try:
+                json.load(open(vm.vm_configuration_file))
+            except ValueError:
+                corrupt.append(name)
+            with contextlib.redirect_stdout(open(os.devnull, "w")):
+                if vm.is_running():
+                    vm.stop(force=True)
+
+        for outcome, count in sorted(totals.items()):
+            print(f"{outcome:<28} {count:6}")
+        print(f"VMs with more than one runner: {duplicates or 'none'}")
+        print(f"Corrupt vm.json: {corrupt or 'none'}")
+        if duplicates or corrupt:
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
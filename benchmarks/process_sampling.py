@@ -0,0 +1,79 @@
+"""CPU cost of the agent's per-process sampling as the process count grows.
+
+Starts idle and busy child processes on this machine, then compares the
+agent's ProcessSampler, which keeps psutil.Process objects between samples,
+with rescanning every process from scratch. Prints the CPU time per sample
+and the interval the sampler settles on to stay inside its CPU budget.
+Needs the real psutil, Linux gives the numbers closest to a guest's.
+
+    python benchmarks/process_sampling.py --counts 100 500 2000
+"""
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+
+import psutil
+
+from macos_virt.service.service import ProcessSampler
+
+IDLE = "import time; time.sleep(3600)"
+BUSY = "while True: pass"
+
+
+def rescan():
+    samples = []
+    for process in psutil.process_iter():
+        try:
+            with process.oneshot():
+                samples.append((process.name(), " ".join(process.cmdline()),
+                                process.cpu_times(), process.memory_info().rss))
+        except psutil.Error:
+            continue
+    return samples
+
+
+def cpu_cost(fn, iterations):
+    costs = []
+    for _ in range(iterations):
+        started = time.thread_time()
+        fn()
+        costs.append(time.thread_time() - started)
+    return statistics.median(costs)
+
+
+def benchmark(count, busy, iterations):
+    children = [subprocess.Popen([sys.executable, "-c", BUSY if number < busy else IDLE])
+                for number in range(count)]
+    try:
+        time.sleep(1)
+        sampler = ProcessSampler()
+        sampler.sample()
+        incremental = cpu_cost(sampler.sample, iterations)
+        scratch = cpu_cost(rescan, iterations)
+        processes = len(sampler.samples)
+        interval = max(ProcessSampler.INTERVAL, incremental / ProcessSampler.CPU_BUDGET)
+        print(f"{processes:>9} {incremental * 1000:12.2f}ms {scratch * 1000:12.2f}ms"
+              f" {interval:9.1f}s {incremental / interval * 100:9.2f}%")
+    finally:
+        for child in children:
+            child.kill()
+        for child in children:
+            child.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--counts", type=int, nargs="+", default=[100, 500, 1000])
+    parser.add_argument("--busy", type=int, default=2, help="Children spinning on a CPU.")
+    parser.add_argument("--iterations", type=int, default=20)
+    args = parser.parse_args()
+
+    print(f"{'processes':>9} {'incremental':>14} {'rescan':>14} {'interval':>10} {'overhead':>10}")
+    for count in args.counts:
+        benchmark(count, args.busy, args.iterations)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""Reply size and round trip latency of agent status queries over a pty.
+
+Runs the real agent request loop against one end of a pty pair, the way it
+talks to /dev/hvc1 in the guest, and queries it from the other end.
+
+    python benchmarks/status_protocol.py --iterations 500
+"""
+import argparse
+import contextlib
+import json
+import os
+import pty
+import statistics
+import threading
+import time
+
+import serial
+
+from macos_virt.service import service
+
+
+class Client:
+    def __init__(self, fd):
+        self.fd = fd
+        self.buffer = b""
+
+    def request(self, message):
+        os.write(self.fd, (json.dumps(message) + "\r\n").encode())
+        while b"\n" not in self.buffer:
+            self.buffer += os.read(self.fd, 65536)
+        line, self.buffer = self.buffer.split(b"\n", 1)
+        return line, json.loads(line)
+
+
+def measure(client, iterations, make_request):
+    sizes, latencies = [], []
+    _, reply = client.request({"message_type": "status"})
+    for _ in range(iterations):
+        start = time.perf_counter()
+        line, reply = client.request(make_request(reply))
+        latencies.append((time.perf_counter() - start) * 1000)
+        sizes.append(len(line))
+    return statistics.mean(sizes), statistics.median(latencies), max(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterations", type=int, default=200)
+    args = parser.parse_args()
+
+    primary, secondary = pty.openpty()
+    service.ser = serial.Serial(os.ttyname(secondary))
+    threading.Thread(target=service.serve, daemon=True).start()
+    client = Client(primary)
+
+    every_field = list(service.STATUS_FIELDS)
+    cases = {
+        # What every status reply cost before field selection.
+        "all fields": lambda last: {"message_type": "status", "fields": every_field},
+        "default": lambda last: {"message_type": "status"},
+        "incremental": lambda last: {"message_type": "status", "since": last["seq"],
+                                     "session": last["session"]},
+        "sshfs mounts": lambda last: {"message_type": "status",
+                                      "fields": ["sshfs_mounts"]},
+    }
+    print(f"{'query':>14} {'bytes':>8} {'median ms':>10} {'max ms':>8}")
+    for name, make_request in cases.items():
+        # The agent logs every status request to stdout.
+        with contextlib.redirect_stdout(open(os.devnull, "w")):
+            size, median, worst = measure(client, args.iterations, make_request)
+        print(f"{name:>14} {size:8.0f} {median:10.3f} {worst:8.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+"""Compare `cp --via-agent` throughput against scp on a running VM.
+
+    python benchmarks/transfer_throughput.py default --size-mb 64
+"""
+import argparse
+import os
+import tempfile
+import time
+
+from macos_virt.controller import VMManager
+
+
+def make_payload(path, size_mb, compressible):
+    block = (b"macos-virt " * 100000)[:1024 * 1024] if compressible else None
+    with open(path, "wb") as f:
+        for _ in range(size_mb):
+            f.write(block if compressible else os.urandom(1024 * 1024))
+
+
+def timed(fn):
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("vm")
+    parser.add_argument("--size-mb", type=int, default=32)
+    args = parser.parse_args()
+
+    vm = VMManager(args.vm)
+    with tempfile.TemporaryDirectory() as tmp:
+        for kind in ("random", "compressible"):
+            source = os.path.join(tmp, f"{kind}.bin")
+            fetched = os.path.join(tmp, f"{kind}-fetched.bin")
+            make_payload(source, args.size_mb, kind == "compressible")
+            for via_agent in (False, True):
+                method = "agent" if via_agent else "scp"
+                # Separate paths, the agent writes as root and scp as the VM user.
+                remote = f"vm:/tmp/macos-virt-bench-{method}.bin"
+                up = timed(lambda: vm.cp(source, remote, via_agent=via_agent))
+                down = timed(lambda: vm.cp(remote, fetched, via_agent=via_agent))
+                print(f"{kind:>13} {method:>5}  "
+                      f"upload {args.size_mb / up:8.2f} MB/s  "
+                      f"download {args.size_mb / down:8.2f} MB/s")
+
+
+if __name__ == "__main__":
+    main()
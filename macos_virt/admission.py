@@ -0,0 +1,142 @@
+import json
+import os
+import pathlib
+import time
+
+import xdg
+
+from macos_virt.locking import LockTimeout, lock
+from macos_virt.settings import get_settings
+
+DEFAULTS = {
+    # Override to simulate or cap host capacity, otherwise detected.
+    "host_cpus": None,
+    "host_memory_mb": None,
+    # Memory kept back for macOS itself.
+    "reserved_memory_mb": 2048,
+    "cpu_overcommit": 4.0,
+    "memory_overcommit": 1.0,
+    # warn, reject or queue
+    "policy": "warn",
+    "queue_timeout": 600,
+}
+
+RESERVATIONS_PATH = os.path.join(xdg.xdg_config_home(), "macos-virt/reservations")
+QUEUE_POLL_INTERVAL = 5
+ADMISSION_LOCK = "admission"
+
+
+def host_capacity(config):
+    cpus = config["host_cpus"] or os.cpu_count()
+    memory = config["host_memory_mb"]
+    if not memory:
+        memory = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") // (1024 * 1024)
+    return cpus, memory
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+
+class AdmissionController:
+    """Compares the CPU and memory ledger of running VMs to host capacity.
+
+    `ledger_source` returns the running VMs as dicts with name, cpus and
+    memory. VMs that have been admitted but are still booting are held as
+    reservation files tagged with the admitting process so concurrent
+    starts see each other and crashed ones expire.
+    """
+
+    def __init__(self, ledger_source, config=None):
+        self.ledger_source = ledger_source
+        self.config = config or get_settings("admission", DEFAULTS)
+        pathlib.Path(RESERVATIONS_PATH).mkdir(parents=True, exist_ok=True)
+
+    def limits(self):
+        cpus, memory = host_capacity(self.config)
+        return {
+            "host_cpus": cpus,
+            "host_memory": memory,
+            "cpu_limit": cpus * self.config["cpu_overcommit"],
+            "memory_limit": (memory - self.config["reserved_memory_mb"])
+                            * self.config["memory_overcommit"],
+        }
+
+    def pending_reservations(self):
+        reservations = []
+        for entry in os.scandir(RESERVATIONS_PATH):
+            try:
+                reservation = json.load(open(entry.path))
+            except (OSError, ValueError):
+                continue
+            if pid_alive(reservation["pid"]):
+                reservations.append(reservation)
+            else:
+                os.unlink(entry.path)
+        return reservations
+
+    def ledger(self, exclude=None):
+        entries = {vm["name"]: vm for vm in self.ledger_source()}
+        for reservation in self.pending_reservations():
+            entries.setdefault(reservation["name"], reservation)
+        return [vm for name, vm in entries.items() if name != exclude]
+
+    def headroom(self, exclude=None):
+        limits = self.limits()
+        ledger = self.ledger(exclude)
+        reserved_cpus = sum(vm["cpus"] for vm in ledger)
+        reserved_memory = sum(vm["memory"] for vm in ledger)
+        return dict(
+            limits,
+            ledger=ledger,
+            reserved_cpus=reserved_cpus,
+            reserved_memory=reserved_memory,
+            free_cpus=limits["cpu_limit"] - reserved_cpus,
+            free_memory=limits["memory_limit"] - reserved_memory,
+        )
+
+    def check(self, name, cpus, memory):
+        headroom = self.headroom(exclude=name)
+        problems = []
+        if cpus > headroom["free_cpus"]:
+            problems.append(
+                f"{cpus} CPUs requested, {headroom['free_cpus']:g} of "
+                f"{headroom['cpu_limit']:g} available")
+        if memory > headroom["free_memory"]:
+            problems.append(
+                f"{memory}MB requested, {headroom['free_memory']:g}MB of "
+                f"{headroom['memory_limit']:g}MB available")
+        return "; ".join(problems)
+
+    def reserve(self, name, cpus, memory):
+        with open(os.path.join(RESERVATIONS_PATH, f"{name}.json"), "w") as f:
+            json.dump({"name": name, "cpus": cpus, "memory": memory, "pid": os.getpid()}, f)
+
+    def release(self, name):
+        path = os.path.join(RESERVATIONS_PATH, f"{name}.json")
+        if os.path.exists(path):
+            os.unlink(path)
+
+    def admit(self, name, cpus, memory, policy=None):
+        """Return (admitted, problem), reserving the resources if admitted."""
+        policy = policy or self.config["policy"]
+        deadline = time.time() + self.config["queue_timeout"]
+        # Starts checking at once would each see the same headroom, they go in turn
+        # until reserved. A queued start keeps its place while it waits.
+        try:
+            with lock(ADMISSION_LOCK, timeout=self.config["queue_timeout"], command="admit"):
+                problem = self.check(name, cpus, memory)
+                if problem and policy == "queue":
+                    while problem and time.time() < deadline:
+                        time.sleep(QUEUE_POLL_INTERVAL)
+                        problem = self.check(name, cpus, memory)
+                if problem and policy != "warn":
+                    return False, problem
+                self.reserve(name, cpus, memory)
+        except LockTimeout as e:
+            return False, str(e)
+        return True, problem
@@ -0,0 +1,196 @@
+import hashlib
+import json
+import os
+import struct
+import zlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from rich.progress import Progress
+
+from macos_virt.sparse import data_extents
+
+MAGIC = b"MVIRTAR1"
+CHUNK_SIZE = 4 * 1024 * 1024
+
+# file index, offset, length, stored length, flags, sha256
+CHUNK_HEADER = struct.Struct(">HQIIB32s")
+# index offset, index length, magic
+TRAILER = struct.Struct(">QQ8s")
+
+FLAG_ZLIB = 0x01
+FLAG_BASE = 0x02
+FLAG_END = 0x80
+
+
+class ArchiveError(Exception):
+    pass
+
+
+def compress_chunk(data, level):
+    digest = hashlib.sha256(data).digest()
+    compressed = zlib.compress(data, level)
+    if len(compressed) < len(data):
+        return digest, compressed, FLAG_ZLIB
+    return digest, data, 0
+
+
+def iter_chunks(path, chunk_size=CHUNK_SIZE):
+    """Yield (offset, data) for chunks holding data, skipping holes and zeros."""
+    zero_chunk = bytes(chunk_size)
+    last_offset = -1
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        for start, end in data_extents(f.fileno(), size):
+            offset = start - start % chunk_size
+            while offset < end:
+                if offset > last_offset:
+                    f.seek(offset)
+                    data = f.read(chunk_size)
+                    last_offset = offset
+                    if data != zero_chunk[:len(data)]:
+                        yield offset, data
+                offset += chunk_size
+
+
+def export_archive(destination, configuration, files, base_image=None,
+                   level=6, workers=None):
+    """Write `files` (name -> path) and the VM configuration to an archive.
+
+    Chunks equal to the same range of `base_image` are recorded by digest
+    only and restored from the importer's base image cache.
+    """
+    index = {"version": 1, "configuration": configuration,
+             "chunk_size": CHUNK_SIZE, "files": []}
+    base = open(base_image, "rb") if base_image else None
+    try:
+        with open(destination, "wb") as out, \
+                ProcessPoolExecutor(max_workers=workers) as pool, Progress() as progress:
+            out.write(MAGIC)
+            window = (workers or os.cpu_count() or 1) * 2
+            for file_number, (name, path) in enumerate(files.items()):
+                size = os.path.getsize(path)
+                entry = {"name": name, "size": size, "chunks": []}
+                index["files"].append(entry)
+                task = progress.add_task(f"Exporting {name}", total=size)
+                pending = deque()
+
+                def write_next():
+                    offset, length, future = pending.popleft()
+                    digest, stored, flags = future.result()
+                    out.write(CHUNK_HEADER.pack(
+                        file_number, offset, length, len(stored), flags, digest))
+                    entry["chunks"].append({
+                        "offset": offset, "length": length, "flags": flags,
+                        "sha256": digest.hex(), "archive_offset": out.tell(),
+                        "archive_length": len(stored)})
+                    out.write(stored)
+                    progress.update(task, completed=offset + length)
+
+                for offset, data in iter_chunks(path):
+                    if base is not None and name == "disk.img":
+                        base.seek(offset)
+                        if base.read(len(data)) == data:
+                            digest = hashlib.sha256(data).digest()
+                            out.write(CHUNK_HEADER.pack(
+                                file_number, offset, len(data), 0, FLAG_BASE, digest))
+                            entry["chunks"].append({
+                                "offset": offset, "length": len(data),
+                                "flags": FLAG_BASE, "sha256": digest.hex()})
+                            continue
+                    pending.append((offset, len(data),
+                                    pool.submit(compress_chunk, data, level)))
+                    if len(pending) >= window:
+                        write_next()
+                while pending:
+                    write_next()
+                progress.update(task, completed=size)
+
+            out.write(CHUNK_HEADER.pack(0, 0, 0, 0, FLAG_END, bytes(32)))
+            index_offset = out.tell()
+            encoded = json.dumps(index).encode()
+            out.write(encoded)
+            out.write(TRAILER.pack(index_offset, len(encoded), MAGIC))
+    finally:
+        if base is not None:
+            base.close()
+
+
+def read_index(path):
+    try:
+        with open(path, "rb") as f:
+            f.seek(-TRAILER.size, os.SEEK_END)
+            index_offset, index_length, magic = TRAILER.unpack(f.read(TRAILER.size))
+            if magic != MAGIC:
+                raise ArchiveError(f"{path} is not a macos-virt archive")
+            f.seek(index_offset)
+            index = json.loads(f.read(index_length))
+    except (OSError, ValueError, struct.error) as e:
+        # Too short for a trailer, or a trailer pointing at garbage.
+        raise ArchiveError(f"{path} is not a readable macos-virt archive: {e}")
+    if not isinstance(index, dict) or not {"configuration", "files"} <= index.keys():
+        raise ArchiveError(f"{path} has a damaged index")
+    return index
+
+
+def import_archive(source, directory, index, base_image=None):
+    """Stream the chunks of an archive into sparse files in `directory`."""
+    for entry in index["files"]:
+        if entry["name"] in ("", ".", "..") or os.path.basename(entry["name"]) != entry["name"]:
+            raise ArchiveError(f"{source} has a file outside the VM: {entry['name']}")
+    paths = [os.path.join(directory, entry["name"]) for entry in index["files"]]
+    for path, entry in zip(paths, index["files"]):
+        with open(path, "wb") as f:
+            f.truncate(entry["size"])
+    handles = [open(path, "r+b") for path in paths]
+    base = open(base_image, "rb") if base_image else None
+    total = sum(entry["size"] for entry in index["files"])
+    try:
+        with open(source, "rb") as archive, Progress() as progress:
+            task = progress.add_task("Importing", total=total)
+            if archive.read(len(MAGIC)) != MAGIC:
+                raise ArchiveError(f"{source} is not a macos-virt archive")
+            imported = [0] * len(paths)
+            while True:
+                header = archive.read(CHUNK_HEADER.size)
+                if len(header) < CHUNK_HEADER.size:
+                    raise ArchiveError(f"{source} is truncated")
+                file_number, offset, length, stored_length, flags, digest = \
+                    CHUNK_HEADER.unpack(header)
+                if flags & FLAG_END:
+                    break
+                if file_number >= len(paths) or \
+                        offset + length > index["files"][file_number]["size"]:
+                    raise ArchiveError(f"{source} has a damaged chunk header at "
+                                       f"{archive.tell() - CHUNK_HEADER.size}")
+                if flags & FLAG_BASE:
+                    if base is None:
+                        raise ArchiveError("Archive needs the profile's base image")
+                    base.seek(offset)
+                    data = base.read(length)
+                else:
+                    data = archive.read(stored_length)
+                    if flags & FLAG_ZLIB:
+                        try:
+                            data = zlib.decompress(data)
+                        except zlib.error as e:
+                            raise ArchiveError(
+                                f"Chunk at {offset} of {index['files'][file_number]['name']} "
+                                f"is corrupted: {e}")
+                if hashlib.sha256(data).digest() != digest:
+                    raise ArchiveError(
+                        f"Chunk at {offset} of {index['files'][file_number]['name']} "
+                        f"failed verification")
+                handles[file_number].seek(offset)
+                handles[file_number].write(data)
+                imported[file_number] += 1
+                progress.update(task, advance=length)
+            # A damaged header can look like the end, the index knows better.
+            if imported != [len(entry["chunks"]) for entry in index["files"]]:
+                raise ArchiveError(f"{source} ended before all of its chunks")
+            progress.update(task, completed=total)
+    finally:
+        for handle in handles:
+            handle.close()
+        if base is not None:
+            base.close()
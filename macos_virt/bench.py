@@ -0,0 +1,215 @@
+import glob
+import json
+import os
+import pathlib
+import socket
+import threading
+import time
+
+import xdg
+from rich.console import Console
+from rich.table import Table
+
+from macos_virt.controller import BaseError, VMManager, VMDoesntExist, VMNotRunning, print_records
+
+console = Console()
+
+BENCH_PATH = os.path.join(xdg.xdg_config_home(), "macos-virt/bench")
+
+TESTS = ("cpu", "disk", "network", "mount")
+
+MB = 1024 * 1024
+
+
+class UnknownRun(BaseError):
+    pass
+
+
+def stream(address, port, seconds, result):
+    """The host end of the network test, see bench_network in the agent."""
+    try:
+        with socket.create_connection((address, port), timeout=30) as connection:
+            block = bytes(MB)
+            deadline = time.monotonic() + seconds
+            while time.monotonic() < deadline:
+                connection.sendall(block)
+            connection.shutdown(socket.SHUT_WR)
+            received = 0
+            started = time.monotonic()
+            while True:
+                data = connection.recv(MB)
+                if not data:
+                    break
+                received += len(data)
+            result["download_mb_per_second"] = round(
+                received / MB / (time.monotonic() - started), 1)
+    except OSError as e:
+        result["error"] = str(e)
+
+
+def run_test(vm, test, seconds, size_mb, mount_path):
+    request = {"message_type": "bench", "test": test, "seconds": seconds, "size_mb": size_mb}
+    host_result = {}
+    streamer = None
+
+    def on_message(message):
+        nonlocal streamer
+        if message.get("message_type") == "bench_listen":
+            address = vm.runner.guest_address(vm.get_ip_address())
+            streamer = threading.Thread(
+                target=stream, args=(address, message["port"], seconds, host_result))
+            streamer.start()
+
+    if test == "mount":
+        request["path"] = mount_path
+    reply = vm.request(request, timeout=seconds * 4 + size_mb + 60, on_message=on_message)
+    if streamer:
+        streamer.join()
+        if "error" in host_result:
+            raise OSError(host_result["error"])
+    return dict(reply["result"], **host_result)
+
+
+def run(name, tests=TESTS, seconds=5, size_mb=256, mount_path=None):
+    """Run the suite in a VM's guest and store the results with its configuration."""
+    vm = VMManager(name)
+    if not vm.exists:
+        raise VMDoesntExist(f"🤷 VM {name} does not exist.")
+    with vm.lock(exclusive=False, command="bench"):
+        if not vm.is_running():
+            raise VMNotRunning(f"🤷 VM {name} is not running.")
+        vm.load_configuration_from_disk()
+        vm.require_capability("bench")
+        if "mount" in tests and mount_path is None:
+            mounts = vm.list_mounts()
+            mount_path = mounts[0] if mounts else None
+        run_id = time.strftime("%Y%m%d-%H%M%S")
+        if os.path.exists(run_path({"vm": name, "id": run_id})):
+            run_id += f"-{os.getpid()}"
+        record = {
+            "id": run_id,
+            "vm": name,
+            "timestamp": time.time(),
+            "configuration": {
+                "profile": vm.configuration["profile"],
+                "cpus": vm.configuration["cpus"],
+                "memory": vm.configuration["memory"],
+                "disk_size": vm.configuration["disk_size"],
+                "runner": vm.runner.name,
+                "mount_path": mount_path,
+            },
+            "parameters": {"seconds": seconds, "size_mb": size_mb},
+            "results": {},
+            "skipped": {},
+        }
+        for test in tests:
+            if test == "mount" and mount_path is None:
+                record["skipped"][test] = ("no sshfs mount in the guest, "
+                                           "mount one or pass --mount-path")
+                continue
+            console.print(f":stopwatch: Running {test} benchmark in {name}")
+            try:
+                record["results"][test] = run_test(vm, test, seconds, size_mb, mount_path)
+            except (BaseError, OSError) as e:
+                record["skipped"][test] = str(e)
+    save_run(record)
+    return record
+
+
+def run_path(record):
+    return os.path.join(BENCH_PATH, record["vm"], record["id"] + ".json")
+
+
+def save_run(record):
+    path = run_path(record)
+    pathlib.Path(os.path.dirname(path)).mkdir(parents=True, exist_ok=True)
+    with open(path + ".tmp", "w") as f:
+        json.dump(record, f, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def list_runs(name=None):
+    paths = glob.glob(os.path.join(BENCH_PATH, name or "*", "*.json"))
+    runs = [json.load(open(path)) for path in paths]
+    return sorted(runs, key=lambda record: record["timestamp"])
+
+
+def load_run(reference):
+    """A run by VM/ID, or the latest run of a VM by its name."""
+    name, _, run_id = reference.partition("/")
+    runs = [record for record in list_runs(name) if not run_id or record["id"] == run_id]
+    if not runs:
+        raise UnknownRun(f"🤷 No benchmark run {reference}, see `macos-virt bench ls`.")
+    return runs[-1]
+
+
+def metrics(record):
+    """Throughputs and rates, leaving out details like the thread count."""
+    return {
+        f"{test}.{metric}": value
+        for test, result in record["results"].items()
+        for metric, value in result.items()
+        if metric.endswith(("_per_second", "_iops"))
+    }
+
+
+def describe_configuration(record):
+    configuration = record["configuration"]
+    return (f"{configuration['cpus']} CPUs, {configuration['memory']}MB, "
+            f"{configuration['disk_size']}MB disk")
+
+
+def print_run(record, output="table"):
+    if output != "table":
+        print_records(record, output)
+        return
+    table = Table(title=f"{record['vm']}/{record['id']}: {describe_configuration(record)}")
+    table.add_column("Metric")
+    table.add_column("Value", justify="right")
+    for metric, value in metrics(record).items():
+        table.add_row(metric, str(value))
+    console.print(table)
+    for test, reason in record["skipped"].items():
+        console.print(f":warning: {test} skipped: {reason}")
+
+
+def print_runs(name=None, output="table"):
+    runs = list_runs(name)
+    if output != "table":
+        print_records(runs, output)
+        return
+    table = Table()
+    table.add_column("Run")
+    table.add_column("Profile")
+    table.add_column("Configuration")
+    table.add_column("Tests")
+    for record in runs:
+        table.add_row(f"{record['vm']}/{record['id']}", record["configuration"]["profile"],
+                      describe_configuration(record), ", ".join(record["results"]))
+    console.print(table)
+
+
+def compare(before, after, output="table"):
+    """Metrics of two runs side by side, all of them are better when higher."""
+    runs = [load_run(before), load_run(after)]
+    values = [metrics(record) for record in runs]
+    rows = []
+    for metric in values[0]:
+        if metric not in values[1]:
+            continue
+        old, new = values[0][metric], values[1][metric]
+        change = round((new - old) / old * 100, 1) if old else None
+        rows.append({"metric": metric, "before": old, "after": new, "change_percent": change})
+    if output != "table":
+        print_records({"before": runs[0], "after": runs[1], "metrics": rows}, output)
+        return
+    table = Table()
+    table.add_column("Metric")
+    for record in runs:
+        table.add_column(f"{record['vm']}/{record['id']}\n{describe_configuration(record)}",
+                         justify="right")
+    table.add_column("Change", justify="right")
+    for row in rows:
+        change = "" if row["change_percent"] is None else f"{row['change_percent']:+.1f}%"
+        table.add_row(row["metric"], str(row["before"]), str(row["after"]), change)
+    console.print(table)
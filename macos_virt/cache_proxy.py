@@ -0,0 +1,389 @@
+import email.utils
+import hashlib
+import ipaddress
+import json
+import os
+import pathlib
+import select
+import shutil
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.error import HTTPError, URLError
+from urllib.parse import quote
+from urllib.request import Request, urlopen
+
+import xdg
+
+from macos_virt import daemon
+from macos_virt.settings import get_settings
+
+DEFAULTS = {
+    "listen": "0.0.0.0",
+    "port": 3142,
+    # The host as seen from guests on the Virtualization.Framework NAT.
+    "guest_address": "192.168.64.1",
+    "allowed_networks": ["127.0.0.0/8", "192.168.64.0/24"],
+    "max_size_mb": 10240,
+    "directory": os.path.join(xdg.xdg_config_home(), "macos-virt/package-cache"),
+}
+
+STORED_HEADERS = ("Content-Type", "ETag", "Last-Modified", "Cache-Control", "Expires")
+# Versioned artifacts never change once published.
+IMMUTABLE_SUFFIXES = (".deb", ".udeb", ".tar.gz", ".tar.xz")
+K3S_PREFIX = "/k3s/"
+K3S_INSTALLER_URL = "https://get.k3s.io"
+K3S_RELEASE_URL = "https://github.com/k3s-io/k3s/releases/download/{version}/{file}"
+BUFFER_SIZE = 256 * 1024
+
+
+def settings():
+    return get_settings("cache_proxy", DEFAULTS)
+
+
+def upstream_url(path):
+    if path.startswith(("http://", "https://")):
+        return path, False
+    if path == K3S_PREFIX + "install.sh":
+        return K3S_INSTALLER_URL, False
+    if path.startswith(K3S_PREFIX):
+        version, _, filename = path[len(K3S_PREFIX):].partition("/")
+        return K3S_RELEASE_URL.format(version=quote(version), file=filename), True
+    return None, False
+
+
+class Cache:
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "revalidated": 0, "misses": 0, "uncacheable": 0,
+                      "stale": 0, "evicted": 0}
+        pathlib.Path(directory).mkdir(parents=True, exist_ok=True)
+
+    def paths(self, url):
+        key = hashlib.sha256(url.encode()).hexdigest()
+        return (os.path.join(self.directory, key + ".data"),
+                os.path.join(self.directory, key + ".json"))
+
+    def lookup(self, url):
+        data_path, meta_path = self.paths(url)
+        try:
+            meta = json.load(open(meta_path))
+        except (OSError, ValueError):
+            return None
+        if not os.path.exists(data_path):
+            return None
+        return meta
+
+    def touch(self, url, meta=None):
+        data_path, meta_path = self.paths(url)
+        if meta is not None:
+            self.write_meta(meta_path, meta)
+        os.utime(data_path)
+
+    @staticmethod
+    def write_meta(meta_path, meta):
+        with open(meta_path + ".tmp", "w") as f:
+            json.dump(meta, f)
+        os.replace(meta_path + ".tmp", meta_path)
+
+    def store(self, url, meta, tmp_path):
+        data_path, meta_path = self.paths(url)
+        os.replace(tmp_path, data_path)
+        self.write_meta(meta_path, meta)
+        self.evict()
+
+    def evict(self):
+        with self.lock:
+            entries = []
+            total = 0
+            for entry in os.scandir(self.directory):
+                if entry.name.endswith(".data"):
+                    st = entry.stat()
+                    entries.append((st.st_mtime, st.st_size, entry.path))
+                    total += st.st_size
+            for _, size, path in sorted(entries):
+                if total <= self.max_size:
+                    break
+                for victim in (path, path[:-len(".data")] + ".json"):
+                    if os.path.exists(victim):
+                        os.unlink(victim)
+                total -= size
+                self.stats["evicted"] += 1
+
+    def count(self, stat):
+        # Handler threads count at once, the stats writer snapshots under the same lock.
+        with self.lock:
+            self.stats[stat] += 1
+
+    def stats_snapshot(self):
+        with self.lock:
+            return dict(self.stats)
+
+    def size(self):
+        return sum(entry.stat().st_size for entry in os.scandir(self.directory)
+                   if entry.name.endswith(".data"))
+
+
+def is_fresh(meta, immutable):
+    if immutable or meta["url"].endswith(IMMUTABLE_SUFFIXES):
+        return True
+    headers = meta["headers"]
+    age = time.time() - meta["stored_at"]
+    for directive in headers.get("Cache-Control", "").split(","):
+        directive = directive.strip()
+        if directive in ("no-cache", "must-revalidate"):
+            return False
+        if directive.startswith("max-age="):
+            try:
+                return age < int(directive[len("max-age="):])
+            except ValueError:
+                return False
+    if "Expires" in headers:
+        try:
+            expires = email.utils.parsedate_to_datetime(headers["Expires"]).timestamp()
+        except (TypeError, ValueError):
+            return False
+        return time.time() < expires
+    return False
+
+
+def is_cacheable(response):
+    return response.status == 200 and "no-store" not in response.headers.get(
+        "Cache-Control", "")
+
+
+class ProxyHandler(BaseHTTPRequestHandler):
+    cache = None
+    allowed_networks = []
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def allowed(self):
+        address = ipaddress.ip_address(self.client_address[0])
+        if any(address in network for network in self.allowed_networks):
+            return True
+        self.send_error(403)
+        return False
+
+    def do_CONNECT(self):
+        # TLS can't be cached, tunnel it so https sources keep working.
+        if not self.allowed():
+            return
+        host, _, port = self.path.partition(":")
+        try:
+            upstream = socket.create_connection((host, int(port or 443)), timeout=30)
+        except OSError:
+            self.send_error(502)
+            return
+        self.send_response(200, "Connection Established")
+        self.end_headers()
+        sockets = [self.connection, upstream]
+        try:
+            while True:
+                readable, _, _ = select.select(sockets, [], [], 300)
+                if not readable:
+                    break
+                for sock in readable:
+                    data = sock.recv(BUFFER_SIZE)
+                    if not data:
+                        return
+                    (upstream if sock is self.connection else self.connection).sendall(data)
+        finally:
+            upstream.close()
+            self.close_connection = True
+
+    def do_HEAD(self):
+        self.do_GET(head=True)
+
+    def do_GET(self, head=False):
+        if not self.allowed():
+            return
+        url, immutable = upstream_url(self.path)
+        if url is None:
+            self.send_error(404)
+            return
+        meta = self.cache.lookup(url)
+        if meta is not None and is_fresh(meta, immutable):
+            self.cache.count("hits")
+            self.cache.touch(url)
+            return self.send_cached(url, meta, head)
+
+        headers = {"User-Agent": self.headers.get("User-Agent", "macos-virt-cache")}
+        if meta is not None:
+            if "ETag" in meta["headers"]:
+                headers["If-None-Match"] = meta["headers"]["ETag"]
+            if "Last-Modified" in meta["headers"]:
+                headers["If-Modified-Since"] = meta["headers"]["Last-Modified"]
+        try:
+            response = urlopen(Request(url, headers=headers), timeout=60)
+        except HTTPError as e:
+            if e.code == 304 and meta is not None:
+                self.cache.count("revalidated")
+                meta["stored_at"] = time.time()
+                self.cache.touch(url, meta)
+                return self.send_cached(url, meta, head)
+            self.send_error(e.code)
+            return
+        except (URLError, OSError):
+            if meta is not None:
+                # Origin unreachable, a stale copy beats failing the install.
+                self.cache.count("stale")
+                return self.send_cached(url, meta, head)
+            self.send_error(502)
+            return
+
+        with response:
+            if not is_cacheable(response):
+                self.cache.count("uncacheable")
+                return self.relay(response, head)
+            self.cache.count("misses")
+            self.fetch_and_store(url, response, head)
+
+    def send_headers(self, status, headers, length):
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        if length is not None:
+            self.send_header("Content-Length", str(length))
+        else:
+            self.close_connection = True
+        self.end_headers()
+
+    def not_modified(self, meta):
+        etag = meta["headers"].get("ETag")
+        if etag and self.headers.get("If-None-Match") == etag:
+            return True
+        modified = meta["headers"].get("Last-Modified")
+        return bool(modified) and self.headers.get("If-Modified-Since") == modified
+
+    def send_cached(self, url, meta, head):
+        if self.not_modified(meta):
+            self.send_headers(304, {}, 0)
+            return
+        data_path, _ = self.cache.paths(url)
+        with open(data_path, "rb") as f:
+            self.send_headers(200, meta["headers"], os.fstat(f.fileno()).st_size)
+            if not head:
+                shutil.copyfileobj(f, self.wfile, BUFFER_SIZE)
+
+    def relay(self, response, head):
+        headers = {name: response.headers[name] for name in STORED_HEADERS
+                   if name in response.headers}
+        length = response.headers.get("Content-Length")
+        self.send_headers(response.status, headers, int(length) if length else None)
+        if not head:
+            shutil.copyfileobj(response, self.wfile, BUFFER_SIZE)
+
+    def fetch_and_store(self, url, response, head):
+        headers = {name: response.headers[name] for name in STORED_HEADERS
+                   if name in response.headers}
+        length = response.headers.get("Content-Length")
+        self.send_headers(200, headers, int(length) if length else None)
+        data_path, _ = self.cache.paths(url)
+        tmp_path = f"{data_path}.{threading.get_ident()}.tmp"
+        client_connected = not head
+        try:
+            with open(tmp_path, "wb") as f:
+                for block in iter(lambda: response.read(BUFFER_SIZE), b""):
+                    f.write(block)
+                    if client_connected:
+                        try:
+                            self.wfile.write(block)
+                        except OSError:
+                            # Finish the download anyway, the next VM will want it.
+                            client_connected = False
+            meta = {"url": url, "headers": headers, "stored_at": time.time()}
+            self.cache.store(url, meta, tmp_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+
+
+def pidfile_path(config):
+    return os.path.join(config["directory"], "proxy.pid")
+
+
+def stats_path(config):
+    return os.path.join(config["directory"], "stats.json")
+
+
+def write_stats_periodically(cache, config):
+    while True:
+        time.sleep(5)
+        Cache.write_meta(stats_path(config), cache.stats_snapshot())
+
+
+def serve():
+    config = settings()
+    cache = Cache(config["directory"], config["max_size_mb"] * 1024 * 1024)
+    try:
+        cache.stats.update(json.load(open(stats_path(config))))
+    except (OSError, ValueError):
+        pass
+    ProxyHandler.cache = cache
+    ProxyHandler.allowed_networks = [
+        ipaddress.ip_network(network) for network in config["allowed_networks"]]
+    server = ThreadingHTTPServer((config["listen"], config["port"]), ProxyHandler)
+    server.daemon_threads = True
+    threading.Thread(target=write_stats_periodically, args=(cache, config),
+                     daemon=True).start()
+    server.serve_forever()
+
+
+def is_running(config=None):
+    return daemon.is_running(pidfile_path(config or settings()))
+
+
+def start():
+    config = settings()
+    return daemon.start("macos_virt.cache_proxy", pidfile_path(config),
+                        os.path.join(config["directory"], "proxy.log"))
+
+
+def stop():
+    daemon.stop(pidfile_path(settings()))
+
+
+def status():
+    config = settings()
+    cache = Cache(config["directory"], config["max_size_mb"] * 1024 * 1024)
+    try:
+        stats = json.load(open(stats_path(config)))
+    except (OSError, ValueError):
+        stats = {}
+    return {
+        "running": is_running(config),
+        "url": guest_proxy_url(config),
+        "size": cache.size(),
+        "max_size": cache.max_size,
+        "stats": stats,
+    }
+
+
+def clear():
+    config = settings()
+    for entry in os.scandir(config["directory"]):
+        if entry.name.endswith((".data", ".json")) and entry.name != "stats.json":
+            os.unlink(entry.path)
+
+
+def guest_proxy_url(config=None):
+    config = config or settings()
+    return f"http://{config['guest_address']}:{config['port']}"
+
+
+def active_guest_proxy_url():
+    """The URL guests should use, or None when the proxy isn't running."""
+    config = settings()
+    if is_running(config):
+        return guest_proxy_url(config)
+    return None
+
+
+if __name__ == "__main__":
+    serve()
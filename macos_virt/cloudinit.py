@@ -0,0 +1,224 @@
+"""Live cloud-init progress while a VM initializes, with an ETA from past runs.
+
+The agent streams the start and finish of cloud-init's stages and modules.
+How long each took is kept per profile and kind of boot, since a first
+boot upgrading packages takes far longer than a reboot.
+"""
+import json
+import os
+import statistics
+import threading
+import time
+
+import xdg
+from rich.console import Console
+from rich.errors import LiveError
+from rich.progress import BarColumn, Progress, TextColumn
+
+console = Console()
+
+HISTORY_PATH = os.path.join(xdg.xdg_config_home(), "macos-virt/cloudinit-history.json")
+# Runs remembered per profile and kind of boot.
+HISTORY_LENGTH = 10
+REFRESH_INTERVAL = 1
+SLOWEST_SHOWN = 3
+
+MODULE_DESCRIPTIONS = {
+    "config-package-update-upgrade-install": "apt upgrade and packages",
+    "config-apt-configure": "apt sources",
+    "config-scripts-user": "runcmd, k3s installs",
+    "config-write-files": "writing files",
+    "config-users-groups": "users",
+    "config-ssh": "SSH host keys",
+    "config-growpart": "growing the root partition",
+    "config-resizefs": "resizing the root filesystem",
+    "config-disk-setup": "formatting data disks",
+    "config-mounts": "mounts",
+    "config-ntp": "NTP",
+}
+
+
+def load_history():
+    try:
+        return json.load(open(HISTORY_PATH))
+    except (OSError, ValueError):
+        return {}
+
+
+def save_history(history):
+    tmp_path = f"{HISTORY_PATH}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(history, f)
+    os.replace(tmp_path, HISTORY_PATH)
+
+
+# VMs initializing in this process at once update the history in turn.
+history_lock = threading.Lock()
+# rich allows one live display at a time, VMs initializing at once share it.
+display_lock = threading.Lock()
+display = None
+display_users = 0
+
+
+def acquire_display():
+    """The shared progress display, or None to print plain lines instead."""
+    global display, display_users
+    with display_lock:
+        if display is None:
+            if not console.is_terminal:
+                return None
+            progress = Progress(TextColumn("{task.description}"), BarColumn(),
+                                TextColumn("{task.fields[eta]}"), console=console)
+            try:
+                progress.start()
+            except LiveError:
+                # Another live display, like an export's progress, is showing.
+                return None
+            display = progress
+        display_users += 1
+        return display
+
+
+def release_display():
+    global display, display_users
+    with display_lock:
+        display_users -= 1
+        if display_users == 0:
+            display.stop()
+            display = None
+
+
+def describe(name):
+    module = name.partition("/")[2]
+    return f"{name} ({MODULE_DESCRIPTIONS[module]})" if module in MODULE_DESCRIPTIONS else name
+
+
+class InitializationProgress:
+    """Tracks cloud-init's events and shows the running module with an ETA."""
+
+    def __init__(self, name, profile, kind):
+        self.name = name
+        self.profile = profile
+        self.kind = kind
+        past = load_history().get(profile, {}).get(kind, {"total": [], "modules": {}})
+        self.expected_total = statistics.median(past["total"]) if past["total"] else None
+        self.expected = {name: statistics.median(seconds)
+                         for name, seconds in past["modules"].items()}
+        self.started = time.monotonic()
+        # Guest timestamps of the running stages and modules, and when the host heard of them.
+        self.running = {}
+        self.seen = {}
+        self.durations = {}
+        self.progress = None
+        self.shown = None
+        self.stopped = threading.Event()
+        # The tick thread and agent events refresh while stop() may remove the task.
+        self.lock = threading.Lock()
+
+    def event(self, message):
+        name = message["name"]
+        with self.lock:
+            if message["event"] == "start":
+                self.running[name] = message["at"]
+                self.seen[name] = time.monotonic()
+            elif name in self.running:
+                self.durations[name] = {
+                    "seconds": round(message["at"] - self.running.pop(name), 3),
+                    "result": message.get("result")}
+        self.refresh()
+
+    def current(self):
+        if not self.running:
+            return "waiting for cloud-init" if not self.durations else "between stages"
+        # The innermost of what is running, a module rather than its stage.
+        return describe(max(self.running, key=lambda name: (self.running[name], "/" in name)))
+
+    def remaining(self):
+        """Estimated seconds left, None without a past run to go by."""
+        now = time.monotonic()
+        estimates = []
+        if self.expected_total is not None:
+            estimates.append(self.expected_total - (now - self.started))
+        if self.expected:
+            left = 0
+            for name, seconds in self.expected.items():
+                if "/" not in name or name in self.durations:
+                    continue
+                if name in self.running:
+                    seconds -= now - self.seen[name]
+                left += max(seconds, 0)
+            estimates.append(left)
+        return max(max(estimates), 0) if estimates else None
+
+    def refresh(self):
+        with self.lock:
+            if not self.stopped.is_set():
+                self.show()
+
+    def show(self):
+        progress = self.progress
+        if progress is None:
+            if self.current() != self.shown:
+                self.shown = self.current()
+                console.print(f":hourglass: {self.name}: {self.shown}")
+            return
+        elapsed = time.monotonic() - self.started
+        remaining = self.remaining()
+        description = f"{self.name}: {self.current()}"
+        if remaining is None:
+            progress.update(self.task, description=description, eta="no ETA yet")
+        else:
+            progress.update(self.task, description=description,
+                            completed=elapsed / (elapsed + remaining) * 100
+                            if elapsed + remaining else 100,
+                            eta=f"about {int(remaining)}s left")
+
+    def tick(self):
+        while not self.stopped.wait(REFRESH_INTERVAL):
+            self.refresh()
+
+    def __enter__(self):
+        progress = acquire_display()
+        if progress is not None:
+            self.task = progress.add_task(f"{self.name}: {self.current()}", total=100, eta="")
+            self.progress = progress
+            threading.Thread(target=self.tick, daemon=True).start()
+        self.refresh()
+        return self
+
+    def stop(self):
+        with self.lock:
+            if self.stopped.is_set():
+                return
+            self.stopped.set()
+            progress, self.progress = self.progress, None
+            if progress is not None:
+                progress.remove_task(self.task)
+        if progress is not None:
+            release_display()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def finish(self, succeeded):
+        """Stop the bar, show the slowest modules and remember this run."""
+        self.stop()
+        total = round(time.monotonic() - self.started, 3)
+        modules = {name: duration for name, duration in self.durations.items() if "/" in name}
+        slowest = sorted(modules, key=lambda name: modules[name]["seconds"], reverse=True)
+        if slowest:
+            console.print(f":stopwatch: Slowest cloud-init modules in {self.name}: " + ", ".join(
+                f"{describe(name)} {modules[name]['seconds']:.1f}s"
+                for name in slowest[:SLOWEST_SHOWN]))
+        # A failed run stopped early, it would make the next ETA optimistic.
+        if not succeeded:
+            return
+        with history_lock:
+            history = load_history()
+            entry = history.setdefault(self.profile, {}).setdefault(
+                self.kind, {"total": [], "modules": {}})
+            entry["total"] = (entry["total"] + [total])[-HISTORY_LENGTH:]
+            for name, duration in self.durations.items():
+                runs = entry["modules"].get(name, [])
+                entry["modules"][name] = (runs + [duration["seconds"]])[-HISTORY_LENGTH:]
+            save_history(history)
@@ -3,3 +3,6 @@ INITRD_FILENAME = "initrd"
 DISK_FILENAME = "disk.img"
 BOOT_DISK_FILENAME = "boot.img"
 CLOUDINIT_ISO_NAME = "cloudinit.img"
+DATA_DISK_FILENAME = "data-{name}.img"
+# Host caching of a data disk, given to the runner after an @ in --disk.
+DISK_CACHE_MODES = ("automatic", "cached", "uncached")
@@ -1,13 +1,19 @@
+import contextlib
 import glob
 import gzip
 import json
 import os
 import pathlib
+import platform
 import random
+import re
 import shutil
 import subprocess
-import tempfile
+import sys
+import threading
 import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
 from subprocess import check_output
 
@@ -18,11 +24,19 @@ import xdg as xdg
 import yaml
 from rich import print
 from rich.console import Console
-from rich.progress import track
 from rich.table import Table
 
-from macos_virt.constants import DISK_FILENAME, BOOT_DISK_FILENAME, CLOUDINIT_ISO_NAME
+from macos_virt.constants import (DISK_FILENAME, BOOT_DISK_FILENAME, CLOUDINIT_ISO_NAME,
+                                  DATA_DISK_FILENAME, DISK_CACHE_MODES)
+from macos_virt import cache_proxy, cloudinit, forward
+from macos_virt.admission import AdmissionController
+from macos_virt.archive import export_archive, import_archive, read_index, ArchiveError, FLAG_BASE
+from macos_virt.locking import LockTimeout, control_lock, locked, vm_lock
 from macos_virt.profiles.registry import registry
+from macos_virt.runner import get_runner
+from macos_virt.settings import get_settings
+from macos_virt.sparse import allocated_bytes, compact_file, preallocate
+from macos_virt.transfer import AgentFileTransfer, TransferError
 
 MODULE_PATH = os.path.dirname(__file__)
 
@@ -36,13 +50,22 @@ KEY_PATH_PUBLIC = os.path.join(
     xdg.xdg_config_home(), "macos-virt/macos-virt-identity.pub"
 )
 
-RUNNER_PATH = os.path.join(MODULE_PATH, "macos_virt_runner/macos_virt_runner")
-RUNNER_PATH_ENTITLEMENTS = os.path.join(
-    MODULE_PATH, "macos_virt_runner/" "macos_virt_runner.entitlements"
-)
-
 USERNAME = "macos-virt"
 
+CONTROL_WAIT_TIMEOUT = 30
+
+# In order, each is checkpointed in vm.json when it completes.
+PROVISIONING_STAGES = ["download", "disks", "cloudinit", "boot", "customize"]
+
+DISK_ALLOCATIONS = ("sparse", "preallocated")
+# Also the disk's filesystem label in the guest, ext4 allows 16 characters.
+DISK_NAME_PATTERN = re.compile(r"^[a-z0-9][a-z0-9-]{0,15}$")
+
+SSH_CONNECT_TIMEOUT = 10
+
+STATUS_SNAPSHOT_FILENAME = "status.json"
+STATUS_SETTINGS = {"ttl": 5, "live_timeout": 2}
+
 console = Console()
 
 
@@ -70,6 +93,14 @@ class VMNotRunning(BaseError):
     pass
 
 
+class VMUnreachable(BaseError):
+    pass
+
+
+class VMLocked(BaseError):
+    pass
+
+
 class VMExists(BaseError):
     pass
 
@@ -78,14 +109,56 @@ class InternalErrorException(BaseError):
     pass
 
 
+class ProvisioningFailed(BaseError):
+    pass
+
+
 class ImmutableConfiguration(BaseError):
     pass
 
 
+class InsufficientCapacity(BaseError):
+    pass
+
+
 class VMStarted(typer.Exit):
     code = 0
 
 
+def generate_mac_address():
+    return "52:54:00:%02x:%02x:%02x" % (
+        random.randint(0, 255),
+        random.randint(0, 255),
+        random.randint(0, 255),
+    )
+
+
+def clone_file(source, destination):
+    if platform.system() == "Darwin":
+        check_output(["cp", "-c", source, destination])
+    else:
+        check_output(["cp", "--reflink=auto", "--sparse=always", source, destination])
+
+
+def print_records(records, output):
+    if output == "ndjson":
+        for record in records if isinstance(records, list) else [records]:
+            sys.stdout.write(json.dumps(record) + "\n")
+    else:
+        sys.stdout.write(json.dumps(records, indent=2) + "\n")
+
+
+def format_uptime(seconds):
+    minutes, _ = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    days, hours = divmod(hours, 24)
+    if days:
+        return f"{days}d{hours}h"
+    if hours:
+        return f"{hours}h{minutes}m"
+    return f"{minutes}m"
+
+
 def get_vm_directory(name):
     path = os.path.join(BASE_PATH, name)
     pathlib.Path(path).mkdir(exist_ok=True)
@@ -97,15 +170,21 @@ class VMManager:
         self.name = name
         self.vm_directory = os.path.join(BASE_PATH, name)
         self.vm_configuration_file = os.path.join(self.vm_directory, "vm.json")
+        self.runner = get_runner()
         self.exists = False
         if os.path.exists(self.vm_configuration_file):
             self.exists = True
         self.configuration = {}
         self.profile = None
 
-    def create(self, profile, cpus, memory, disk_size):
-        if self.exists:
-            raise VMExists(f"VM {self.name} already exists")
+    @locked()
+    def create(self, profile, cpus, memory, disk_size, admission_policy=None, resume=False):
+        # Checked again under the lock, another create may have just finished.
+        if os.path.exists(self.vm_configuration_file):
+            self.load_configuration_from_disk()
+            if not resume or not self.pending_stages():
+                raise VMExists(f"VM {self.name} already exists")
+            return self.resume_provisioning(admission_policy)
         self.configuration = {
             "memory": memory,
             "cpus": cpus,
@@ -113,20 +192,62 @@ class VMManager:
             "disk_size": disk_size,
             "ip_address": None,
             "status": "uninitialized",
-            "mac_address": "52:54:00:%02x:%02x:%02x"
-                           % (
-                               random.randint(0, 255),
-                               random.randint(0, 255),
-                               random.randint(0, 255),
-                           ),
+            "mac_address": generate_mac_address(),
+            "instance_id": str(uuid.uuid4()),
+            "provisioning": {"completed": {}},
         }
-        pathlib.Path(self.vm_directory).mkdir(parents=True)
-        self.save_configuration_to_disk()
-        self.profile = registry.get_profile(self.configuration["profile"])
-        self.provision()
+        admission = self.admit(admission_policy)
+        try:
+            pathlib.Path(self.vm_directory).mkdir(parents=True)
+            self.save_configuration_to_disk()
+            self.profile = registry.get_profile(self.configuration["profile"])
+            self.provision()
+        finally:
+            admission.release(self.name)
+
+    def admit(self, policy=None):
+        admission = AdmissionController(Controller.resource_ledger)
+        admitted, problem = admission.admit(
+            self.name, self.configuration["cpus"], self.configuration["memory"], policy)
+        if not admitted:
+            raise InsufficientCapacity(
+                f":no_entry: Not enough host capacity for VM {self.name}: {problem}")
+        if problem:
+            console.print(f":warning: Host is overcommitted by VM {self.name}: {problem}")
+        return admission
 
     def is_provisioned(self):
-        return self.configuration.get("status") == "running"
+        return self.configuration.get("status") == "running" and not self.pending_stages()
+
+    def pending_stages(self):
+        provisioning = self.configuration.get("provisioning")
+        if provisioning is None:
+            # Created before stages were checkpointed, it either finished or
+            # has to be provisioned again from the start.
+            return [] if self.configuration.get("status") == "running" else PROVISIONING_STAGES
+        return [stage for stage in PROVISIONING_STAGES
+                if stage not in provisioning["completed"]]
+
+    def resume_provisioning(self, admission_policy=None):
+        provisioning = self.configuration.setdefault("provisioning", {"completed": {}})
+        pending = self.pending_stages()
+        console.print(f":construction: Resuming provisioning of {self.name} at {pending[0]}")
+        if self.is_running() and pending[0] != "customize":
+            # Left over from a failed boot, the agent only answers once
+            # cloud-init has finished so it may not get to power off.
+            try:
+                self.stop(wait=True, timeout=60)
+            except InternalErrorException:
+                self.stop(force=True)
+                self.wait_for_stop()
+        if "boot" in pending and "cloudinit" in provisioning["completed"]:
+            # cloud-init may have run already, it only runs again for a new instance.
+            self.configuration["instance_id"] = str(uuid.uuid4())
+        admission = self.admit(admission_policy)
+        try:
+            self.provision()
+        finally:
+            admission.release(self.name)
 
     def get_ip_address(self):
         self.load_configuration_from_disk()
@@ -142,17 +263,32 @@ class VMManager:
             os.path.join(self.vm_directory, CLOUDINIT_ISO_NAME),
         )
 
-    def shell(self, args, wait=False):
-        if not self.is_running():
-            raise VMNotRunning(f"🤷 VM {self.name} is not running.")
-        ip_address = self.get_ip_address()
-        to_spawn = [
+    def data_disks(self):
+        return self.configuration.get("disks", [])
+
+    def data_disk_file(self, disk):
+        return os.path.join(self.vm_directory, DATA_DISK_FILENAME.format(name=disk["name"]))
+
+    def ssh_arguments(self, options=()):
+        return [
             "/usr/bin/ssh",
             "-oStrictHostKeyChecking=no",
+            *options,
             "-i",
             KEY_PATH,
-            f"{USERNAME}@{ip_address}",
+            f"{USERNAME}@{self.get_ip_address()}",
         ]
+
+    def command_arguments(self, command):
+        """Arguments running `command` in the guest without a terminal or prompts."""
+        return self.runner.remote_command(
+            self.ssh_arguments(["-oBatchMode=yes", f"-oConnectTimeout={SSH_CONNECT_TIMEOUT}"]),
+            command, self.vm_directory)
+
+    def shell(self, args, wait=False):
+        if not self.is_running():
+            raise VMNotRunning(f"🤷 VM {self.name} is not running.")
+        to_spawn = self.ssh_arguments()
         if args is not None:
             to_spawn += [args]
         if wait:
@@ -167,34 +303,68 @@ class VMManager:
             check_output(["ssh-keygen", "-f", KEY_PATH, "-N", ""])
         return open(KEY_PATH_PUBLIC).read()
 
-    def start(self):
+    @locked()
+    def start(self, admission_policy=None):
         if not self.exists:
             raise VMDoesntExist("🤷 VM {self.name} does not exist.")
         self.load_configuration_from_disk()
+        if self.pending_stages():
+            return self.resume_provisioning(admission_policy)
         if self.is_running():
             raise VMRunning(f"🤷 VM {self.name} is already running.")
 
         elif self.configuration["status"] == "running":
-            return self.boot_normally()
+            # Stops that didn't wait for the VM to go down leave these for now.
+            self.apply_pending_resources()
+            admission = self.admit(admission_policy)
+            try:
+                return self.boot_normally()
+            finally:
+                admission.release(self.name)
 
         raise InternalErrorException(
             f"VM {self.name} is in an unknown state, can't boot."
         )
 
+    @contextlib.contextmanager
+    def lock(self, exclusive=True, command=""):
+        """Hold the VM's advisory lock, exclusive for lifecycle changes."""
+        with contextlib.ExitStack() as stack:
+            try:
+                stack.enter_context(vm_lock(self.name, exclusive, command=command))
+            except LockTimeout as e:
+                raise VMLocked(f"🔒 VM {self.name} is busy. {e}")
+            yield
+
+    @contextlib.contextmanager
+    def control_channel(self, timeout=None):
+        """Hold the VM's control channel so replies can't go to another process."""
+        with contextlib.ExitStack() as stack:
+            try:
+                stack.enter_context(control_lock(self.name, timeout))
+            except LockTimeout as e:
+                raise VMLocked(f"🔒 VM {self.name}'s control channel is busy. {e}")
+            yield
+
     def load_configuration_from_disk(self):
         self.configuration = json.load(open(self.vm_configuration_file))
         self.profile = registry.get_profile(self.configuration["profile"])
 
+    def open_control_port(self, timeout=300):
+        return serial.Serial(os.path.join(self.vm_directory, "control"), timeout=timeout)
+
     @property
     def get_status_port(self):
-        return serial.Serial(os.path.join(self.vm_directory, "control"), timeout=300)
+        return self.open_control_port()
 
     def send_message(self, message):
-        ser = self.get_status_port
-        dumped = json.dumps(message)
-        ser.write((dumped + "\r\n").encode())
+        with self.control_channel():
+            ser = self.get_status_port
+            dumped = json.dumps(message)
+            ser.write((dumped + "\r\n").encode())
 
-    def stop(self, force=False):
+    @locked()
+    def stop(self, force=False, wait=False, timeout=120):
         if not self.is_running():
             raise VMNotRunning(f"🤷 VM {self.name} is not running")
         if force:
@@ -209,32 +379,108 @@ class VMManager:
 
         self.send_message({"message_type": "poweroff"})
         console.print(f":sleeping: Stop request sent to {self.name}")
+        if wait:
+            self.wait_for_stop(timeout)
+            self.apply_pending_resources()
+
+    def wait_for_stop(self, timeout=120):
+        deadline = time.time() + timeout
+        while self.is_running():
+            if time.time() > deadline:
+                raise InternalErrorException(
+                    f"VM {self.name} did not stop within {timeout} seconds.")
+            time.sleep(1)
 
     def provision(self):
+        """Run the provisioning stages that haven't completed yet.
+
+        A stage whose checkpoint is missing or whose artifacts no longer
+        check out is run again, along with every stage after it. When a
+        stage fails the VM is kept, `create --resume` or `start` continue
+        from that stage.
+        """
+        provisioning = self.configuration.setdefault("provisioning", {"completed": {}})
+        completed = provisioning["completed"]
+        redo = False
+        for stage in PROVISIONING_STAGES:
+            if not redo and stage in completed and self.stage_valid(stage, completed[stage]):
+                continue
+            redo = True
+            completed.pop(stage, None)
+            started = time.time()
+            try:
+                checkpoint = getattr(self, f"provision_{stage}")() or {}
+            except (Exception, KeyboardInterrupt) as e:
+                provisioning["failed"] = {"stage": stage, "error": str(e) or type(e).__name__,
+                                          "at": time.time()}
+                self.save_configuration_to_disk()
+                console.print(
+                    f":construction: Provisioning {self.name} failed at {stage}, "
+                    f"run `macos-virt start {self.name}` to continue from there.")
+                raise
+            checkpoint.update(seconds=round(time.time() - started, 1), at=time.time())
+            completed[stage] = checkpoint
+            provisioning.pop("failed", None)
+            self.save_configuration_to_disk()
+
+    def stage_valid(self, stage, checkpoint):
+        vm_disk, vm_boot_disk, cloudinit_iso = self.file_locations()
+        if stage == "disks":
+            return os.path.exists(vm_boot_disk) and os.path.exists(vm_disk) \
+                and os.path.getsize(vm_disk) == checkpoint.get("disk_bytes")
+        if stage == "cloudinit":
+            return os.path.exists(cloudinit_iso) \
+                and checkpoint.get("instance_id") == self.configuration.get("instance_id")
+        return True
+
+    def provision_download(self):
+        self.runner.profile_files(self.profile)
+
+    def provision_disks(self):
         vm_disk, vm_boot_disk, cloudinit_iso = self.file_locations()
-        (
-            kernel,
-            initrd,
-            disk,
-        ) = self.profile.file_locations()
-        check_output(["cp", "-c", disk, vm_disk])
-        mb_padding = b"\0" * MB
+        disk = self.runner.profile_files(self.profile)[2]
+        if os.path.exists(vm_disk):
+            os.unlink(vm_disk)
+        clone_file(disk, vm_disk)
+        # Both images start out sparse, the guest only sees zeros either way.
         with open(vm_boot_disk, "wb") as f:
-            for _ in track(range(256), description="Creating Boot image..."):
-                f.write(mb_padding)
+            f.truncate(256 * MB)
         size = os.path.getsize(vm_disk)
-        chunks = int(((MB * self.configuration["disk_size"]) - size) / MB)
-        with open(vm_disk, "ba") as f:
-            for _ in track(range(chunks), description="Expanding Root Image..."):
-                f.write(mb_padding)
+        if MB * self.configuration["disk_size"] > size:
+            os.truncate(vm_disk, MB * self.configuration["disk_size"])
+        return {"disk_bytes": os.path.getsize(vm_disk)}
+
+    def provision_cloudinit(self):
         ssh_key = self.get_ssh_public_key()
-        cloudinit_content = self.profile.render_cloudinit_data(USERNAME, ssh_key)
+        self.write_cloudinit_iso(self.profile.render_data_disks(
+            self.profile.render_cloudinit_data(
+                USERNAME, ssh_key, cache_proxy.active_guest_proxy_url()),
+            self.data_disks()))
+        return {"instance_id": self.configuration["instance_id"]}
+
+    def provision_boot(self):
+        kernel, initrd, _ = self.runner.profile_files(self.profile)
+        if not self.boot_vm(kernel, initrd):
+            raise ProvisioningFailed(
+                f":rotating_light: cloud-init failed in VM {self.name}, it is still "
+                f"running so you can look at /var/log/cloud-init-output.log.")
+
+    def provision_customize(self):
+        if not self.is_running():
+            self.boot_normally()
+        self.profile.post_provision_customizations(self)
+
+    def write_cloudinit_iso(self, cloudinit_content):
+        cloudinit_iso = self.file_locations()[2]
         iso = pycdlib.PyCdlib()
         iso.new(interchange_level=4, joliet=True, rock_ridge="1.09", vol_ident="cidata")
         userdata = "#cloud-config\n" + yaml.dump(cloudinit_content)
+        metadata = ""
+        if "instance_id" in self.configuration:
+            metadata = f"instance-id: {self.configuration['instance_id']}\n"
         iso.add_fp(
-            BytesIO(),
-            0,
+            BytesIO(metadata.encode()),
+            len(metadata),
             "/METADATA.;1",
             rr_name="meta-data",
             joliet_path="/meta-data",
@@ -249,8 +495,58 @@ class VMManager:
         )
         iso.write(cloudinit_iso)
         iso.close()
-        self.boot_vm(kernel, initrd)
-        self.profile.post_provision_customizations(self)
+
+    @locked(exclusive=False)
+    def clone(self, destination):
+        if not self.exists:
+            raise VMDoesntExist(f"🤷 VM {self.name} does not exist.")
+        if self.is_running():
+            raise VMRunning(
+                f"VM {self.name} is running, please stop it before cloning.")
+        self.load_configuration_from_disk()
+        if not self.is_provisioned():
+            raise InternalErrorException(
+                f"VM {self.name} has not finished provisioning, can't clone.")
+        target = VMManager(destination)
+        with target.lock():
+            return self.clone_into(target)
+
+    def clone_into(self, target):
+        destination = target.name
+        if os.path.exists(target.vm_configuration_file):
+            raise VMExists(f"VM {destination} already exists")
+        pathlib.Path(target.vm_directory).mkdir(parents=True)
+        try:
+            for source_file, target_file in zip(self.file_locations()[:2],
+                                                target.file_locations()[:2]):
+                clone_file(source_file, target_file)
+            for disk in self.data_disks():
+                clone_file(self.data_disk_file(disk), target.data_disk_file(disk))
+            target.configuration = dict(
+                self.configuration,
+                ip_address=None,
+                mac_address=generate_mac_address(),
+                instance_id=str(uuid.uuid4()),
+            )
+            # Ports and resizes belong to the source, the clone keeps the default idle window.
+            for key in ("forwards", "pending_resources", "idle"):
+                target.configuration.pop(key, None)
+            target.profile = self.profile
+            target.write_clone_cloudinit_iso()
+            target.save_configuration_to_disk()
+        except Exception:
+            shutil.rmtree(target.vm_directory)
+            raise
+        target.exists = True
+        console.print(f":dna: VM {destination} cloned from {self.name}")
+        return target
+
+    def write_clone_cloudinit_iso(self):
+        """cloud-init data for a copy of a provisioned VM, it runs again for the new instance."""
+        self.write_cloudinit_iso(self.profile.render_data_disks(
+            self.profile.render_clone_cloudinit_data(
+                USERNAME, self.get_ssh_public_key(), cache_proxy.active_guest_proxy_url()),
+            self.data_disks()))
 
     def boot_vm(self, kernel, initrd):
         try:
@@ -262,19 +558,8 @@ class VMManager:
         except gzip.BadGzipFile:
             pass
 
-        check_output(
-            [
-                "codesign",
-                "-f",
-                "-s",
-                "-",
-                "--entitlements",
-                RUNNER_PATH_ENTITLEMENTS,
-                RUNNER_PATH,
-            ]
-        )
+        self.runner.prepare()
         arguments = [
-            RUNNER_PATH,
             "--pidfile=./pidfile",
             f"--kernel={kernel}",
             "--cmdline=console=hvc0 irqfixup" " quiet root=/dev/vda",
@@ -282,27 +567,46 @@ class VMManager:
             f"--cdrom=./{CLOUDINIT_ISO_NAME}",
             f"--disk={DISK_FILENAME}",
             f"--disk={BOOT_DISK_FILENAME}",
+        ]
+        for disk in self.data_disks():
+            # Like --network's mode, the runner takes a caching mode after an @, see openDisk.
+            cache = "" if disk["cache"] == "automatic" else f"@{disk['cache']}"
+            arguments.append(f"--disk={os.path.basename(self.data_disk_file(disk))}{cache}")
+        arguments += [
             f"--network={self.configuration['mac_address']}@nat",
             f"--cpu-count={self.configuration['cpus']}",
             f"--memory-size={self.configuration['memory']}",
             "--console-symlink=console",
             "--control-symlink=control",
         ]
-        process = subprocess.Popen(arguments, cwd=self.vm_directory)
-        time.sleep(5)
+        control = os.path.join(self.vm_directory, "control")
+        if os.path.lexists(control):
+            os.unlink(control)
+        process = self.runner.launch(arguments, self.vm_directory)
+        deadline = time.time() + CONTROL_WAIT_TIMEOUT
+        while not os.path.exists(control) and process.poll() is None \
+                and time.time() < deadline:
+            time.sleep(0.1)
         try:
-            serial.Serial(os.path.join(self.vm_directory, "control"), timeout=300)
+            serial.Serial(control, timeout=300)
         except serial.serialutil.SerialException:
             returncode = process.wait()
 
             raise InternalErrorException(
                 f"VM Failed to start. " f"Return code {returncode}"
             )
-        subprocess.run(
-            f"/usr/bin/screen -dm -S console-{self.name} {self.vm_directory}/console",
-            shell=True,
-        )
-        self.watch_initialization()
+        # Reap the runner when it exits, a zombie would still look running.
+        threading.Thread(target=process.wait, daemon=True).start()
+        self.runner.attach_console(self.name, self.vm_directory)
+        initialized = self.watch_initialization()
+        if self.data_disks():
+            self.setup_data_disks()
+        if self.configuration.get("forwards"):
+            try:
+                forward.start_forwarder(self.vm_directory)
+            except forward.ForwarderFailed as e:
+                console.print(f":warning: VM {self.name} started without its forwards: {e}")
+        return initialized
 
     def format_status(self, status):
         grid = Table.grid()
@@ -318,8 +622,10 @@ class VMManager:
         print(grid)
 
     def save_configuration_to_disk(self):
-        with open(os.path.join(self.vm_directory, "vm.json"), "w") as f:
+        # Replaced in one step so readers never see a partly written file.
+        with open(self.vm_configuration_file + ".tmp", "w") as f:
             json.dump(self.configuration, f)
+        os.replace(self.vm_configuration_file + ".tmp", self.vm_configuration_file)
 
     def update_vm_status(self, status):
         status_string = status["status"]
@@ -335,6 +641,7 @@ class VMManager:
         self.configuration["status"] = status_string
         self.save_configuration_to_disk()
         if status_string == "running":
+            self.save_status_snapshot(status)
             self.format_status(status)
             if "network_addresses" in status:
                 for address, netmask in status["network_addresses"]:
@@ -357,44 +664,123 @@ class VMManager:
 
     def boot_normally(self):
         vm_disk, vm_boot_disk, cloudinit_iso = self.file_locations()
-        mountpoint = subprocess.check_output(
-            ["hdiutil", "attach", "-readonly", "-imagekey", "diskimage-class=CRawDiskImage",
-             vm_boot_disk]).decode().split()[1]
-
-        kernel_path, initrd_path = self.profile.get_boot_files_from_filesystem(mountpoint)
-        console.print(
-            f":floppy_disk: Booting with Kernel {kernel_path} and"
-            f" Ramdisk {initrd_path} from Boot volume"
-        )
-        with tempfile.NamedTemporaryFile(delete=True) as kernel:
-            kernel.write(open(os.path.join(mountpoint, kernel_path), "rb").read())
-            with tempfile.NamedTemporaryFile(delete=True) as initrd:
-                initrd.write(open(os.path.join(mountpoint, initrd_path), "rb").read())
-                subprocess.check_output(["hdiutil", "detach", mountpoint])
-                self.boot_vm(kernel.name, initrd.name)
+        with self.runner.boot_files(vm_boot_disk, self.profile) as (
+                kernel_path, initrd_path, kernel, initrd):
+            console.print(
+                f":floppy_disk: Booting with Kernel {kernel_path} and"
+                f" Ramdisk {initrd_path} from Boot volume"
+            )
+            self.boot_vm(kernel, initrd)
+
+    def initialization_kind(self):
+        """What cloud-init does on this boot, which decides how long it takes."""
+        if "boot" in self.pending_stages():
+            return "provision"
+        # Clones and recreated instances run the per-instance modules again.
+        if self.configuration.get("initialized_instance_id") != \
+                self.configuration.get("instance_id"):
+            return "first_boot"
+        return "boot"
 
     def watch_initialization(self):
         text = "🥚 VM has been created"
 
         console.print(text)
-        port = self.get_status_port
-
-        while True:
-            status = json.loads(port.readline().decode())
-            if self.update_vm_status(status):
-                break
-
-    def get_status_obj(self):
+        failed = False
+        progress = cloudinit.InitializationProgress(self.name, self.profile.name,
+                                                    self.initialization_kind())
+        with self.control_channel(), progress:
+            port = self.get_status_port
+
+            while True:
+                status = json.loads(port.readline().decode())
+                if status["status"] == "initialization_progress":
+                    progress.event(status)
+                    continue
+                if status["status"] == "initialization_complete":
+                    progress.finish(succeeded=True)
+                    self.configuration["initialized_instance_id"] = \
+                        self.configuration.get("instance_id")
+                elif status["status"] == "initialization_error":
+                    progress.finish(succeeded=False)
+                    failed = True
+                if self.update_vm_status(status):
+                    return not failed
+
+    def read_status_snapshot(self):
+        try:
+            snapshot = json.load(
+                open(os.path.join(self.vm_directory, STATUS_SNAPSHOT_FILENAME)))
+            booted = os.path.getmtime(os.path.join(self.vm_directory, "pidfile"))
+        except (OSError, ValueError):
+            return None
+        # A snapshot taken before the VM last booted describes another boot.
+        if booted > snapshot["timestamp"]:
+            return None
+        return snapshot
+
+    def save_status_snapshot(self, status):
+        path = os.path.join(self.vm_directory, STATUS_SNAPSHOT_FILENAME)
+        with open(path + ".tmp", "w") as f:
+            json.dump({"timestamp": time.time(), "status": status}, f)
+        os.replace(path + ".tmp", path)
+
+    def get_status_obj(self, fresh=False, ttl=None, timeout=300):
         if not self.is_running():
             raise VMNotRunning("VM {self.name} is not running.")
-        self.send_message({"message_type": "status"})
-        port = self.get_status_port
-        return json.loads(port.readline().decode())
-
-    def print_realtime_status(self):
-        status_obj = self.get_status_obj()
-        self.format_status(status_obj)
+        snapshot = self.read_status_snapshot()
+        if not fresh:
+            if ttl is None:
+                ttl = get_settings("status", STATUS_SETTINGS)["ttl"]
+            if snapshot and time.time() - snapshot["timestamp"] < ttl:
+                return snapshot["status"]
+        previous = snapshot["status"] if snapshot else {}
+        status = self.query_status(since=previous.get("seq"),
+                                   session=previous.get("session"), timeout=timeout)
+        if previous.get("session") and status.get("session") == previous["session"]:
+            # Only the fields that changed since the snapshot were sent.
+            status = dict(previous, **status)
+        self.save_status_snapshot(status)
+        return status
+
+    def query_status(self, fields=None, since=None, session=None, timeout=300):
+        request = {"message_type": "status"}
+        if fields:
+            request["fields"] = fields
+        if since is not None:
+            request.update(since=since, session=session)
+        deadline = time.time() + timeout
+        with self.control_channel(timeout):
+            try:
+                port = self.open_control_port(timeout=timeout)
+                port.write((json.dumps(request) + "\r\n").encode())
+            except (serial.serialutil.SerialException, OSError) as e:
+                raise VMUnreachable(f"VM {self.name} is unreachable: {e}")
+            while True:
+                # read_until bounds the whole line by the port timeout, unlike readline.
+                port.timeout = max(deadline - time.time(), 0)
+                try:
+                    line = port.read_until(b"\n")
+                except serial.serialutil.SerialException as e:
+                    # The VM went away mid reply, most likely it was stopped.
+                    raise VMUnreachable(f"VM {self.name} is unreachable: {e}")
+                if not line.endswith(b"\n"):
+                    raise VMUnreachable(f"VM {self.name} did not answer within {timeout}s")
+                try:
+                    status = json.loads(line.decode())
+                except ValueError:
+                    continue
+                if "status" in status:
+                    return status
+
+    def print_realtime_status(self, output="table", fresh=False):
+        status_obj = self.get_status_obj(fresh=fresh)
+        if output == "table":
+            self.format_status(status_obj)
+        else:
+            print_records(dict(status_obj, name=self.name), output)
 
+    @locked()
     def delete(self):
         if not self.exists:
             raise VMDoesntExist(f"🤷 VM {self.name} does not exist.")
@@ -402,18 +788,22 @@ class VMManager:
             raise VMRunning(
                 f"VM {self.name} is running, please stop it before deleting."
             )
+        forward.stop_forwarder(self.vm_directory)
         shutil.rmtree(self.vm_directory)
 
-    def cp(self, source, destination, recursive=False):
+    @locked(exclusive=False)
+    def cp(self, source, destination, recursive=False, via_agent=False):
         if not self.is_running():
             raise VMNotRunning(f"🤷 VM {self.name} is not running.")
+        if via_agent:
+            return self.cp_via_agent(source, destination, recursive)
         args = []
         if source.startswith("vm:"):
             args.append(f"{USERNAME}@{self.get_ip_address()}:{source[3:]}")
             args.append(destination)
         elif destination.startswith("vm:"):
             args.append(source)
-            args.append(f"{USERNAME}@{self.get_ip_address()}:{source[3:]}")
+            args.append(f"{USERNAME}@{self.get_ip_address()}:{destination[3:]}")
         if not args:
             raise InternalErrorException(
                 "Copy arguments missing vm: prefix to indicate direction."
@@ -429,13 +819,45 @@ class VMManager:
                     ] + args
         check_output(full_args)
 
+    def require_capability(self, capability):
+        capabilities = self.get_status_obj().get("capabilities", [])
+        if capability not in capabilities:
+            raise InternalErrorException(
+                f"🤷 The agent in VM {self.name} does not support {capability}, "
+                f"it needs to be recreated.")
+        return capabilities
+
+    def cp_via_agent(self, source, destination, recursive=False):
+        if recursive:
+            raise InternalErrorException(
+                "Recursive copies are not supported via the agent, use scp.")
+        capabilities = self.require_capability("file_transfer")
+        with self.control_channel():
+            transfer = AgentFileTransfer(self.open_control_port(timeout=60),
+                                         framed="framing" in capabilities)
+            try:
+                if source.startswith("vm:"):
+                    transfer.download(source[3:], destination)
+                elif destination.startswith("vm:"):
+                    transfer.upload(source, destination[3:])
+                else:
+                    raise InternalErrorException(
+                        "Copy arguments missing vm: prefix to indicate direction."
+                    )
+            except TransferError as e:
+                raise InternalErrorException(f":broken_heart: {e}")
+
     def list_mounts(self):
         if not self.is_running():
             raise VMNotRunning(f"🤷 VM {self.name} is not running.")
-        status = self.get_status_obj()
+        status = self.query_status(fields=["sshfs_mounts"])
+        if "sshfs_mounts" in status:
+            return status["sshfs_mounts"]
+        # Agents without field selection always send the whole mount table.
         return [x.split(" ")[1] for x in status['mounts'].splitlines()
                 if "fuse.sshfs" in x]
 
+    @locked(exclusive=False)
     def mount(self, source, destination, ro=False):
         if not self.is_running():
             raise VMNotRunning(f"🤷 VM {self.name} is not running.")
@@ -466,13 +888,137 @@ class VMManager:
         else:
             console.print(f":broken_heart: {destination} was not mounted successfully")
 
-    def update_resources(self, memory, cpus):
+    def setup_data_disks(self):
+        """Have the agent format and mount disks added since the first boot."""
+        try:
+            self.require_capability("disks")
+        except InternalErrorException:
+            console.print(f":warning: The agent in VM {self.name} can't set up data disks, "
+                          f"only those present at creation are mounted.")
+            return
+        reply = self.request({"message_type": "setup_disks", "disks": [
+            {"name": disk["name"], "mount": disk["mount"]} for disk in self.data_disks()]},
+            timeout=600)
+        for result in reply["disks"]:
+            if not result["ok"]:
+                console.print(f":broken_heart: Data disk {result['name']} ({result['device']}) "
+                              f"was not mounted: {result['error']}")
+            elif result["formatted"]:
+                console.print(f":minidisc: Data disk {result['name']} formatted")
+
+    @locked()
+    def add_disk(self, name, size, allocation="sparse", cache="automatic", mount=None,
+                 source=None):
+        """Attach a data disk of `size` MB, or the existing image at `source`."""
+        if not self.exists:
+            raise VMDoesntExist(f"🤷 VM {self.name} does not exist.")
+        if self.is_running():
+            raise VMRunning(f"VM {self.name} is running, please stop it before adding disks.")
+        self.load_configuration_from_disk()
+        if not DISK_NAME_PATTERN.match(name):
+            raise InternalErrorException(
+                f"🤷 Disk names are up to 16 lowercase letters, digits and dashes, not {name}.")
+        if any(disk["name"] == name for disk in self.data_disks()):
+            raise InternalErrorException(f"🤷 VM {self.name} already has a disk {name}.")
+        disk = {"name": name, "allocation": allocation, "cache": cache,
+                "mount": mount or f"/mnt/{name}"}
+        path = self.data_disk_file(disk)
+        if source:
+            shutil.move(source, path)
+        elif allocation == "preallocated":
+            preallocate(path, size * MB)
+        else:
+            with open(path, "wb") as f:
+                f.truncate(size * MB)
+        disk["size"] = os.path.getsize(path) // MB
+        self.configuration.setdefault("disks", []).append(disk)
+        self.save_configuration_to_disk()
+        console.print(f":minidisc: Disk {name} ({disk['size']}MB, {allocation}) added to "
+                      f"{self.name}, mounted at {disk['mount']} from the next boot")
+
+    @locked()
+    def remove_disk(self, name, keep=None):
+        """Detach a data disk, deleting its image unless it is moved to `keep`."""
+        if not self.exists:
+            raise VMDoesntExist(f"🤷 VM {self.name} does not exist.")
+        if self.is_running():
+            raise VMRunning(f"VM {self.name} is running, please stop it before removing disks.")
+        self.load_configuration_from_disk()
+        disks = [disk for disk in self.data_disks() if disk["name"] == name]
+        if not disks:
+            raise InternalErrorException(f"🤷 VM {self.name} has no disk {name}.")
+        path = self.data_disk_file(disks[0])
+        if keep:
+            shutil.move(path, keep)
+            console.print(f":minidisc: Disk {name} detached from {self.name} and kept at {keep}")
+        else:
+            os.unlink(path)
+            console.print(f":wastebasket: Disk {name} removed from {self.name}")
+        self.configuration["disks"].remove(disks[0])
+        self.save_configuration_to_disk()
+
+    def list_disks(self, output="table"):
+        if not self.exists:
+            raise VMDoesntExist(f"🤷 VM {self.name} does not exist.")
+        self.load_configuration_from_disk()
+        disks = []
+        for index, disk in enumerate(self.data_disks()):
+            path = self.data_disk_file(disk)
+            disks.append(dict(disk, device=f"/dev/vd{chr(ord('c') + index)}",
+                              allocated=allocated_bytes(path) // MB if os.path.exists(path)
+                              else None))
+        if output != "table":
+            print_records(disks, output)
+            return
+        table = Table()
+        table.add_column("Disk")
+        table.add_column("Size", justify="right")
+        table.add_column("Allocated", justify="right")
+        table.add_column("Allocation")
+        table.add_column("Cache")
+        table.add_column("Mount")
+        for disk in disks:
+            table.add_row(disk["name"], f"{disk['size']}MB",
+                          "missing" if disk["allocated"] is None else f"{disk['allocated']}MB",
+                          disk["allocation"], disk["cache"], f"{disk['mount']} ({disk['device']})")
+        print(table)
+
+    @locked()
+    def set_idle_policy(self, minutes=None, never=False):
+        """Override the idle monitor's window for this VM, or opt it out."""
+        if not self.exists:
+            raise VMDoesntExist(f"🤷 VM {self.name} does not exist.")
+        self.load_configuration_from_disk()
+        if never:
+            self.configuration["idle"] = {"never": True}
+            console.print(f":zzz: VM {self.name} will never be stopped when idle")
+        elif minutes is not None:
+            self.configuration["idle"] = {"minutes": minutes}
+            console.print(f":zzz: VM {self.name} will be stopped after {minutes} idle minutes")
+        else:
+            self.configuration.pop("idle", None)
+            console.print(f":zzz: VM {self.name} follows the default idle policy")
+        self.save_configuration_to_disk()
+
+    @locked()
+    def update_resources(self, memory, cpus, disk_size=None):
         if self.is_running():
             raise VMRunning(
                 f"🤷 VM {self.name} is running, "
                 f"Please shut it down before updating resources."
             )
         self.load_configuration_from_disk()
+        self.check_disk_size(disk_size)
+        # Changing resources now replaces what was scheduled for the next stop.
+        superseded = self.configuration.pop("pending_resources", None)
+        if disk_size:
+            console.print(
+                f":rocket: growing the disk from "
+                f"{self.configuration['disk_size']} to {disk_size}"
+            )
+            # The guest grows its root filesystem into the space on the next boot.
+            os.truncate(self.file_locations()[0], disk_size * MB)
+            self.configuration["disk_size"] = disk_size
         if memory:
             console.print(
                 f":rocket: changing memory from "
@@ -480,16 +1026,279 @@ class VMManager:
             )
             self.configuration["memory"] = memory
         if cpus:
-            self.configuration["cpus"] = cpus
             console.print(
                 f":rocket: changing CPUs from "
                 f"{self.configuration['cpus']} to {cpus}"
             )
-        if memory or cpus:
+            self.configuration["cpus"] = cpus
+        if memory or cpus or disk_size or superseded:
             self.save_configuration_to_disk()
-        else:
+        if not (memory or cpus or disk_size):
             console.print(f"🤷 You didn't ask to change anything.")
 
+    def check_disk_size(self, disk_size):
+        if disk_size and disk_size < self.configuration["disk_size"]:
+            raise InternalErrorException(
+                f"🤷 Disks can't shrink, VM {self.name} has "
+                f"{self.configuration['disk_size']}MB.")
+
+    @locked()
+    def schedule_resources(self, memory=None, cpus=None, disk_size=None):
+        """Update resources now if the VM is stopped, otherwise when it next stops."""
+        if not self.is_running():
+            self.update_resources(memory, cpus, disk_size)
+            return
+        self.load_configuration_from_disk()
+        self.check_disk_size(disk_size)
+        changes = {"memory": memory, "cpus": cpus, "disk_size": disk_size}
+        pending = self.configuration.setdefault("pending_resources", {})
+        pending.update({resource: value for resource, value in changes.items() if value})
+        self.save_configuration_to_disk()
+        console.print(f":calendar: VM {self.name} will be updated to "
+                      f"{', '.join(f'{resource} {value}' for resource, value in pending.items())}"
+                      f" when it next stops")
+
+    def apply_pending_resources(self):
+        self.load_configuration_from_disk()
+        pending = self.configuration.get("pending_resources")
+        if not pending:
+            return
+        disk_size = pending.get("disk_size")
+        if disk_size and disk_size < self.configuration["disk_size"]:
+            # The disk grew past it since, shrinking would cut off the filesystem.
+            console.print(f":warning: Not shrinking VM {self.name}'s disk to {disk_size}MB, "
+                          f"it has {self.configuration['disk_size']}MB.")
+            disk_size = None
+        try:
+            # Clears pending_resources once applied.
+            self.update_resources(pending.get("memory"), pending.get("cpus"), disk_size)
+        except (InternalErrorException, OSError) as e:
+            # An update that can't apply mustn't keep the VM from starting or stopping.
+            console.print(f":warning: Dropped the update scheduled for VM {self.name}: {e}")
+            self.load_configuration_from_disk()
+            self.configuration.pop("pending_resources", None)
+            self.save_configuration_to_disk()
+
+    @locked(exclusive=False)
+    def request(self, message, timeout=60, on_message=None):
+        """Send `message` to the agent and return its reply of the same type.
+
+        Other messages received meanwhile are passed to `on_message`.
+        """
+        with self.control_channel():
+            port = self.open_control_port(timeout=timeout)
+            port.write((json.dumps(message) + "\r\n").encode())
+            while True:
+                line = port.readline()
+                if not line:
+                    raise VMUnreachable(f"VM {self.name} did not answer within {timeout}s")
+                reply = json.loads(line.decode())
+                if reply.get("message_type") in (message["message_type"], "error"):
+                    break
+                if on_message:
+                    on_message(reply)
+        if reply["message_type"] == "error":
+            raise InternalErrorException(f":broken_heart: {reply['error']}")
+        return reply
+
+    def trim_guest(self, zero_free=False):
+        self.require_capability("fstrim")
+        reply = self.request({"message_type": "fstrim", "zero_free": zero_free}, timeout=3600)
+        if not reply["ok"]:
+            console.print(":warning: fstrim failed, the disks may not support discard")
+        console.print(reply["output"].strip())
+
+    def top(self, count=10, sort="cpu"):
+        if not self.is_running():
+            raise VMNotRunning(f"🤷 VM {self.name} is not running.")
+        self.require_capability("top")
+        return self.request({"message_type": "top", "count": count, "sort": sort})
+
+    def print_processes(self, count=10, sort="cpu", output="table"):
+        reply = self.top(count, sort)
+        if output != "table":
+            print_records(reply["processes"], output)
+            return
+        table = Table()
+        table.add_column("PID", justify="right")
+        table.add_column("Name")
+        for column in ("CPU %", "RSS MB", "Read KB/s", "Write KB/s"):
+            table.add_column(column, justify="right")
+        table.add_column("Command", overflow="ellipsis", no_wrap=True)
+        for process in reply["processes"]:
+            rates = [process["read_rate"], process["write_rate"]]
+            table.add_row(
+                str(process["pid"]),
+                process["name"],
+                "" if process["cpu"] is None else str(process["cpu"]),
+                str(process["rss"] // MB),
+                *["" if rate is None else str(rate // 1024) for rate in rates],
+                process["command"],
+            )
+        print(table)
+        console.print(
+            f"{reply['total']} processes, sampled {reply['age']}s ago every "
+            f"{reply['interval']}s at {reply['sample_cpu_seconds'] * 1000:.1f}ms CPU per sample")
+
+    @locked()
+    def compact(self, zero_free=False):
+        if not self.exists:
+            raise VMDoesntExist(f"🤷 VM {self.name} does not exist.")
+        if self.is_running():
+            self.trim_guest(zero_free)
+            console.print(
+                f":sleeping: Guest filesystems trimmed, stop {self.name} and run "
+                f"compact again to reclaim the space on the host.")
+            return
+        self.load_configuration_from_disk()
+        reclaimed = 0
+        # Preallocated disks are left alone, compacting would undo it.
+        paths = list(self.file_locations()[:2]) + [
+            self.data_disk_file(disk) for disk in self.data_disks()
+            if disk["allocation"] == "sparse"]
+        for path in paths:
+            before, after = compact_file(path)
+            reclaimed += before - after
+            console.print(
+                f":scissors: {os.path.basename(path)} "
+                f"{before // MB}MB -> {after // MB}MB allocated")
+        console.print(f":broom: Reclaimed {reclaimed // MB}MB from VM {self.name}")
+
+    @locked(exclusive=False)
+    def export(self, destination, dedupe_base=False, level=6, workers=None):
+        if not self.exists:
+            raise VMDoesntExist(f"🤷 VM {self.name} does not exist.")
+        if self.is_running():
+            raise VMRunning(
+                f"VM {self.name} is running, please stop it before exporting.")
+        self.load_configuration_from_disk()
+        base_image = None
+        if dedupe_base:
+            base_image = self.runner.profile_files(self.profile)[2]
+        vm_disk, vm_boot_disk, cloudinit_iso = self.file_locations()
+        configuration = dict(self.configuration, name=self.name)
+        export_archive(
+            destination,
+            configuration,
+            dict({DISK_FILENAME: vm_disk, BOOT_DISK_FILENAME: vm_boot_disk,
+                  CLOUDINIT_ISO_NAME: cloudinit_iso},
+                 **{os.path.basename(self.data_disk_file(disk)): self.data_disk_file(disk)
+                    for disk in self.data_disks()}),
+            base_image=base_image,
+            level=level,
+            workers=workers,
+        )
+        console.print(
+            f":package: VM {self.name} exported to {destination} "
+            f"({os.path.getsize(destination) // MB}MB)")
+
+    @locked()
+    def import_archive(self, source, index):
+        if self.exists:
+            raise VMExists(f"VM {self.name} already exists")
+        # Like a clone, an imported VM is a new machine, importing twice makes two.
+        configuration = dict(index["configuration"], ip_address=None,
+                             mac_address=generate_mac_address(), instance_id=str(uuid.uuid4()))
+        configuration.pop("name", None)
+        self.profile = registry.get_profile(configuration["profile"])
+        base_image = None
+        if any(chunk["flags"] & FLAG_BASE
+               for entry in index["files"] for chunk in entry["chunks"]):
+            # Downloaded first if need be, like for a new VM.
+            base_image = self.runner.profile_files(self.profile)[2]
+        pathlib.Path(self.vm_directory).mkdir(parents=True)
+        try:
+            import_archive(source, self.vm_directory, index, base_image=base_image)
+            self.configuration = configuration
+            if self.is_provisioned():
+                self.write_clone_cloudinit_iso()
+            self.save_configuration_to_disk()
+        except BaseException as e:
+            # Half an import, interrupted or not, is no VM.
+            shutil.rmtree(self.vm_directory, ignore_errors=True)
+            if isinstance(e, ArchiveError):
+                raise InternalErrorException(f":broken_heart: {e}")
+            raise
+        self.exists = True
+        console.print(f":package: VM {self.name} imported from {source}")
+
+    @locked()
+    def add_forward(self, host_port, guest_port, bind="127.0.0.1"):
+        if not self.exists:
+            raise VMDoesntExist(f"🤷 VM {self.name} does not exist.")
+        self.load_configuration_from_disk()
+        forwards = self.configuration.setdefault("forwards", [])
+        if any(f["host_port"] == host_port for f in forwards):
+            raise InternalErrorException(f"🤷 Port {host_port} is already forwarded.")
+        definition = {"host_port": host_port, "guest_port": guest_port, "bind": bind}
+        forwards.append(definition)
+        self.save_configuration_to_disk()
+        if self.is_running():
+            try:
+                forward.start_forwarder(self.vm_directory)
+            except forward.ForwarderFailed as e:
+                # The other forwards listened before, bring them back without this one.
+                forwards.remove(definition)
+                self.save_configuration_to_disk()
+                if forwards:
+                    self.restart_forwarder()
+                raise InternalErrorException(f":broken_heart: {e}")
+        console.print(f":link: {bind}:{host_port} forwards to port {guest_port} of {self.name}")
+
+    def restart_forwarder(self):
+        try:
+            forward.start_forwarder(self.vm_directory)
+        except forward.ForwarderFailed as e:
+            raise InternalErrorException(f":broken_heart: {e}")
+
+    @locked()
+    def remove_forward(self, host_port):
+        if not self.exists:
+            raise VMDoesntExist(f"🤷 VM {self.name} does not exist.")
+        self.load_configuration_from_disk()
+        forwards = self.configuration.get("forwards", [])
+        remaining = [f for f in forwards if f["host_port"] != host_port]
+        if len(remaining) == len(forwards):
+            raise InternalErrorException(f"🤷 Port {host_port} is not forwarded.")
+        self.configuration["forwards"] = remaining
+        self.save_configuration_to_disk()
+        console.print(f"❌ Forward of port {host_port} removed.")
+        if self.is_running():
+            if remaining:
+                self.restart_forwarder()
+            else:
+                forward.stop_forwarder(self.vm_directory)
+
+    def list_forwards(self):
+        if not self.exists:
+            raise VMDoesntExist(f"🤷 VM {self.name} does not exist.")
+        self.load_configuration_from_disk()
+        stats = forward.read_stats(self.vm_directory)
+        running = forward.is_forwarder_running(self.vm_directory)
+        table = Table()
+        table.add_column("Host")
+        table.add_column("Guest Port")
+        table.add_column("Status")
+        table.add_column("Connections (active/total)")
+        table.add_column("In")
+        table.add_column("Out")
+        for definition in self.configuration.get("forwards", []):
+            entry = stats.get(definition["host_port"])
+            row = [f"{definition['bind']}:{definition['host_port']}",
+                   str(definition["guest_port"])]
+            if running and entry:
+                row += [
+                    "Forwarding :link:",
+                    f"{entry['connections_active']}/{entry['connections_total']}",
+                    f"{entry['bytes_in'] // MB}MB ({entry['rate_in'] / MB:.1f}MB/s)",
+                    f"{entry['bytes_out'] // MB}MB ({entry['rate_out'] / MB:.1f}MB/s)",
+                ]
+            else:
+                row += ["Stopped :stop_button:", "", "", ""]
+            table.add_row(*row)
+        print(table)
+
+    @locked(exclusive=False)
     def umount(self, mountpoint):
         mounts = self.list_mounts()
         if mountpoint not in mounts:
@@ -513,37 +1322,152 @@ class Controller:
         return [x for x in vms if VMManager(x).is_running()]
 
     @classmethod
-    def get_all_vm_status(cls):
-        vms = cls.list_all_vms()
+    def resource_ledger(cls):
+        ledger = []
+        for vm in cls.list_running_vms():
+            vm_obj = VMManager(vm)
+            vm_obj.load_configuration_from_disk()
+            ledger.append({"name": vm, "cpus": vm_obj.configuration["cpus"],
+                           "memory": vm_obj.configuration["memory"]})
+        return ledger
+
+    @classmethod
+    def print_capacity(cls):
+        headroom = AdmissionController(cls.resource_ledger).headroom()
+        grid = Table.grid()
+        grid.add_column(width=40)
+        grid.add_column(style="bold")
+        grid.add_row("Host CPUs", str(headroom["host_cpus"]))
+        grid.add_row("Host Memory", f"{headroom['host_memory']}MB")
+        grid.add_row("CPU Limit (with overcommit)", f"{headroom['cpu_limit']:g}")
+        grid.add_row("Memory Limit (with overcommit)", f"{headroom['memory_limit']:g}MB")
+        grid.add_row("Reserved CPUs", str(headroom["reserved_cpus"]))
+        grid.add_row("Reserved Memory", f"{headroom['reserved_memory']}MB")
+        grid.add_row("CPU Headroom", f"{headroom['free_cpus']:g}")
+        grid.add_row("Memory Headroom", f"{headroom['free_memory']:g}MB")
+        print(grid)
         table = Table()
         table.add_column("VM Name", width=35)
-        table.add_column("IP Address")
-        table.add_column("Profile")
         table.add_column("CPUs")
         table.add_column("Memory")
-        table.add_column("Status")
-        for vm in vms:
+        table.add_column("State")
+        for vm in headroom["ledger"]:
+            state = "Booting :hourglass:" if "pid" in vm else "Running :person_running:"
+            table.add_row(vm["name"], str(vm["cpus"]), str(vm["memory"]), state)
+        print(table)
+
+    @classmethod
+    def clone_vm(cls, source, destination, count=1):
+        if count == 1:
+            return [VMManager(source).clone(destination)]
+        names = [f"{destination}-{number}" for number in range(1, count + 1)]
+        with ThreadPoolExecutor(max_workers=min(count, 8)) as pool:
+            return list(pool.map(lambda name: VMManager(source).clone(name), names))
+
+    @classmethod
+    def import_vm(cls, source, name=None):
+        try:
+            index = read_index(source)
+        except ArchiveError as e:
+            raise InternalErrorException(f":broken_heart: {e}")
+        VMManager(name or index["configuration"]["name"]).import_archive(source, index)
+
+    @classmethod
+    def vm_summaries(cls, live=False, timeout=None):
+        summaries = []
+        for vm in cls.list_all_vms():
             vm_obj = VMManager(vm)
             if vm_obj.exists:
                 vm_obj.load_configuration_from_disk()
                 configuration = vm_obj.configuration
-                try:
-                    ip_address = vm_obj.get_ip_address()
-                except VMHasNoAssignedAddress:
-                    ip_address = "None"
+                summaries.append({
+                    "name": vm,
+                    "ip_address": configuration.get("ip_address"),
+                    "profile": configuration["profile"],
+                    "cpus": configuration["cpus"],
+                    "memory": configuration["memory"],
+                    "status": "running" if vm_obj.is_running() else "stopped",
+                    "pending_stages": vm_obj.pending_stages(),
+                })
+        if live:
+            cls.add_live_metrics(summaries, timeout)
+        return summaries
+
+    @staticmethod
+    def add_live_metrics(summaries, timeout=None):
+        """Query every running VM at once, waiting at most `timeout` seconds overall."""
+        if timeout is None:
+            timeout = get_settings("status", STATUS_SETTINGS)["live_timeout"]
+        running = [summary for summary in summaries if summary["status"] == "running"]
+        if not running:
+            return
+        deadline = time.time() + timeout
+        statuses = {}
 
-                if vm_obj.is_running():
-                    status = "Running :person_running:"
+        def query(name):
+            # Lock waits and reads share what is left of the deadline.
+            try:
+                statuses[name] = VMManager(name).get_status_obj(
+                    timeout=max(deadline - time.time(), 0))
+            except Exception:
+                pass
+
+        # Daemon threads, a VM that never answers can't hold up exiting.
+        threads = [threading.Thread(target=query, args=(summary["name"],), daemon=True)
+                   for summary in running]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(max(deadline - time.time(), 0))
+        statuses = dict(statuses)
+        for summary in running:
+            status = statuses.get(summary["name"])
+            if status is None:
+                summary["status"] = "unreachable"
+                continue
+            for field in ("cpu_usage", "memory_usage", "root_fs_usage", "uptime"):
+                summary[field] = status.get(field)
+
+    @classmethod
+    def get_all_vm_status(cls, output="table", live=False, timeout=None):
+        summaries = cls.vm_summaries(live, timeout)
+        if output != "table":
+            print_records(summaries, output)
+            return
+        table = Table()
+        table.add_column("VM Name", width=35)
+        table.add_column("IP Address")
+        table.add_column("Profile")
+        table.add_column("CPUs")
+        table.add_column("Memory")
+        table.add_column("Status")
+        if live:
+            for column in ("CPU %", "Memory %", "Root FS %", "Uptime"):
+                table.add_column(column, justify="right")
+        for summary in summaries:
+            if summary["status"] == "running":
+                status = "Running :person_running:"
+            elif summary["status"] == "unreachable":
+                status = "Unreachable :warning:"
+            elif summary["pending_stages"]:
+                status = "Incomplete :construction:"
+            else:
+                status = "Stopped :stop_button:"
+
+            row = [
+                summary["name"],
+                str(summary["ip_address"]),
+                summary["profile"],
+                str(summary["cpus"]),
+                str(summary["memory"]),
+                status,
+            ]
+            if live:
+                if "uptime" in summary:
+                    row += [str(summary["cpu_usage"]), str(summary["memory_usage"]),
+                            str(summary["root_fs_usage"]), format_uptime(summary["uptime"])]
                 else:
-                    status = "Stopped :stop_button:"
-
-                table.add_row(
-                    vm,
-                    ip_address,
-                    configuration["profile"],
-                    str(configuration["cpus"]),
-                    str(configuration["memory"]),
-                    status,
-                )
+                    row += ["", "", "", ""]
+            table.add_row(*row)
 
         print(table)
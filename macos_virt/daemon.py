@@ -0,0 +1,49 @@
+"""Background processes, like the idle monitor, tracked by a pid file."""
+import os
+import pathlib
+import signal
+import subprocess
+import sys
+
+
+def read_pid(pidfile):
+    try:
+        return int(open(pidfile).read())
+    except (OSError, ValueError):
+        return None
+
+
+def is_running(pidfile):
+    pid = read_pid(pidfile)
+    if pid is None:
+        return False
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+
+def start(module, pidfile, log_file, arguments=()):
+    """Run `python -m module` detached unless it already runs, returning its pid."""
+    if is_running(pidfile):
+        return read_pid(pidfile)
+    pathlib.Path(os.path.dirname(pidfile)).mkdir(parents=True, exist_ok=True)
+    with open(log_file, "a") as log:
+        process = subprocess.Popen(
+            [sys.executable, "-m", module, *arguments],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=log,
+            start_new_session=True,
+        )
+    with open(pidfile, "w") as f:
+        f.write(str(process.pid))
+    return process.pid
+
+
+def stop(pidfile):
+    if is_running(pidfile):
+        os.kill(read_pid(pidfile), signal.SIGTERM)
+    if os.path.exists(pidfile):
+        os.unlink(pidfile)
@@ -0,0 +1,178 @@
+"""Runs one command in many running VMs at once, for `macos-virt run`."""
+import fnmatch
+import os
+import shlex
+import signal
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from rich.console import Console
+from rich.markup import escape
+from rich.table import Table
+
+from macos_virt.controller import BaseError, Controller, VMManager, VMNotRunning, print_records
+
+console = Console(highlight=False)
+
+# Output kept per stream and VM for the report, older output is dropped.
+OUTPUT_LIMIT = 1024 * 1024
+POLL_INTERVAL = 0.1
+PRINT_LOCK = threading.Lock()
+COLORS = ("cyan", "magenta", "green", "yellow", "blue", "red")
+
+
+class NoMatchingVMs(BaseError):
+    pass
+
+
+def select_vms(patterns, all_vms=False):
+    """Running VMs matching any of the names or globs in `patterns`."""
+    running = sorted(Controller.list_running_vms())
+    if all_vms:
+        selected = running
+    else:
+        selected = [name for name in running
+                    if any(fnmatch.fnmatch(name, pattern) for pattern in patterns)]
+    if not selected:
+        raise NoMatchingVMs("🤷 No running VM matches, see `macos-virt ls`.")
+    return selected
+
+
+class Output:
+    """One stream of a command, printed as it comes and kept for the report."""
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.data = bytearray()
+        self.truncated = False
+
+    def read(self, stream, echo):
+        for line in iter(stream.readline, b""):
+            self.data += line
+            if len(self.data) > OUTPUT_LIMIT:
+                del self.data[:len(self.data) - OUTPUT_LIMIT]
+                self.truncated = True
+            if echo:
+                text = line.decode(errors="replace").rstrip("\n")
+                with PRINT_LOCK:
+                    console.print(f"{self.prefix} {escape(text)}", soft_wrap=True)
+
+    def text(self):
+        return self.data.decode(errors="replace")
+
+
+class FanOut:
+    def __init__(self, names, command, parallel=8, timeout=300, fail_fast=False, echo=True):
+        self.names = names
+        self.command = command
+        self.parallel = parallel
+        self.timeout = timeout
+        self.fail_fast = fail_fast
+        self.echo = echo
+        self.cancelled = threading.Event()
+        width = max(len(name) for name in names)
+        self.prefixes = {
+            name: f"[{COLORS[index % len(COLORS)]}]{escape(name.ljust(width))} |[/]"
+            for index, name in enumerate(names)
+        }
+
+    def run_one(self, name):
+        result = {"vm": name, "status": "skipped", "exit_code": None, "duration": None}
+        if self.cancelled.is_set():
+            return result
+        vm = VMManager(name)
+        started = time.monotonic()
+        try:
+            with vm.lock(exclusive=False, command="run"):
+                if not vm.is_running():
+                    raise VMNotRunning(f"🤷 VM {name} is not running.")
+                result.update(self.execute(name, vm.command_arguments(self.command)))
+        except (BaseError, OSError) as e:
+            result.update(status="error", error=str(e))
+        result["duration"] = round(time.monotonic() - started, 3)
+        if result["status"] != "ok" and self.fail_fast:
+            self.cancelled.set()
+        return result
+
+    def execute(self, name, arguments):
+        process = subprocess.Popen(arguments, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE, start_new_session=True)
+        outputs = {"stdout": Output(self.prefixes[name]),
+                   "stderr": Output(self.prefixes[name] + "[red]![/]")}
+        readers = [threading.Thread(target=outputs[key].read,
+                                    args=(getattr(process, key), self.echo))
+                   for key in outputs]
+        for reader in readers:
+            reader.start()
+        deadline = time.monotonic() + self.timeout
+        status = None
+        while status is None:
+            try:
+                process.wait(timeout=POLL_INTERVAL)
+                status = "ok" if process.returncode == 0 else "failed"
+            except subprocess.TimeoutExpired:
+                if time.monotonic() > deadline:
+                    status = "timeout"
+                elif self.cancelled.is_set():
+                    status = "cancelled"
+                else:
+                    continue
+                # Children holding the output pipes open go too.
+                os.killpg(process.pid, signal.SIGKILL)
+                process.wait()
+        for reader in readers:
+            reader.join()
+        result = {"status": status,
+                  "exit_code": process.returncode if status in ("ok", "failed") else None}
+        for key, output in outputs.items():
+            result[key] = output.text()
+            if output.truncated:
+                result[f"{key}_truncated"] = True
+        return result
+
+    def run(self):
+        with ThreadPoolExecutor(max_workers=max(min(self.parallel, len(self.names)), 1)) as pool:
+            return list(pool.map(self.run_one, self.names))
+
+
+def run(names, command, parallel=8, timeout=300, fail_fast=False, output="table"):
+    """Run `command`, a list of arguments, in every VM and report each VM's result.
+
+    Returns whether it succeeded everywhere.
+    """
+    fan_out = FanOut(names, shlex.join(command), parallel, timeout, fail_fast,
+                     echo=output == "table")
+    started = time.time()
+    results = fan_out.run()
+    report = {
+        "command": command,
+        "started": started,
+        "duration": round(time.time() - started, 3),
+        "ok": all(result["status"] == "ok" for result in results),
+        "vms": results,
+    }
+    if output == "ndjson":
+        print_records(results, output)
+    elif output != "table":
+        print_records(report, output)
+    else:
+        print_summary(results)
+    return report["ok"]
+
+
+def print_summary(results):
+    table = Table()
+    table.add_column("VM")
+    table.add_column("Status")
+    table.add_column("Exit code", justify="right")
+    table.add_column("Duration", justify="right")
+    for result in results:
+        status = result["status"]
+        if "error" in result:
+            status += f": {result['error']}"
+        table.add_row(result["vm"], status,
+                      "" if result["exit_code"] is None else str(result["exit_code"]),
+                      "" if result["duration"] is None else f"{result['duration']:.1f}s")
+    console.print(table)
@@ -0,0 +1,273 @@
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import yaml
+from rich.console import Console
+from rich.table import Table
+
+from macos_virt.admission import DEFAULTS as ADMISSION_DEFAULTS, host_capacity
+from macos_virt.controller import BaseError, VMManager
+from macos_virt.profiles.registry import registry
+from macos_virt.runner import get_runner
+from macos_virt.settings import get_settings
+
+console = Console()
+
+VM_DEFAULTS = {
+    "profile": "ubuntu-20.04",
+    "cpus": 1,
+    "memory": 2048,
+    "disk_size": 5000,
+    "state": "running",
+    "mounts": [],
+}
+
+RESOURCES = ("cpus", "memory", "io", "downloads")
+
+
+class InvalidManifest(BaseError):
+    pass
+
+
+class Action:
+    def __init__(self, kind, target, run, depends=(), **resources):
+        self.kind = kind
+        self.target = target
+        self.run = run
+        self.depends = list(depends)
+        self.resources = {name: resources.get(name, 0) for name in RESOURCES}
+        self.status = "pending"
+        self.error = None
+        self.duration = None
+
+    @property
+    def id(self):
+        return f"{self.kind}:{self.target}"
+
+
+def load_manifest(path):
+    manifest = yaml.safe_load(open(path)) or {}
+    defaults = dict(VM_DEFAULTS, **manifest.get("defaults", {}))
+    desired = []
+    names = set()
+    for vm in manifest.get("vms", []):
+        vm = dict(defaults, **vm)
+        if "name" not in vm:
+            raise InvalidManifest(f"A VM in {path} has no name")
+        if vm["name"] in names:
+            raise InvalidManifest(f"VM {vm['name']} is defined twice in {path}")
+        if vm["profile"] not in registry:
+            raise InvalidManifest(f"VM {vm['name']} has unknown profile {vm['profile']}")
+        if vm["state"] not in ("running", "stopped"):
+            raise InvalidManifest(f"VM {vm['name']} has invalid state {vm['state']}")
+        names.add(vm["name"])
+        desired.append(vm)
+    # By default as much as the host has for VMs, as admission sees it.
+    admission = get_settings("admission", ADMISSION_DEFAULTS)
+    host_cpus, host_memory = host_capacity(admission)
+    budget = {"cpus": host_cpus, "memory": host_memory - admission["reserved_memory_mb"],
+              "io": 2, "downloads": 1}
+    budget.update(manifest.get("budget", {}))
+    return desired, budget
+
+
+class Plan:
+    def __init__(self):
+        self.actions = {}
+        self.warnings = []
+
+    def add(self, kind, target, run, depends=(), **resources):
+        action = Action(kind, target, run, [d for d in depends if d], **resources)
+        self.actions[action.id] = action
+        return action.id
+
+    def last_action_for(self, name):
+        ids = [action.id for action in self.actions.values() if action.target == name]
+        return ids[-1] if ids else None
+
+
+def update_if_changed(name, memory, cpus):
+    manager = VMManager(name)
+    manager.load_configuration_from_disk()
+    if (manager.configuration["memory"], manager.configuration["cpus"]) != (memory, cpus):
+        manager.update_resources(memory, cpus)
+
+
+def build_plan(desired):
+    plan = Plan()
+    desired_by_name = {vm["name"]: vm for vm in desired}
+
+    runner = get_runner()
+    for profile_name in sorted({vm["profile"] for vm in desired}):
+        profile = registry.get_profile(profile_name)
+        # The runner knows where a profile's files come from, like for `create`.
+        if not runner.has_profile_files(profile):
+            plan.add("download", profile_name,
+                     lambda profile=profile: runner.profile_files(profile), downloads=1)
+
+    # Clone sources are planned first so their clones can depend on them.
+    for vm in sorted(desired, key=lambda vm: vm.get("clone_from") in desired_by_name):
+        plan_vm(plan, vm, desired_by_name)
+    return plan
+
+
+def plan_vm(plan, vm, desired_by_name):
+    name = vm["name"]
+    manager = VMManager(name)
+    boot = {"cpus": vm["cpus"], "memory": vm["memory"]}
+    previous = None
+    running = False
+
+    if not manager.exists and vm.get("clone_from"):
+        source = vm["clone_from"]
+        if desired_by_name.get(source, {}).get("state") == "running":
+            raise InvalidManifest(f"Clone source {source} of {name} must be stopped")
+        previous = plan.add("clone", name,
+                            lambda: VMManager(source).clone(name),
+                            [plan.last_action_for(source)], io=1)
+        previous = plan.add("update", name,
+                            lambda: update_if_changed(name, vm["memory"], vm["cpus"]),
+                            [previous])
+    elif not manager.exists:
+        download = f"download:{vm['profile']}"
+        previous = plan.add("create", name,
+                            lambda: VMManager(name).create(
+                                vm["profile"], vm["cpus"], vm["memory"], vm["disk_size"]),
+                            [download if download in plan.actions else None],
+                            io=1, **boot)
+        running = True
+    else:
+        manager.load_configuration_from_disk()
+        configuration = manager.configuration
+        running = manager.is_running()
+        if configuration["profile"] != vm["profile"]:
+            plan.warnings.append(f"{name}: profile can't change, recreate the VM")
+        if configuration["disk_size"] != vm["disk_size"]:
+            plan.warnings.append(f"{name}: disk_size can't change, recreate the VM")
+        if (configuration["cpus"], configuration["memory"]) != (vm["cpus"], vm["memory"]):
+            if running:
+                previous = plan.add("stop", name,
+                                    lambda: VMManager(name).stop(wait=True))
+                running = False
+            previous = plan.add("update", name,
+                                lambda: VMManager(name).update_resources(
+                                    vm["memory"], vm["cpus"]),
+                                [previous])
+
+    if vm["state"] == "running" and not running:
+        previous = plan.add("start", name, lambda: VMManager(name).start(),
+                            [previous], **boot)
+    elif vm["state"] == "stopped" and running:
+        previous = plan.add("stop", name, lambda: VMManager(name).stop(wait=True),
+                            [previous])
+
+    if vm["state"] == "running" and vm["mounts"]:
+        mounted = []
+        if previous is None:
+            mounted = manager.list_mounts()
+        for number, mount in enumerate(vm["mounts"]):
+            if mount["destination"] in mounted:
+                continue
+            previous = plan.add(
+                f"mount-{number}", name,
+                lambda mount=mount: VMManager(name).mount(
+                    os.path.expanduser(mount["source"]), mount["destination"],
+                    mount.get("ro", False)),
+                [previous])
+
+
+class Scheduler:
+    """Runs plan actions once their dependencies finish, within the budget.
+
+    The budget bounds what is in flight at once: CPUs and memory of booting
+    VMs, disk heavy operations and downloads.
+    """
+
+    def __init__(self, actions, budget, workers=8):
+        self.actions = list(actions)
+        self.budget = budget
+        self.workers = workers
+        self.in_use = {name: 0 for name in RESOURCES}
+
+    def fits(self, action):
+        if not any(self.in_use.values()):
+            return True
+        for name, amount in action.resources.items():
+            limit = self.budget.get(name)
+            if amount and limit is not None and self.in_use[name] + amount > limit:
+                return False
+        return True
+
+    def execute(self, action):
+        start = time.time()
+        try:
+            action.run()
+        finally:
+            action.duration = time.time() - start
+
+    def run(self):
+        by_id = {action.id: action for action in self.actions}
+        pending = list(self.actions)
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            while pending or running:
+                for action in list(pending):
+                    states = [by_id[d].status for d in action.depends if d in by_id]
+                    if any(state in ("failed", "skipped") for state in states):
+                        action.status = "skipped"
+                        pending.remove(action)
+                    elif all(state == "done" for state in states) and self.fits(action):
+                        for name, amount in action.resources.items():
+                            self.in_use[name] += amount
+                        action.status = "running"
+                        running[pool.submit(self.execute, action)] = action
+                        pending.remove(action)
+                if not running:
+                    continue
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    action = running.pop(future)
+                    for name, amount in action.resources.items():
+                        self.in_use[name] -= amount
+                    try:
+                        future.result()
+                        action.status = "done"
+                    except Exception as e:
+                        action.status = "failed"
+                        action.error = str(getattr(e, "exit_code", e))
+        return all(action.status == "done" for action in self.actions)
+
+
+def print_plan(plan, results=False):
+    for warning in plan.warnings:
+        console.print(f":warning: {warning}")
+    if not plan.actions:
+        console.print(":white_check_mark: Fleet is up to date")
+        return
+    table = Table()
+    table.add_column("Action")
+    table.add_column("VM / Profile")
+    table.add_column("After")
+    if results:
+        table.add_column("Result")
+        table.add_column("Duration")
+    for action in plan.actions.values():
+        row = [action.kind, action.target, ", ".join(action.depends)]
+        if results:
+            row.append(action.status if not action.error
+                       else f"{action.status}: {action.error}")
+            row.append(f"{action.duration:.1f}s" if action.duration is not None else "")
+        table.add_row(*row)
+    console.print(table)
+
+
+def apply(path, dry_run=False, workers=8):
+    desired, budget = load_manifest(path)
+    plan = build_plan(desired)
+    if dry_run or not plan.actions:
+        print_plan(plan)
+        return True
+    succeeded = Scheduler(plan.actions.values(), budget, workers).run()
+    print_plan(plan, results=True)
+    return succeeded
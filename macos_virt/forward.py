@@ -0,0 +1,274 @@
+import asyncio
+import json
+import os
+import socket
+import sys
+import time
+
+from macos_virt import daemon
+
+BUFFER_SIZE = 256 * 1024
+SOCKET_BUFFER_SIZE = 1024 * 1024
+POOL_SIZE = 2
+STATS_INTERVAL = 2
+STARTUP_TIMEOUT = 10
+
+PIDFILE = "forward.pid"
+STATS_FILE = "forward-stats.json"
+ERROR_FILE = "forward-error"
+LOG_FILE = "forward.log"
+
+
+class ForwarderFailed(Exception):
+    pass
+
+
+def tune_socket(sock):
+    if sock is None:
+        return
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_SIZE)
+
+
+class GuestAddress:
+    """The guest's IP from vm.json, reloaded whenever the file changes."""
+
+    def __init__(self, vm_directory):
+        self.path = os.path.join(vm_directory, "vm.json")
+        self.mtime = None
+        self.address = None
+
+    def get(self):
+        mtime = os.stat(self.path).st_mtime_ns
+        if mtime != self.mtime:
+            self.address = json.load(open(self.path)).get("ip_address")
+            self.mtime = mtime
+        return self.address
+
+
+class UpstreamReader(asyncio.StreamReader):
+    """Remembers the guest closing its side, even with data left unread."""
+
+    closed_by_peer = False
+
+    def feed_eof(self):
+        self.closed_by_peer = True
+        super().feed_eof()
+
+
+class Forward:
+    def __init__(self, guest, host_port, guest_port, bind="127.0.0.1", pool_size=POOL_SIZE):
+        self.guest = guest
+        self.host_port = host_port
+        self.guest_port = guest_port
+        self.bind = bind
+        self.pool_size = pool_size
+        self.pool = []
+        self.refilling = False
+        # asyncio only keeps weak references to tasks, a connection whose
+        # reads are paused by flow control could otherwise be collected.
+        self.tasks = set()
+        self.connections_total = 0
+        self.connections_active = 0
+        self.connect_errors = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    async def open_upstream(self, address):
+        loop = asyncio.get_running_loop()
+        reader = UpstreamReader(limit=BUFFER_SIZE)
+        transport, protocol = await loop.create_connection(
+            lambda: asyncio.StreamReaderProtocol(reader), address, self.guest_port)
+        writer = asyncio.StreamWriter(transport, protocol, reader, loop)
+        tune_socket(writer.get_extra_info("socket"))
+        return reader, writer
+
+    async def connect_upstream(self):
+        address = self.guest.get()
+        while self.pool:
+            pooled_address, reader, writer = self.pool.pop()
+            # at_eof() stays false while a banner sent before the guest
+            # half-closed is still buffered.
+            if pooled_address == address and not reader.closed_by_peer \
+                    and reader.exception() is None and not writer.is_closing():
+                return reader, writer
+            writer.close()
+        return await self.open_upstream(address)
+
+    async def refill_pool(self):
+        # Keeps a few idle upstream connections open so clients skip the
+        # connect round trip to the guest.
+        if self.refilling:
+            return
+        self.refilling = True
+        try:
+            while len(self.pool) < self.pool_size:
+                address = self.guest.get()
+                reader, writer = await self.open_upstream(address)
+                self.pool.append((address, reader, writer))
+        except OSError:
+            pass
+        finally:
+            self.refilling = False
+
+    async def pipe(self, reader, writer, counter):
+        try:
+            while True:
+                data = await reader.read(BUFFER_SIZE)
+                if not data:
+                    break
+                setattr(self, counter, getattr(self, counter) + len(data))
+                writer.write(data)
+                await writer.drain()
+            if writer.can_write_eof():
+                writer.write_eof()
+        except (ConnectionError, OSError):
+            writer.close()
+
+    def track(self, task):
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def handle(self, client_reader, client_writer):
+        self.track(asyncio.current_task())
+        self.connections_total += 1
+        self.connections_active += 1
+        tune_socket(client_writer.get_extra_info("socket"))
+        try:
+            try:
+                upstream_reader, upstream_writer = await self.connect_upstream()
+            except OSError:
+                self.connect_errors += 1
+                client_writer.close()
+                return
+            self.track(asyncio.ensure_future(self.refill_pool()))
+            await asyncio.gather(
+                self.pipe(client_reader, upstream_writer, "bytes_out"),
+                self.pipe(upstream_reader, client_writer, "bytes_in"),
+            )
+            upstream_writer.close()
+            client_writer.close()
+        finally:
+            self.connections_active -= 1
+
+    async def start(self):
+        server = await asyncio.start_server(
+            self.handle, self.bind, self.host_port, limit=BUFFER_SIZE, reuse_address=True)
+        self.track(asyncio.ensure_future(self.refill_pool()))
+        return server
+
+    def stats(self):
+        return {
+            "host_port": self.host_port,
+            "guest_port": self.guest_port,
+            "bind": self.bind,
+            "connections_total": self.connections_total,
+            "connections_active": self.connections_active,
+            "connect_errors": self.connect_errors,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+        }
+
+
+def vm_alive(vm_directory):
+    try:
+        os.kill(int(open(os.path.join(vm_directory, "pidfile")).read()), 0)
+    except (OSError, ValueError):
+        return False
+    return True
+
+
+def write_stats(vm_directory, forwards, previous, interval):
+    stats = []
+    for forward in forwards:
+        entry = forward.stats()
+        last = previous.get(forward.host_port, entry)
+        entry["rate_in"] = (entry["bytes_in"] - last["bytes_in"]) / interval
+        entry["rate_out"] = (entry["bytes_out"] - last["bytes_out"]) / interval
+        previous[forward.host_port] = entry
+        stats.append(entry)
+    path = os.path.join(vm_directory, STATS_FILE)
+    with open(path + ".tmp", "w") as f:
+        json.dump({"timestamp": time.time(), "forwards": stats}, f)
+    os.replace(path + ".tmp", path)
+
+
+async def serve(vm_directory, definitions):
+    guest = GuestAddress(vm_directory)
+    forwards = [
+        Forward(guest, d["host_port"], d["guest_port"], d.get("bind", "127.0.0.1"),
+                d.get("pool", POOL_SIZE))
+        for d in definitions
+    ]
+    servers = []
+    for forward in forwards:
+        try:
+            servers.append(await forward.start())
+        except OSError as e:
+            raise ForwarderFailed(
+                f"Can't listen on {forward.bind}:{forward.host_port}: {e.strerror or e}")
+    previous = {}
+    # The first stats tell start_forwarder every port is listening.
+    write_stats(vm_directory, forwards, previous, STATS_INTERVAL)
+    while forwards and vm_alive(vm_directory):
+        await asyncio.sleep(STATS_INTERVAL)
+        write_stats(vm_directory, forwards, previous, STATS_INTERVAL)
+    for server in servers:
+        server.close()
+
+
+def is_forwarder_running(vm_directory):
+    return daemon.is_running(os.path.join(vm_directory, PIDFILE))
+
+
+def stop_forwarder(vm_directory):
+    daemon.stop(os.path.join(vm_directory, PIDFILE))
+    for name in (STATS_FILE, ERROR_FILE):
+        if os.path.exists(os.path.join(vm_directory, name)):
+            os.unlink(os.path.join(vm_directory, name))
+
+
+def start_forwarder(vm_directory):
+    """Start the forwarder, returning once it listens on every port."""
+    stop_forwarder(vm_directory)
+    pid = daemon.start("macos_virt.forward", os.path.join(vm_directory, PIDFILE),
+                       os.path.join(vm_directory, LOG_FILE), [vm_directory])
+    deadline = time.time() + STARTUP_TIMEOUT
+    while not os.path.exists(os.path.join(vm_directory, STATS_FILE)):
+        try:
+            error = open(os.path.join(vm_directory, ERROR_FILE)).read()
+        except OSError:
+            error = None
+        if error or time.time() > deadline:
+            stop_forwarder(vm_directory)
+            raise ForwarderFailed(
+                error or f"The forwarder didn't start, see {os.path.join(vm_directory, LOG_FILE)}")
+        time.sleep(0.05)
+    return pid
+
+
+def read_stats(vm_directory):
+    try:
+        stats = json.load(open(os.path.join(vm_directory, STATS_FILE)))
+    except (OSError, ValueError):
+        return {}
+    return {entry["host_port"]: entry for entry in stats["forwards"]}
+
+
+def main():
+    vm_directory = sys.argv[1]
+    definitions = json.load(open(os.path.join(vm_directory, "vm.json"))).get("forwards", [])
+    try:
+        asyncio.run(serve(vm_directory, definitions))
+    except ForwarderFailed as e:
+        print(e, file=sys.stderr)
+        with open(os.path.join(vm_directory, ERROR_FILE), "w") as f:
+            f.write(str(e))
+    if daemon.read_pid(os.path.join(vm_directory, PIDFILE)) == os.getpid():
+        os.unlink(os.path.join(vm_directory, PIDFILE))
+
+
+if __name__ == "__main__":
+    main()
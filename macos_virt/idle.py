@@ -0,0 +1,236 @@
+"""Stops VMs nobody has used for a while.
+
+The monitor runs in the background, samples every running VM through its
+agent and stops a VM gracefully once it has been idle for its window.
+Every sample and every stop is appended to the activity log.
+
+    python -m macos_virt.idle
+"""
+import fnmatch
+import json
+import os
+import pathlib
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import xdg
+
+from macos_virt import daemon
+from macos_virt import forward
+from macos_virt.controller import BaseError, Controller, VMManager
+from macos_virt.settings import get_settings
+
+DEFAULTS = {
+    # Minutes without activity before a running VM is stopped.
+    "idle_minutes": 60,
+    # Seconds between samples.
+    "interval": 60,
+    # A VM above either of these is in use.
+    "cpu_threshold": 5.0,
+    "network_threshold_kb": 16,
+    # Names or globs of VMs never stopped, `idle set VM --never` does the same per VM.
+    "exclude": [],
+    "directory": os.path.join(xdg.xdg_config_home(), "macos-virt/idle"),
+}
+
+ACTIVITY_FIELDS = ["cpu_usage", "network_bytes", "ssh_sessions", "users", "sshfs_mounts"]
+SAMPLE_TIMEOUT = 10
+LOG_MAX_BYTES = 10 * 1024 * 1024
+
+
+def settings():
+    return get_settings("idle", DEFAULTS)
+
+
+def path(config, name):
+    return os.path.join(config["directory"], name)
+
+
+def idle_window(vm, config):
+    """Minutes a VM may sit idle, or None when it is never stopped."""
+    if any(fnmatch.fnmatch(vm.name, pattern) for pattern in config["exclude"]):
+        return None
+    policy = vm.configuration.get("idle", {})
+    if policy.get("never"):
+        return None
+    return policy.get("minutes", config["idle_minutes"])
+
+
+def booted_at(vm):
+    try:
+        return os.path.getmtime(os.path.join(vm.vm_directory, "pidfile"))
+    except OSError:
+        return None
+
+
+def activity_reasons(sample, config):
+    """Why a sample counts as activity, nothing means idle."""
+    reasons = []
+    if sample["cpu_usage"] >= config["cpu_threshold"]:
+        reasons.append("cpu")
+    if sample.get("network_rate") is not None and \
+            sample["network_rate"] >= config["network_threshold_kb"] * 1024:
+        reasons.append("network")
+    # Every sshfs mount holds an ssh connection into the guest.
+    if sample["ssh_sessions"] > len(sample["sshfs_mounts"]):
+        reasons.append("ssh")
+    if sample["users"]:
+        reasons.append("users")
+    if sample["forwarded_connections"]:
+        reasons.append("forwards")
+    return reasons
+
+
+class IdleMonitor:
+    def __init__(self, config=None):
+        self.config = config or settings()
+        pathlib.Path(self.config["directory"]).mkdir(parents=True, exist_ok=True)
+        try:
+            self.state = json.load(open(path(self.config, "state.json")))
+        except (OSError, ValueError):
+            self.state = {}
+
+    def save_state(self):
+        state_path = path(self.config, "state.json")
+        with open(state_path + ".tmp", "w") as f:
+            json.dump(self.state, f)
+        os.replace(state_path + ".tmp", state_path)
+
+    def log(self, entry):
+        log_path = path(self.config, "activity.log")
+        if os.path.exists(log_path) and os.path.getsize(log_path) > LOG_MAX_BYTES:
+            os.replace(log_path, log_path + ".1")
+        with open(log_path, "a") as f:
+            f.write(json.dumps(dict(entry, time=time.time())) + "\n")
+
+    def sample(self, vm):
+        status = vm.query_status(fields=ACTIVITY_FIELDS, timeout=SAMPLE_TIMEOUT)
+        missing = [field for field in ACTIVITY_FIELDS if field not in status]
+        if missing:
+            raise ValueError(f"the agent doesn't report {', '.join(missing)}, "
+                             f"recreate the VM to update it")
+        sample = {field: status[field] for field in ACTIVITY_FIELDS}
+        forwards = forward.read_stats(vm.vm_directory).values()
+        sample["forwarded_connections"] = sum(entry["connections_active"] for entry in forwards)
+        return sample
+
+    def check(self, vm, sample, now):
+        """Update a VM's idle state from a sample, returning whether to stop it."""
+        window = idle_window(vm, self.config)
+        booted = booted_at(vm)
+        state = self.state.get(vm.name)
+        if state is None or state["booted"] != booted:
+            # Never seen or rebooted since, its idle time starts now.
+            state = self.state[vm.name] = {"booted": booted, "last_active": now,
+                                           "network_bytes": None, "sampled_at": None}
+        # Counters start again from zero when the guest's interface resets.
+        previous = state["network_bytes"]
+        if previous is not None and sample["network_bytes"] >= previous:
+            sample["network_rate"] = int((sample["network_bytes"] - previous)
+                                         / (now - state["sampled_at"]))
+        reasons = activity_reasons(sample, self.config)
+        if reasons:
+            state["last_active"] = now
+        state.update(network_bytes=sample["network_bytes"], sampled_at=now,
+                     last_sample=sample, window=window)
+        idle_for = now - state["last_active"]
+        self.log({"vm": vm.name, "event": "sample", "active": reasons,
+                  "idle_seconds": int(idle_for), "cpu_usage": sample["cpu_usage"],
+                  "network_rate": sample.get("network_rate"),
+                  "ssh_sessions": sample["ssh_sessions"], "users": sample["users"]})
+        return window is not None and idle_for >= window * 60
+
+    def stop(self, vm, now):
+        idle_for = int(now - self.state[vm.name]["last_active"])
+        try:
+            vm.stop(wait=True)
+        except BaseError as e:
+            self.log({"vm": vm.name, "event": "stop_failed", "error": str(e)})
+            return
+        self.state.pop(vm.name, None)
+        self.log({"vm": vm.name, "event": "stopped", "idle_seconds": idle_for})
+
+    def run_once(self):
+        vms = [VMManager(name) for name in Controller.list_running_vms()]
+        for name in set(self.state) - {vm.name for vm in vms}:
+            del self.state[name]
+        with ThreadPoolExecutor(max_workers=max(len(vms), 1)) as pool:
+            samples = list(pool.map(self.try_sample, vms))
+        now = time.time()
+        for vm, sample in zip(vms, samples):
+            if sample is None:
+                continue
+            if self.check(vm, sample, now):
+                self.stop(vm, now)
+        self.save_state()
+
+    def try_sample(self, vm):
+        try:
+            vm.load_configuration_from_disk()
+            if vm.pending_stages():
+                # Still being created, its stages may take a while.
+                return None
+            return self.sample(vm)
+        except (BaseError, OSError, ValueError, KeyError) as e:
+            # A busy or unresponsive VM isn't known to be idle.
+            self.log({"vm": vm.name, "event": "unreachable", "error": str(e)})
+            return None
+
+    def run(self):
+        while True:
+            self.run_once()
+            time.sleep(self.config["interval"])
+            # Picks up settings.yaml changes without a restart.
+            self.config = settings()
+
+
+def pidfile(config):
+    return path(config, "idle.pid")
+
+
+def is_running(config=None):
+    return daemon.is_running(pidfile(config or settings()))
+
+
+def start():
+    config = settings()
+    return daemon.start("macos_virt.idle", pidfile(config), path(config, "monitor.log"))
+
+
+def stop():
+    daemon.stop(pidfile(settings()))
+
+
+def status():
+    """The monitor's view of every VM, for `idle status`."""
+    config = settings()
+    try:
+        state = json.load(open(path(config, "state.json")))
+    except (OSError, ValueError):
+        state = {}
+    vms = []
+    for name in Controller.list_all_vms():
+        vm = VMManager(name)
+        vm.load_configuration_from_disk()
+        entry = state.get(name, {}) if vm.is_running() else {}
+        vms.append({
+            "name": name,
+            "running": vm.is_running(),
+            "idle_minutes": idle_window(vm, config),
+            "idle_seconds": int(time.time() - entry["last_active"]) if entry else None,
+            "last_sample": entry.get("last_sample"),
+        })
+    return {"running": is_running(config), "interval": config["interval"], "vms": vms}
+
+
+def read_log(name=None, lines=20):
+    config = settings()
+    try:
+        entries = [json.loads(line) for line in open(path(config, "activity.log"))]
+    except OSError:
+        return []
+    return [entry for entry in entries if name is None or entry["vm"] == name][-lines:]
+
+
+if __name__ == "__main__":
+    IdleMonitor().run()
@@ -0,0 +1,131 @@
+import contextlib
+import fcntl
+import functools
+import json
+import os
+import pathlib
+import threading
+import time
+
+import xdg
+
+from macos_virt.settings import get_settings
+
+LOCKS_PATH = os.path.join(xdg.xdg_config_home(), "macos-virt/locks")
+
+DEFAULTS = {
+    # Seconds to wait for another command working on the same VM.
+    "timeout": 120,
+    "download_timeout": 3600,
+}
+
+POLL_INTERVAL = 0.1
+
+_held = threading.local()
+
+
+class LockTimeout(Exception):
+    def __init__(self, name, holder):
+        self.name = name
+        self.holder = holder
+        super().__init__(f"Timed out waiting for lock {name}{describe_holder(holder)}")
+
+
+def describe_holder(holder):
+    if not holder:
+        return ""
+    try:
+        os.kill(holder["pid"], 0)
+    except OSError:
+        # The kernel drops flock locks with their last descriptor, a dead
+        # holder means a child inherited it.
+        return f", last taken by exited process {holder['pid']} ({holder['command']})"
+    return f", held by process {holder['pid']} ({holder['command']})"
+
+
+def held_locks():
+    if not hasattr(_held, "locks"):
+        _held.locks = {}
+    return _held.locks
+
+
+def read_holder(path):
+    try:
+        return json.load(open(path + ".holder"))
+    except (OSError, ValueError):
+        return None
+
+
+def write_holder(path, exclusive, command):
+    with open(path + ".holder.tmp", "w") as f:
+        json.dump({"pid": os.getpid(), "exclusive": exclusive, "command": command}, f)
+    os.replace(path + ".holder.tmp", path + ".holder")
+
+
+@contextlib.contextmanager
+def lock(name, exclusive=True, timeout=None, command=""):
+    """Advisory lock on `name`, shared or exclusive, waiting up to `timeout`.
+
+    Locks are flock()s so a crashed holder never leaves a stale lock
+    behind. They are reentrant within a thread, an exclusive lock also
+    covers shared requests.
+    """
+    path = os.path.join(LOCKS_PATH, name + ".lock")
+    held = held_locks()
+    if path in held:
+        if exclusive and not held[path]:
+            raise RuntimeError(f"Can't upgrade shared lock {name} to exclusive")
+        yield
+        return
+
+    if timeout is None:
+        timeout = get_settings("locks", DEFAULTS)["timeout"]
+    pathlib.Path(LOCKS_PATH).mkdir(parents=True, exist_ok=True)
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        operation = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+        deadline = time.time() + timeout
+        while True:
+            try:
+                fcntl.flock(fd, operation | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                if time.time() >= deadline:
+                    raise LockTimeout(name, read_holder(path))
+                time.sleep(POLL_INTERVAL)
+        if exclusive:
+            write_holder(path, exclusive, command)
+        held[path] = exclusive
+        try:
+            yield
+        finally:
+            del held[path]
+            if exclusive and os.path.exists(path + ".holder"):
+                os.unlink(path + ".holder")
+    finally:
+        os.close(fd)
+
+
+def vm_lock(vm_name, exclusive=True, timeout=None, command=""):
+    return lock(f"vm-{vm_name}", exclusive, timeout, command)
+
+
+def control_lock(vm_name, timeout=None):
+    """Serializes request/reply exchanges on a VM's control channel."""
+    return lock(f"control-{vm_name}", True, timeout)
+
+
+def download_lock(profile_name):
+    return lock(f"profile-{profile_name}", True,
+                get_settings("locks", DEFAULTS)["download_timeout"], "download")
+
+
+def locked(exclusive=True):
+    """Decorate a VMManager method to hold the VM's lock while it runs."""
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.lock(exclusive, command=method.__name__):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
@@ -1,16 +1,20 @@
 import enum
+import time
 from importlib.metadata import version as package_version
+from typing import List
 
 import typer
 from rich.console import Console
 from rich.table import Table
 
-from macos_virt.controller import Controller, VMManager
+from macos_virt import bench, cache_proxy, fanout, fleet, idle, usage
+from macos_virt.controller import (Controller, VMManager, print_records, DISK_ALLOCATIONS,
+                                   DISK_CACHE_MODES)
 from macos_virt.profiles.registry import registry
 
 app = typer.Typer(name="macos-virt - a utility to run Linux VMs using Virtualization.Framework")
 
-profiles = [(profile, profile) for profile in registry.profiles.keys()]
+profiles = [(profile, profile) for profile in registry.get_profiles()]
 
 profiles_enum = enum.Enum("Profiles", dict(profiles))
 
@@ -21,6 +25,48 @@ running_vms = [(vm, vm) for vm in Controller.list_running_vms()]
 running_vms_enum = enum.Enum("RunningVMs", dict(running_vms))
 
 
+class OutputFormat(str, enum.Enum):
+    table = "table"
+    json = "json"
+    ndjson = "ndjson"
+
+
+class ProcessSort(str, enum.Enum):
+    cpu = "cpu"
+    rss = "rss"
+    io = "io"
+
+
+BenchTest = enum.Enum("BenchTest", {test: test for test in bench.TESTS}, type=str)
+DiskAllocation = enum.Enum("DiskAllocation", {mode: mode for mode in DISK_ALLOCATIONS}, type=str)
+DiskCache = enum.Enum("DiskCache", {mode: mode for mode in DISK_CACHE_MODES}, type=str)
+
+
+class AdmissionPolicy(str, enum.Enum):
+    warn = "warn"
+    reject = "reject"
+    queue = "queue"
+
+
+forward_app = typer.Typer(help="Forward host ports to services in a VM")
+app.add_typer(forward_app, name="forward")
+
+cache_proxy_app = typer.Typer(help="Host-side caching proxy for guest package installs")
+app.add_typer(cache_proxy_app, name="cache-proxy")
+
+idle_app = typer.Typer(help="Stop VMs automatically when nobody uses them")
+app.add_typer(idle_app, name="idle")
+
+bench_app = typer.Typer(help="Benchmark guest CPU, disk, network and mounts")
+app.add_typer(bench_app, name="bench")
+
+disk_app = typer.Typer(help="Attach extra data disks to a VM")
+app.add_typer(disk_app, name="disk")
+
+usage_app = typer.Typer(help="Sample VM resource usage for `recommend`")
+app.add_typer(usage_app, name="usage")
+
+
 @app.command(help="Create a new VM")
 def create(
         name="default",
@@ -28,13 +74,44 @@ def create(
         memory: int = 2048,
         cpus: int = 1,
         disk_size: int = 5000,
+        admission: AdmissionPolicy = typer.Option(
+            None, help="What to do when the host lacks capacity, overrides settings."),
+        resume: bool = typer.Option(
+            False, "--resume", help="Continue provisioning a VM whose create failed."),
 ):
-    VMManager(name).create(profile.value, cpus, memory, disk_size)
+    VMManager(name).create(profile.value, cpus, memory, disk_size,
+                           admission_policy=admission and admission.value, resume=resume)
+
+
+@app.command(help="Clone a stopped VM using copy-on-write disks")
+def clone(
+        source: vms_enum,
+        destination: str,
+        count: int = typer.Option(
+            1, help="Number of clones, named DESTINATION-1..DESTINATION-N when above 1."),
+):
+    Controller.clone_vm(source.value, destination, count)
+
+
+@app.command(help="Bring VMs in line with a fleet manifest")
+def apply(
+        file: str = typer.Option(..., "-f", "--file", help="Fleet manifest (YAML)."),
+        dry_run: bool = typer.Option(False, "--dry-run", help="Only show the plan."),
+        workers: int = typer.Option(8, help="Maximum actions running at once."),
+):
+    if not fleet.apply(file, dry_run=dry_run, workers=workers):
+        raise typer.Exit(1)
 
 
 @app.command(help="List all VMs")
-def ls():
-    Controller.get_all_vm_status()
+def ls(
+        output: OutputFormat = typer.Option(OutputFormat.table, "--output", "-o"),
+        live: bool = typer.Option(
+            False, "--live", help="Query running VMs for CPU, memory, disk and uptime."),
+        timeout: float = typer.Option(
+            None, "--timeout", help="Seconds to wait for running VMs with --live."),
+):
+    Controller.get_all_vm_status(output=output.value, live=live, timeout=timeout)
 
 
 @app.command(help="Stop a running VM")
@@ -46,18 +123,53 @@ def stop(
 
 
 @app.command(help="Start an already created VM")
-def start(name: vms_enum):
-    VMManager(name.value).start()
+def start(
+        name: vms_enum,
+        admission: AdmissionPolicy = typer.Option(
+            None, help="What to do when the host lacks capacity, overrides settings."),
+):
+    VMManager(name.value).start(admission_policy=admission and admission.value)
+
+
+@app.command(help="Show host CPU and memory headroom for VMs")
+def capacity():
+    Controller.print_capacity()
 
 
 @app.command(help="Get high level status of a running VM")
-def status(name: running_vms_enum):
-    VMManager(name.value).print_realtime_status()
+def status(
+        name: running_vms_enum,
+        output: OutputFormat = typer.Option(OutputFormat.table, "--output", "-o"),
+        fresh: bool = typer.Option(
+            False, "--fresh", help="Query the VM even if a recent snapshot exists."),
+):
+    VMManager(name.value).print_realtime_status(output=output.value, fresh=fresh)
+
 
+@app.command(help="Show the processes using the most CPU, memory or IO in a running VM")
+def ps(
+        name: running_vms_enum,
+        count: int = typer.Option(10, "--count", "-n", help="Number of processes to show."),
+        sort: ProcessSort = typer.Option(ProcessSort.cpu, "--sort"),
+        output: OutputFormat = typer.Option(OutputFormat.table, "--output", "-o"),
+):
+    VMManager(name.value).print_processes(count=count, sort=sort.value, output=output.value)
 
-@app.command(help="Update memory or CPU on a stopped VM")
-def update(name: vms_enum = "default", memory: int = None, cpus: int = None):
-    VMManager(name.value).update_resources(memory, cpus)
+
+@app.command(help="Update memory, CPU or disk size on a stopped VM, disks can only grow")
+def update(name: vms_enum = "default", memory: int = None, cpus: int = None,
+           disk_size: int = None):
+    VMManager(name.value).update_resources(memory, cpus, disk_size)
+
+
+@app.command(help="Recommend CPUs, memory and disk size for VMs from sampled usage")
+def recommend(
+        names: List[str] = typer.Argument(None, help="VMs to size, all of them by default."),
+        apply: bool = typer.Option(
+            False, "--apply", help="Update VMs with enough samples when they next stop."),
+        output: OutputFormat = typer.Option(OutputFormat.table, "--output", "-o"),
+):
+    usage.print_recommendations(names, apply, output.value)
 
 
 @app.command(help="Mount a local directory into the VM")
@@ -77,14 +189,289 @@ def shell(name: running_vms_enum, command: str = None):
     VMManager(name.value).shell(command)
 
 
+@app.command(name="run", help="Run a command in many running VMs at once, "
+                              "macos-virt run --vms 'web-*' -- uptime")
+def run_command(
+        command: List[str] = typer.Argument(..., help="The command and its arguments, after --."),
+        vms: List[str] = typer.Option(None, "--vms", help="VM name or glob, can be repeated."),
+        all_vms: bool = typer.Option(False, "--all", help="Every running VM."),
+        parallel: int = typer.Option(8, help="Maximum VMs running the command at once."),
+        timeout: int = typer.Option(300, help="Seconds before the command is killed in a VM."),
+        fail_fast: bool = typer.Option(
+            False, "--fail-fast", help="Cancel the remaining VMs after the first failure."),
+        output: OutputFormat = typer.Option(
+            OutputFormat.table, "--output", "-o",
+            help="table prefixes output lines with the VM, json reports it per VM."),
+):
+    if bool(vms) == all_vms:
+        raise typer.BadParameter("Pass either --vms or --all.")
+    names = fanout.select_vms(vms, all_vms)
+    if not fanout.run(names, command, parallel, timeout, fail_fast, output.value):
+        raise typer.Exit(1)
+
+
 @app.command(help="Copy a file to/from a running VM, macos-virt cp default vm:/etc/passwd")
 def cp(
         name: running_vms_enum,
         src,
         destination,
         recursive: bool = typer.Option(False, "--recursive"),
+        via_agent: bool = typer.Option(
+            False, "--via-agent",
+            help="Transfer over the VM agent's control channel instead of scp."),
+):
+    VMManager(name.value).cp(source=src, destination=destination,
+                             recursive=recursive, via_agent=via_agent)
+
+
+@app.command(help="Trim a running VM or reclaim zeroed space from a stopped VM's disks")
+def compact(
+        name: vms_enum,
+        zero_free: bool = typer.Option(
+            False, "--zero-free",
+            help="Zero the guest's free space first so the host can reclaim it."),
 ):
-    VMManager(name.value).cp(source=src, destination=destination, recursive=recursive)
+    VMManager(name.value).compact(zero_free=zero_free)
+
+
+@app.command(help="Export a stopped VM to a sparse, compressed archive")
+def export(
+        name: vms_enum,
+        destination,
+        dedupe_base: bool = typer.Option(
+            False, "--dedupe-base",
+            help="Leave out chunks the importer can take from its base image cache."),
+        level: int = typer.Option(6, help="zlib compression level."),
+        workers: int = typer.Option(None, help="Compression processes, defaults to CPU count."),
+):
+    VMManager(name.value).export(destination, dedupe_base=dedupe_base,
+                                 level=level, workers=workers)
+
+
+@app.command(name="import", help="Import a VM from an exported archive")
+def import_vm(source, name: str = typer.Option(None, help="Name for the imported VM.")):
+    Controller.import_vm(source, name)
+
+
+@forward_app.command("add", help="Forward a localhost port to a port in the VM")
+def forward_add(
+        name: vms_enum,
+        host_port: int,
+        guest_port: int = typer.Argument(None, help="Defaults to HOST_PORT."),
+        bind: str = typer.Option("127.0.0.1", help="Host address to listen on."),
+):
+    VMManager(name.value).add_forward(host_port, guest_port or host_port, bind)
+
+
+@forward_app.command("rm", help="Remove a port forward")
+def forward_rm(name: vms_enum, host_port: int):
+    VMManager(name.value).remove_forward(host_port)
+
+
+@forward_app.command("ls", help="List port forwards with connection and throughput stats")
+def forward_ls(name: vms_enum):
+    VMManager(name.value).list_forwards()
+
+
+@disk_app.command("add", help="Add a data disk to a stopped VM, mounted from its next boot")
+def disk_add(
+        name: vms_enum,
+        disk: str = typer.Argument(..., help="Disk name, also its filesystem label."),
+        size: int = typer.Option(10000, help="Size in MB, ignored with --from."),
+        allocation: DiskAllocation = typer.Option(
+            DiskAllocation.sparse, help="Preallocated disks reserve all of their space now."),
+        cache: DiskCache = typer.Option(DiskCache.automatic, help="Host caching of the disk."),
+        mount: str = typer.Option(None, help="Guest mount point, /mnt/DISK by default."),
+        source: str = typer.Option(None, "--from", help="Move in an existing disk image."),
+):
+    VMManager(name.value).add_disk(disk, size, allocation.value, cache.value, mount, source)
+
+
+@disk_app.command("rm", help="Remove a data disk from a stopped VM")
+def disk_rm(
+        name: vms_enum,
+        disk: str,
+        keep: str = typer.Option(None, help="Move the disk image here instead of deleting it."),
+):
+    VMManager(name.value).remove_disk(disk, keep)
+
+
+@disk_app.command("ls", help="List a VM's data disks")
+def disk_ls(
+        name: vms_enum,
+        output: OutputFormat = typer.Option(OutputFormat.table, "--output", "-o"),
+):
+    VMManager(name.value).list_disks(output.value)
+
+
+@bench_app.command("run", help="Run the benchmark suite in a running VM and store the results")
+def bench_run(
+        name: running_vms_enum,
+        test: List[BenchTest] = typer.Option(
+            None, "--test", help="Run only this test, can be repeated."),
+        seconds: int = typer.Option(5, help="Duration of each timed test."),
+        size_mb: int = typer.Option(256, "--size-mb", help="Data written by disk and mount tests."),
+        mount_path: str = typer.Option(
+            None, help="Guest directory for the mount test, the first sshfs mount by default."),
+        output: OutputFormat = typer.Option(OutputFormat.table, "--output", "-o"),
+):
+    tests = [item.value for item in test] if test else bench.TESTS
+    record = bench.run(name.value, tests, seconds, size_mb, mount_path)
+    bench.print_run(record, output.value)
+
+
+@bench_app.command("ls", help="List stored benchmark runs")
+def bench_ls(
+        name: str = typer.Argument(None, help="Only runs of this VM."),
+        output: OutputFormat = typer.Option(OutputFormat.table, "--output", "-o"),
+):
+    bench.print_runs(name, output.value)
+
+
+@bench_app.command("show", help="Show a stored run, VM/ID or a VM name for its latest")
+def bench_show(run: str, output: OutputFormat = typer.Option(OutputFormat.table, "--output", "-o")):
+    bench.print_run(bench.load_run(run), output.value)
+
+
+@bench_app.command("compare", help="Compare two runs, each VM/ID or a VM name for its latest")
+def bench_compare(
+        before: str,
+        after: str,
+        output: OutputFormat = typer.Option(OutputFormat.table, "--output", "-o"),
+):
+    bench.compare(before, after, output.value)
+
+
+@cache_proxy_app.command("start", help="Start the package cache, new VMs will use it")
+def cache_proxy_start():
+    pid = cache_proxy.start()
+    typer.echo(f"Package cache running (pid {pid}), guests use {cache_proxy.guest_proxy_url()}")
+
+
+@cache_proxy_app.command("stop", help="Stop the package cache")
+def cache_proxy_stop():
+    cache_proxy.stop()
+
+
+@cache_proxy_app.command("status", help="Show package cache size and hit rates")
+def cache_proxy_status():
+    state = cache_proxy.status()
+    tab = Table()
+    tab.add_column("Setting")
+    tab.add_column("Value")
+    tab.add_row("Running", str(state["running"]))
+    tab.add_row("Guest URL", state["url"])
+    tab.add_row("Size", f"{state['size'] // (1024 * 1024)}MB of "
+                        f"{state['max_size'] // (1024 * 1024)}MB")
+    for name, value in state["stats"].items():
+        tab.add_row(name.capitalize(), str(value))
+    Console().print(tab)
+
+
+@cache_proxy_app.command("clear", help="Remove all cached artifacts")
+def cache_proxy_clear():
+    cache_proxy.clear()
+
+
+@usage_app.command("start", help="Start the usage sampler in the background")
+def usage_start():
+    pid = usage.start()
+    typer.echo(f"Usage sampler running (pid {pid})")
+
+
+@usage_app.command("stop", help="Stop the usage sampler")
+def usage_stop():
+    usage.stop()
+
+
+@usage_app.command("run", help="Run the usage sampler in the foreground")
+def usage_run(once: bool = typer.Option(False, "--once", help="Sample every VM once and exit.")):
+    sampler = usage.UsageSampler()
+    if once:
+        sampler.run_once()
+    else:
+        sampler.run()
+
+
+@idle_app.command("start", help="Start the idle monitor in the background")
+def idle_start():
+    pid = idle.start()
+    typer.echo(f"Idle monitor running (pid {pid})")
+
+
+@idle_app.command("stop", help="Stop the idle monitor")
+def idle_stop():
+    idle.stop()
+
+
+@idle_app.command("run", help="Run the idle monitor in the foreground")
+def idle_run(once: bool = typer.Option(False, "--once", help="Sample every VM once and exit.")):
+    monitor = idle.IdleMonitor()
+    if once:
+        monitor.run_once()
+    else:
+        monitor.run()
+
+
+@idle_app.command("status", help="Show how long each VM has been idle")
+def idle_status(output: OutputFormat = typer.Option(OutputFormat.table, "--output", "-o")):
+    state = idle.status()
+    if output != OutputFormat.table:
+        print_records(state, output.value)
+        return
+    Console().print(f"Idle monitor {'running' if state['running'] else 'not running'}, "
+                    f"sampling every {state['interval']}s")
+    tab = Table()
+    tab.add_column("VM")
+    tab.add_column("Stopped after")
+    tab.add_column("Idle for", justify="right")
+    tab.add_column("CPU %", justify="right")
+    tab.add_column("SSH", justify="right")
+    tab.add_column("Users", justify="right")
+    for vm in state["vms"]:
+        sample = vm["last_sample"] or {}
+        tab.add_row(
+            vm["name"],
+            "never" if vm["idle_minutes"] is None else f"{vm['idle_minutes']}m idle",
+            "" if vm["idle_seconds"] is None else f"{vm['idle_seconds'] // 60}m",
+            str(sample.get("cpu_usage", "")),
+            str(sample.get("ssh_sessions", "")),
+            str(sample.get("users", "")),
+        )
+    Console().print(tab)
+
+
+@idle_app.command("set", help="Change how long a VM may be idle, or opt it out")
+def idle_set(
+        name: vms_enum,
+        minutes: float = typer.Option(None, help="Idle minutes before the VM is stopped."),
+        never: bool = typer.Option(False, "--never", help="Never stop this VM."),
+):
+    VMManager(name.value).set_idle_policy(minutes, never)
+
+
+@idle_app.command("log", help="Show recent samples and stops from the activity log")
+def idle_log(
+        name: str = typer.Argument(None, help="Only entries for this VM."),
+        lines: int = typer.Option(20, "--lines", "-n"),
+        output: OutputFormat = typer.Option(OutputFormat.table, "--output", "-o"),
+):
+    entries = idle.read_log(name, lines)
+    if output != OutputFormat.table:
+        print_records(entries, output.value)
+        return
+    tab = Table()
+    tab.add_column("Time")
+    tab.add_column("VM")
+    tab.add_column("Event")
+    tab.add_column("Details")
+    for entry in entries:
+        details = {key: value for key, value in entry.items()
+                   if key not in ("time", "vm", "event") and value not in (None, [])}
+        tab.add_row(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(entry["time"])),
+                    entry["vm"], entry["event"],
+                    ", ".join(f"{key}={value}" for key, value in details.items()))
+    Console().print(tab)
 
 
 @app.command(help="Delete a stopped VM")
@@ -100,13 +487,17 @@ def version():
 
 
 @app.command(help="Describe profiles that are available")
-def profiles():
+def profiles(output: OutputFormat = typer.Option(OutputFormat.table, "--output", "-o")):
+    if output != OutputFormat.table:
+        print_records([{"name": name, "description": description}
+                       for name, description in registry.describe()], output.value)
+        return
     console = Console()
     tab = Table()
     tab.add_column("Profile name")
     tab.add_column("Description")
-    for name, profile in registry.profiles.items():
-        tab.add_row(name, profile.description)
+    for name, description in registry.describe():
+        tab.add_row(name, description)
     console.print(tab)
 
 
@@ -1,9 +1,11 @@
+import hashlib
 import xdg
 import os
 import platform
 import pathlib
 
 from macos_virt.constants import KERNAL_FILENAME, INITRD_FILENAME, DISK_FILENAME
+from macos_virt.locking import download_lock
 from .downloader import download
 
 base_path = os.path.join(xdg.xdg_config_home(), "macos-virt/base-files/")
@@ -14,8 +16,14 @@ else:
     PLATFORM = "arm64"
 
 
+class ChecksumMismatch(Exception):
+    pass
+
+
 class BaseProfile:
     name = None
+    # Optional sha256 of the kernel, initrd and disk_image downloads.
+    checksums = {}
 
     @classmethod
     def profile_directory(cls):
@@ -51,6 +59,12 @@ class BaseProfile:
 
     @classmethod
     def download_required_files(cls):
+        # One download per profile, others wait for it and find the files.
+        with download_lock(cls.name):
+            cls.download_required_files_locked()
+
+    @classmethod
+    def download_required_files_locked(cls):
         cache_directory = cls.profile_directory()
         if not cls.required_files_exist():
             kernel_url = cls.get_kernel_url()
@@ -70,6 +84,11 @@ class BaseProfile:
                     {"from": disk_url, "to": tmp_disk_filename},
                 ]
             )
+            cls.verify_checksums({
+                "kernel": tmp_kernel_filename,
+                "initrd": tmp_initrd_filename,
+                "disk_image": tmp_disk_filename,
+            })
             os.rename(
                 tmp_kernel_filename, os.path.join(cache_directory, KERNAL_FILENAME)
             )
@@ -79,6 +98,22 @@ class BaseProfile:
             os.rename(tmp_disk_filename, os.path.join(cache_directory, DISK_FILENAME))
             cls.process_downloaded_files(cache_directory)
 
+    @classmethod
+    def verify_checksums(cls, files):
+        for key, path in files.items():
+            expected = cls.checksums.get(key)
+            if not expected:
+                continue
+            digest = hashlib.sha256()
+            with open(path, "rb") as f:
+                for block in iter(lambda: f.read(1024 * 1024), b""):
+                    digest.update(block)
+            if digest.hexdigest() != expected.lower():
+                for tmp_path in files.values():
+                    os.unlink(tmp_path)
+                raise ChecksumMismatch(
+                    f"{cls.name}: {key} download does not match its sha256 checksum")
+
     @classmethod
     def get_kernel_url(cls):
         raise NotImplementedError()
@@ -92,8 +127,35 @@ class BaseProfile:
         raise NotImplementedError()
 
     @classmethod
-    def render_cloudinit_data(cls, username, ssh_key):
+    def render_cloudinit_data(cls, username, ssh_key, package_proxy=None):
         raise NotImplementedError()
 
+    @classmethod
+    def render_data_disks(cls, template, disks):
+        """Format blank data disks and mount them by label on first boot.
+
+        Data disks are attached after the root and boot disks, so the
+        first is /dev/vdc. Disks that already have a filesystem are kept.
+        """
+        for index, disk in enumerate(disks):
+            template.setdefault("fs_setup", []).append({
+                "label": disk["name"],
+                "filesystem": "ext4",
+                "device": f"/dev/vd{chr(ord('c') + index)}",
+                "overwrite": False,
+            })
+            template.setdefault("mounts", []).append(
+                [f"LABEL={disk['name']}", disk["mount"], "ext4", "defaults,nofail", "0", "2"])
+        return template
+
+    @classmethod
+    def render_clone_cloudinit_data(cls, username, ssh_key, package_proxy=None):
+        # A clone's disk is already provisioned, a new instance-id only needs
+        # cloud-init to re-key the host and refresh users and files.
+        template = cls.render_cloudinit_data(username, ssh_key, package_proxy)
+        for key in ("package_update", "package_upgrade", "packages", "runcmd"):
+            template.pop(key, None)
+        return template
+
     def get_boot_files_from_filesystem(self, filesystem):
         pass
@@ -1,25 +1,192 @@
-from macos_virt.profiles import BaseProfile
-from macos_virt.profiles.ubuntu import Ubuntu2004, Ubuntu2104, Ubuntu2110, Ubuntu2004K3S, Ubuntu2204, Ubuntu2204K3S
+import hashlib
+import importlib
+import json
+import os
+import sys
+
+import xdg
+import yaml
+
+from macos_virt.profiles import BaseProfile, PLATFORM
+
+# Profiles shipped with macos-virt. Others come from packages declaring
+# entry points in ENTRY_POINT_GROUP, or from declarative files in
+# DROP_IN_PATH.
+BUILTIN_PROFILES = {
+    "ubuntu-20.04": "macos_virt.profiles.ubuntu:Ubuntu2004",
+    "ubuntu-21.04": "macos_virt.profiles.ubuntu:Ubuntu2104",
+    "ubuntu-21.10": "macos_virt.profiles.ubuntu:Ubuntu2110",
+    "ubuntu-20.04-k3s": "macos_virt.profiles.ubuntu:Ubuntu2004K3S",
+    "ubuntu-22.04": "macos_virt.profiles.ubuntu:Ubuntu2204",
+    "ubuntu-22.04-k3s": "macos_virt.profiles.ubuntu:Ubuntu2204K3S",
+}
+ENTRY_POINT_GROUP = "macos_virt.profiles"
+DROP_IN_PATH = os.path.join(xdg.xdg_config_home(), "macos-virt/profiles.d")
+CACHE_PATH = os.path.join(xdg.xdg_config_home(), "macos-virt/profile-cache.json")
+CACHE_VERSION = 1
+
+DECLARATIVE_DEFAULTS = {
+    "base": "ubuntu-20.04",
+    "description": "",
+    "checksums": {},
+    "boot_files": {"kernel": "vmlinuz", "initrd": "initrd.img"},
+}
+
+
+def load_object(target):
+    module, _, attribute = target.partition(":")
+    return getattr(importlib.import_module(module), attribute)
+
+
+def entry_point_targets():
+    from importlib.metadata import entry_points
+    found = entry_points()
+    if hasattr(found, "select"):
+        found = found.select(group=ENTRY_POINT_GROUP)
+    else:
+        found = found.get(ENTRY_POINT_GROUP, [])
+    return {entry_point.name: entry_point.value for entry_point in found}
+
+
+def drop_in_files():
+    try:
+        return sorted(entry.path for entry in os.scandir(DROP_IN_PATH)
+                      if entry.name.endswith((".yaml", ".yml")))
+    except FileNotFoundError:
+        return []
+
+
+def fingerprint():
+    """Changes whenever discovery could find something different.
+
+    Installing or removing a package changes the mtime of its sys.path
+    directory, editing a drop-in file changes the file's.
+    """
+    parts = [str(CACHE_VERSION), PLATFORM]
+    builtin_directory = os.path.dirname(os.path.abspath(__file__))
+    for path in sys.path + [builtin_directory, DROP_IN_PATH] + drop_in_files():
+        try:
+            parts.append(f"{path}:{os.stat(path or '.').st_mtime_ns}")
+        except OSError:
+            continue
+    return hashlib.sha256("\n".join(parts).encode()).hexdigest()
+
+
+def substitute(value):
+    return value.replace("{platform}", PLATFORM) if isinstance(value, str) else value
+
+
+def profile_from_file(path, base):
+    """Build a profile class from a declarative profile file.
+
+    Behaviour not covered by the file, like how cloud-init is rendered,
+    comes from the `base` profile.
+    """
+    data = dict(DECLARATIVE_DEFAULTS, **yaml.safe_load(open(path)))
+    urls = {key: substitute(data[key])
+            for key in ("kernel_url", "initrd_url", "disk_image_url")}
+    boot_files = (data["boot_files"]["kernel"], data["boot_files"]["initrd"])
+    attributes = {
+        "name": data["name"],
+        "description": data["description"],
+        "checksums": data["checksums"],
+        "get_kernel_url": classmethod(lambda cls: urls["kernel_url"]),
+        "get_initrd_url": classmethod(lambda cls: urls["initrd_url"]),
+        "get_disk_image_url": classmethod(lambda cls: urls["disk_image_url"]),
+        "get_boot_files_from_filesystem": classmethod(lambda cls, mountpoint: boot_files),
+    }
+    if "cloudinit_file" in data:
+        attributes["cloudinit_file"] = os.path.join(
+            os.path.dirname(os.path.abspath(path)), data["cloudinit_file"])
+    if "extracted_name" in data:
+        attributes["extracted_name"] = substitute(data["extracted_name"])
+    else:
+        # Without a tarball member to extract, the disk image is used as downloaded.
+        attributes["process_downloaded_files"] = classmethod(lambda cls, directory: None)
+    return type(f"DeclarativeProfile[{data['name']}]", (base,), attributes)
 
 
 class Registry:
-    profiles = {}
+    """Profiles by name, discovered without importing them.
+
+    Discovery results are cached in CACHE_PATH, so listing profiles reads
+    one file. A profile's code is only imported when it is used.
+    """
+
+    def __init__(self):
+        self.loaded = {}
+        self.metadata = None
 
     def add_profile(self, profile: BaseProfile):
-        self.profiles[profile.name] = profile
+        self.loaded[profile.name] = profile
+        if self.metadata is not None:
+            self.metadata[profile.name] = {"description": profile.description,
+                                           "source": "code"}
+
+    def discover(self):
+        metadata = {}
+        targets = dict(BUILTIN_PROFILES)
+        targets.update(entry_point_targets())
+        for name, target in targets.items():
+            try:
+                description = load_object(target).description
+            except Exception as e:
+                print(f"Ignoring profile {name}, {target} can't be loaded: {e}",
+                      file=sys.stderr)
+                continue
+            metadata[name] = {"description": description, "source": "entry_point",
+                              "target": target}
+        for path in drop_in_files():
+            try:
+                data = yaml.safe_load(open(path))
+                metadata[data["name"]] = {
+                    "description": data.get("description", ""),
+                    "source": "file",
+                    "path": path,
+                }
+            except (OSError, KeyError, TypeError, yaml.YAMLError) as e:
+                print(f"Ignoring profile file {path}: {e}", file=sys.stderr)
+        return metadata
+
+    def get_metadata(self):
+        if self.metadata is None:
+            current = fingerprint()
+            try:
+                cache = json.load(open(CACHE_PATH))
+                if cache["fingerprint"] == current:
+                    self.metadata = cache["profiles"]
+            except (OSError, ValueError, KeyError):
+                pass
+            if self.metadata is None:
+                self.metadata = self.discover()
+                os.makedirs(os.path.dirname(CACHE_PATH), exist_ok=True)
+                with open(CACHE_PATH + ".tmp", "w") as f:
+                    json.dump({"fingerprint": current, "profiles": self.metadata}, f)
+                os.replace(CACHE_PATH + ".tmp", CACHE_PATH)
+            for name, profile in self.loaded.items():
+                self.metadata.setdefault(name, {"description": profile.description,
+                                                "source": "code"})
+        return self.metadata
 
     def get_profiles(self):
-        return list(self.profiles.keys())
+        return list(self.get_metadata().keys())
+
+    def describe(self):
+        return [(name, entry["description"]) for name, entry in self.get_metadata().items()]
+
+    def __contains__(self, name):
+        return name in self.get_metadata()
 
     def get_profile(self, name) -> BaseProfile:
-        return self.profiles[name]
+        if name not in self.loaded:
+            entry = self.get_metadata()[name]
+            if entry["source"] == "file":
+                with open(entry["path"]) as f:
+                    base = yaml.safe_load(f).get("base", DECLARATIVE_DEFAULTS["base"])
+                self.loaded[name] = profile_from_file(entry["path"], self.get_profile(base))
+            else:
+                self.loaded[name] = load_object(entry["target"])
+        return self.loaded[name]
 
 
 registry = Registry()
-
-registry.add_profile(Ubuntu2004)
-registry.add_profile(Ubuntu2104)
-registry.add_profile(Ubuntu2110)
-registry.add_profile(Ubuntu2004K3S)
-registry.add_profile(Ubuntu2204)
-registry.add_profile(Ubuntu2204K3S)
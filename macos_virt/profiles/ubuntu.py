@@ -61,11 +61,13 @@ class Ubuntu2004(BaseProfile):
         )
 
     @classmethod
-    def render_cloudinit_data(cls, username, ssh_key):
+    def render_cloudinit_data(cls, username, ssh_key, package_proxy=None):
         template = yaml.safe_load(open(os.path.join(PATH, cls.cloudinit_file), "rb"))
         template["users"][1]["gecos"] = username
         template["users"][1]["name"] = username
         template["users"][1]["ssh-authorized-keys"][0] = ssh_key
+        if package_proxy:
+            template["apt"] = {"proxy": package_proxy}
         if "write_files" in template:
             write_files = template["write_files"]
         else:
@@ -85,6 +87,12 @@ class Ubuntu2004(BaseProfile):
                 "path": "/usr/sbin/macos-virt-service.py",
             }
         )
+        write_files.append(
+            {
+                "content": open(os.path.join(PATH, "../service/protocol.py")).read(),
+                "path": "/usr/sbin/macos_virt_protocol.py",
+            }
+        )
         write_files.append(
             {
                 "content": open(
@@ -97,15 +105,33 @@ class Ubuntu2004(BaseProfile):
         return template
 
 
+K3S_VERSION = "v1.23.5+k3s1"
+K3S_BINARY = "k3s-arm64" if PLATFORM == "arm64" else "k3s"
+
+
 class K3sMixin:
-    k3s_installer = """
+    k3s_installer = f"""
         #!/bin/sh
         systemctl stop unattended-upgrades
         add-apt-repository -y ppa:canonical-server/server-backports
         apt-get update
         apt-get install -y docker.io qemu binfmt-support qemu-user-static
         systemctl start unattended-upgrades
-        curl -sfL https://get.k3s.io | sudo INSTALL_K3S_VERSION=v1.23.5+k3s1 INSTALL_K3S_EXEC="--write-kubeconfig-mode 644" sh -
+        curl -sfL https://get.k3s.io | sudo INSTALL_K3S_VERSION={K3S_VERSION} INSTALL_K3S_EXEC="--write-kubeconfig-mode 644" sh -
+      """
+
+    # Fetches the installer and binary through the host's package cache.
+    k3s_cached_installer = f"""
+        #!/bin/sh
+        systemctl stop unattended-upgrades
+        add-apt-repository -y ppa:canonical-server/server-backports
+        apt-get update
+        apt-get install -y docker.io qemu binfmt-support qemu-user-static
+        systemctl start unattended-upgrades
+        curl -sfL {{proxy}}/k3s/install.sh -o /root/k3s-install.sh
+        curl -sfL {{proxy}}/k3s/{K3S_VERSION}/{K3S_BINARY} -o /usr/local/bin/k3s
+        chmod +x /usr/local/bin/k3s
+        INSTALL_K3S_SKIP_DOWNLOAD=true INSTALL_K3S_VERSION={K3S_VERSION} INSTALL_K3S_EXEC="--write-kubeconfig-mode 644" sh /root/k3s-install.sh
       """
 
     @classmethod
@@ -128,10 +154,14 @@ class K3sMixin:
         console.print(f"export KUBECONFIG={k3s_path}")
 
     @classmethod
-    def render_cloudinit_data(cls, username, ssh_key):
-        template = Ubuntu2004.render_cloudinit_data(username, ssh_key)
+    def render_cloudinit_data(cls, username, ssh_key, package_proxy=None):
+        template = Ubuntu2004.render_cloudinit_data(username, ssh_key, package_proxy)
         write_files = template.get("write_files", [])
-        write_files.append({"content": cls.k3s_installer, "path": "/root/k3s-init.sh"})
+        if package_proxy:
+            installer = cls.k3s_cached_installer.replace("{proxy}", package_proxy)
+        else:
+            installer = cls.k3s_installer
+        write_files.append({"content": installer, "path": "/root/k3s-init.sh"})
         write_files.append(
             {
                 "content": open(
@@ -0,0 +1,150 @@
+import contextlib
+import os
+import pathlib
+import shlex
+import subprocess
+import sys
+import tempfile
+from subprocess import check_output
+
+import xdg
+
+from macos_virt.settings import get_settings
+
+MODULE_PATH = os.path.dirname(__file__)
+
+RUNNER_PATH = os.path.join(MODULE_PATH, "macos_virt_runner/macos_virt_runner")
+RUNNER_PATH_ENTITLEMENTS = os.path.join(
+    MODULE_PATH, "macos_virt_runner/" "macos_virt_runner.entitlements"
+)
+
+DEFAULTS = {
+    # macos runs VMs with Virtualization.Framework, simulator fakes them.
+    "backend": "macos",
+}
+
+SIMULATOR_FILES_PATH = os.path.join(xdg.xdg_config_home(), "macos-virt/simulator")
+SIMULATOR_DISK_SIZE = 64 * 1024 * 1024
+
+
+class MacOSRunner:
+    """Boots VMs with the bundled Virtualization.Framework runner."""
+
+    name = "macos"
+
+    def prepare(self):
+        check_output(
+            [
+                "codesign",
+                "-f",
+                "-s",
+                "-",
+                "--entitlements",
+                RUNNER_PATH_ENTITLEMENTS,
+                RUNNER_PATH,
+            ]
+        )
+
+    def launch(self, arguments, vm_directory):
+        return subprocess.Popen([RUNNER_PATH] + arguments, cwd=vm_directory)
+
+    def profile_files(self, profile):
+        return profile.file_locations()
+
+    def has_profile_files(self, profile):
+        return profile.required_files_exist()
+
+    @contextlib.contextmanager
+    def boot_files(self, boot_disk, profile):
+        """Yield the kernel and initrd installed on a VM's boot disk."""
+        mountpoint = subprocess.check_output(
+            ["hdiutil", "attach", "-readonly", "-imagekey", "diskimage-class=CRawDiskImage",
+             boot_disk]).decode().split()[1]
+        try:
+            kernel_path, initrd_path = profile.get_boot_files_from_filesystem(mountpoint)
+            with tempfile.NamedTemporaryFile(delete=True) as kernel:
+                kernel.write(open(os.path.join(mountpoint, kernel_path), "rb").read())
+                with tempfile.NamedTemporaryFile(delete=True) as initrd:
+                    initrd.write(open(os.path.join(mountpoint, initrd_path), "rb").read())
+                    subprocess.check_output(["hdiutil", "detach", mountpoint])
+                    mountpoint = None
+                    yield kernel_path, initrd_path, kernel.name, initrd.name
+        finally:
+            if mountpoint:
+                subprocess.run(["hdiutil", "detach", mountpoint])
+
+    def guest_address(self, ip_address):
+        return ip_address
+
+    def remote_command(self, ssh_arguments, command, vm_directory):
+        return ssh_arguments + [command]
+
+    def attach_console(self, name, vm_directory):
+        subprocess.run(
+            f"/usr/bin/screen -dm -S console-{name} {vm_directory}/console",
+            shell=True,
+        )
+
+
+class SimulatedRunner:
+    """Runs `macos_virt.simulator` in place of the runner, on any platform.
+
+    The simulator takes the runner's arguments and runs the real guest agent
+    on the control pty, so everything above the runner can be exercised and
+    benchmarked without macOS.
+    """
+
+    name = "simulator"
+
+    def prepare(self):
+        pass
+
+    def launch(self, arguments, vm_directory):
+        return subprocess.Popen(
+            [sys.executable, "-m", "macos_virt.simulator"] + arguments,
+            cwd=vm_directory,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=open(os.path.join(vm_directory, "simulator.log"), "a"),
+            start_new_session=True,
+        )
+
+    def profile_files(self, profile):
+        directory = os.path.join(SIMULATOR_FILES_PATH, profile.name)
+        pathlib.Path(directory).mkdir(parents=True, exist_ok=True)
+        paths = [os.path.join(directory, name) for name in ("kernel", "initrd", "disk.img")]
+        for path in paths:
+            if not os.path.exists(path):
+                with open(path, "wb") as f:
+                    if path.endswith("disk.img"):
+                        f.truncate(SIMULATOR_DISK_SIZE)
+        return tuple(paths)
+
+    def has_profile_files(self, profile):
+        directory = os.path.join(SIMULATOR_FILES_PATH, profile.name)
+        return all(os.path.exists(os.path.join(directory, name))
+                   for name in ("kernel", "initrd", "disk.img"))
+
+    @contextlib.contextmanager
+    def boot_files(self, boot_disk, profile):
+        kernel, initrd, _ = self.profile_files(profile)
+        yield "vmlinuz", "initrd.img", kernel, initrd
+
+    def guest_address(self, ip_address):
+        # The simulated guest's sockets are on this machine, not at its fake address.
+        return "127.0.0.1"
+
+    def remote_command(self, ssh_arguments, command, vm_directory):
+        # There is no sshd in the simulated guest, commands run in its directory.
+        return ["/bin/sh", "-c", f"cd {shlex.quote(vm_directory)} && {command}"]
+
+    def attach_console(self, name, vm_directory):
+        pass
+
+
+RUNNERS = {runner.name: runner for runner in (MacOSRunner, SimulatedRunner)}
+
+
+def get_runner():
+    backend = os.environ.get("MACOS_VIRT_RUNNER") or get_settings("runner", DEFAULTS)["backend"]
+    return RUNNERS[backend]()
@@ -0,0 +1,247 @@
+"""Framing for the host <-> guest control channel.
+
+The channel started out as one JSON document per line. Frames are length
+prefixed instead, so a stray newline or a partial read can't desynchronize
+the two sides, and can carry several messages in one write:
+
+    magic (1) | version (1) | flags (1) | payload length (4, big endian) | payload
+
+A frame starts with MAGIC, which is never the first byte of a JSON line, so
+both kinds can share the channel. Peers only send frames after finding out,
+over JSON, that the other side understands them.
+
+This module is copied into the guest next to the agent, it must only use
+the standard library.
+"""
+import json
+import struct
+import zlib
+
+MAGIC = 0xA5
+VERSION = 1
+VERSIONS = [VERSION]
+
+HEADER = struct.Struct(">BBBI")
+
+# Payload encodings, the low nibble of the flags.
+ENCODING_JSON = 0x00
+ENCODING_BINARY = 0x01
+ENCODING_MASK = 0x0F
+FLAG_ZLIB = 0x10
+FLAG_BATCH = 0x20
+
+COMPRESS_THRESHOLD = 4096
+MAX_PAYLOAD = 64 * 1024 * 1024
+
+
+class ProtocolError(Exception):
+    pass
+
+
+# Compact binary encoding of JSON like values plus bytes, which JSON can
+# only carry as base64.
+_INT = struct.Struct(">q")
+_FLOAT = struct.Struct(">d")
+_LENGTH = struct.Struct(">I")
+
+
+def _encode(value, out):
+    if value is None:
+        out += b"N"
+    elif value is True:
+        out += b"T"
+    elif value is False:
+        out += b"F"
+    elif isinstance(value, int):
+        out += b"i"
+        out += _INT.pack(value)
+    elif isinstance(value, float):
+        out += b"d"
+        out += _FLOAT.pack(value)
+    elif isinstance(value, str):
+        data = value.encode()
+        out += b"s"
+        out += _LENGTH.pack(len(data))
+        out += data
+    elif isinstance(value, (bytes, bytearray)):
+        out += b"b"
+        out += _LENGTH.pack(len(value))
+        out += value
+    elif isinstance(value, (list, tuple)):
+        out += b"l"
+        out += _LENGTH.pack(len(value))
+        for item in value:
+            _encode(item, out)
+    elif isinstance(value, dict):
+        out += b"m"
+        out += _LENGTH.pack(len(value))
+        for key, item in value.items():
+            _encode(key, out)
+            _encode(item, out)
+    else:
+        raise ProtocolError(f"Can't encode {type(value).__name__}")
+
+
+def _decode(data, offset):
+    tag = data[offset:offset + 1]
+    offset += 1
+    if tag == b"N":
+        return None, offset
+    if tag == b"T":
+        return True, offset
+    if tag == b"F":
+        return False, offset
+    if tag == b"i":
+        return _INT.unpack_from(data, offset)[0], offset + _INT.size
+    if tag == b"d":
+        return _FLOAT.unpack_from(data, offset)[0], offset + _FLOAT.size
+    if tag in (b"s", b"b", b"l", b"m"):
+        length = _LENGTH.unpack_from(data, offset)[0]
+        offset += _LENGTH.size
+        if tag == b"s":
+            return bytes(data[offset:offset + length]).decode(), offset + length
+        if tag == b"b":
+            return bytes(data[offset:offset + length]), offset + length
+        if tag == b"l":
+            items = []
+            for _ in range(length):
+                item, offset = _decode(data, offset)
+                items.append(item)
+            return items, offset
+        mapping = {}
+        for _ in range(length):
+            key, offset = _decode(data, offset)
+            mapping[key], offset = _decode(data, offset)
+        return mapping, offset
+    raise ProtocolError(f"Unknown tag {tag!r}")
+
+
+def encode_binary(value):
+    out = bytearray()
+    _encode(value, out)
+    return bytes(out)
+
+
+def decode_binary(data):
+    value, offset = _decode(memoryview(data), 0)
+    if offset != len(data):
+        raise ProtocolError("Trailing data after binary payload")
+    return value
+
+
+def has_bytes(message):
+    return any(isinstance(value, (bytes, bytearray)) for value in message.values())
+
+
+def encode_frame(messages, encoding=None, batch=None):
+    """Encode one message, or a list of them as a batch, into a frame.
+
+    Without an explicit encoding, binary is used when a message carries
+    bytes and JSON otherwise, CPython's JSON encoder being the faster one.
+    """
+    if batch is None:
+        batch = isinstance(messages, list)
+    if encoding is None:
+        items = messages if batch else [messages]
+        encoding = ENCODING_BINARY if any(has_bytes(m) for m in items) else ENCODING_JSON
+    if encoding == ENCODING_BINARY:
+        payload = encode_binary(messages)
+    else:
+        payload = json.dumps(messages, separators=(",", ":")).encode()
+    flags = encoding
+    if batch:
+        flags |= FLAG_BATCH
+    # Bytes values are file data, already compressed where worthwhile by the
+    # sender, running zlib over them again only costs time.
+    if encoding == ENCODING_JSON and len(payload) >= COMPRESS_THRESHOLD:
+        compressed = zlib.compress(payload, 1)
+        if len(compressed) < len(payload):
+            payload = compressed
+            flags |= FLAG_ZLIB
+    return HEADER.pack(MAGIC, VERSION, flags, len(payload)) + payload
+
+
+def decode_payload(flags, payload):
+    if flags & FLAG_ZLIB:
+        payload = zlib.decompress(payload)
+    encoding = flags & ENCODING_MASK
+    if encoding == ENCODING_BINARY:
+        decoded = decode_binary(payload)
+    elif encoding == ENCODING_JSON:
+        decoded = json.loads(payload)
+    else:
+        raise ProtocolError(f"Unknown encoding {encoding}")
+    return decoded if flags & FLAG_BATCH else [decoded]
+
+
+def read_exactly(port, length):
+    data = b""
+    while len(data) < length:
+        block = port.read(length - len(data))
+        if not block:
+            raise ProtocolError("Channel closed or timed out mid frame")
+        data += block
+    return data
+
+
+def read_messages(port):
+    """Read the next frame or JSON line from `port`.
+
+    Returns the messages it held and whether it was a frame, so replies
+    can be sent the same way. Returns ([], False) when the port times out
+    or reaches EOF between messages.
+    """
+    while True:
+        first = port.read(1)
+        if not first:
+            return [], False
+        if first[0] == MAGIC:
+            _, version, flags, length = HEADER.unpack(
+                first + read_exactly(port, HEADER.size - 1))
+            if version not in VERSIONS:
+                raise ProtocolError(f"Unsupported frame version {version}")
+            if length > MAX_PAYLOAD:
+                raise ProtocolError(f"Frame of {length} bytes is too large")
+            return decode_payload(flags, read_exactly(port, length)), True
+        if first in (b"\r", b"\n"):
+            # Left over from a JSON line terminator.
+            continue
+        line = first + port.readline()
+        try:
+            return [json.loads(line)], False
+        except ValueError:
+            # Line noise, resynchronize on the next message.
+            continue
+
+
+class Channel:
+    """Message oriented wrapper over a port, sending frames once negotiated."""
+
+    def __init__(self, port, framed=False):
+        self.port = port
+        self.framed = framed
+        self.queue = []
+
+    def send(self, message):
+        if self.framed:
+            self.port.write(encode_frame(message))
+        else:
+            self.port.write((json.dumps(message) + "\r\n").encode())
+
+    def send_batch(self, messages):
+        """Send several messages in a single write."""
+        if not messages:
+            return
+        if self.framed:
+            self.port.write(encode_frame(list(messages)))
+        else:
+            self.port.write(b"".join(
+                (json.dumps(message) + "\r\n").encode() for message in messages))
+
+    def receive(self):
+        """Return the next message, or None when the port times out."""
+        if not self.queue:
+            self.queue, _ = read_messages(self.port)
+        if not self.queue:
+            return None
+        return self.queue.pop(0)
@@ -1,57 +1,727 @@
+import base64
+import calendar
+import hashlib
 import json
+import mmap
 import os
+import random
+import re
+import socket
+import stat
 import subprocess
+import threading
+import uuid
+import zlib
 
 import psutil
 import serial
 import time
 
-ser = serial.Serial("/dev/hvc1")
+try:
+    from macos_virt.service import protocol
+except ImportError:
+    # In the guest the protocol module is installed next to this script.
+    import macos_virt_protocol as protocol
+
+AGENT_VERSION = 2
+CAPABILITIES = ["file_transfer", "fstrim", "status_fields", "framing", "top", "bench", "disks"]
+
+# Identifies this agent process, a `since` from a previous one is meaningless.
+SESSION = uuid.uuid4().hex
+
+ser = None
+# Data disks' mount points and fstab live under this, the simulator moves it.
+ROOT = "/"
+# Replies go back the way the request came, as a frame or a JSON line, and
+# replies to a batch are collected and sent as one.
+reply_framed = False
+reply_batch = None
 
 
 def send_json_message(message):
-    dumped = json.dumps(message)
-    ser.write((dumped + "\r\n").encode())
-
-
-def send_status():
-    output = {
-        "cpu_count": psutil.cpu_count(),
-        "cpu_usage": psutil.cpu_percent(),
-        "root_fs_usage": psutil.disk_usage("/").percent,
-        "mounts": open("/proc/mounts").read(),
-        "status": "running",
-        "uptime": int(time.time() - psutil.boot_time()),
-        "processes": len(psutil.pids()),
-        "network_addresses": [
-            [x.address, x.netmask]
-            for x in psutil.net_if_addrs()["enp0s1"]
-            if x.family.name == "AF_INET"
-        ],
-        "memory_usage": psutil.virtual_memory().percent,
-    }
+    if reply_batch is not None:
+        reply_batch.append(message)
+    elif reply_framed:
+        ser.write(protocol.encode_frame(message))
+    else:
+        dumped = json.dumps(message)
+        ser.write((dumped + "\r\n").encode())
+
+
+def network_addresses():
+    return [
+        [x.address, x.netmask]
+        for x in psutil.net_if_addrs().get("enp0s1", [])
+        if x.family.name == "AF_INET"
+    ]
+
+
+def sshfs_mounts():
+    mounts = []
+    for line in open("/proc/mounts"):
+        fields = line.split(" ")
+        if fields[2] == "fuse.sshfs":
+            mounts.append(fields[1])
+    return mounts
+
+
+def network_bytes():
+    counters = psutil.net_io_counters(pernic=True)
+    return sum(counter.bytes_sent + counter.bytes_recv
+               for name, counter in counters.items() if name != "lo")
+
+
+def ssh_sessions():
+    return len([connection for connection in psutil.net_connections(kind="tcp")
+                if connection.laddr and connection.laddr.port == 22
+                and connection.status == psutil.CONN_ESTABLISHED])
+
+
+STATUS_FIELDS = {
+    "cpu_count": psutil.cpu_count,
+    "cpu_usage": psutil.cpu_percent,
+    "root_fs_usage": lambda: psutil.disk_usage("/").percent,
+    "uptime": lambda: int(time.time() - psutil.boot_time()),
+    "processes": lambda: len(psutil.pids()),
+    "network_addresses": network_addresses,
+    "memory_usage": lambda: psutil.virtual_memory().percent,
+    "agent_version": lambda: AGENT_VERSION,
+    "capabilities": lambda: CAPABILITIES,
+    "framing": lambda: protocol.VERSIONS,
+    # Only sent when asked for by name.
+    "mounts": lambda: open("/proc/mounts").read(),
+    "sshfs_mounts": sshfs_mounts,
+    "network_bytes": network_bytes,
+    "ssh_sessions": ssh_sessions,
+    "users": lambda: len(psutil.users()),
+}
+ON_DEMAND_FIELDS = {"mounts", "sshfs_mounts", "network_bytes", "ssh_sessions", "users"}
+
+status_seq = 0
+# field -> [last value, seq at which it last changed]
+status_history = {}
+
+
+def send_status(command=None):
+    """Reply with the requested fields, or all but the on demand ones.
+
+    With `since` set to the `seq` of an earlier reply from this session only
+    the fields that changed after it are included.
+    """
+    global status_seq
+    command = command or {}
+    fields = command.get("fields") or [
+        name for name in STATUS_FIELDS if name not in ON_DEMAND_FIELDS]
+    since = command.get("since") if command.get("session") == SESSION else None
+    status_seq += 1
+    output = {"status": "running", "seq": status_seq, "session": SESSION}
+    for name in fields:
+        if name not in STATUS_FIELDS:
+            continue
+        value = STATUS_FIELDS[name]()
+        history = status_history.get(name)
+        if history is None or history[0] != value:
+            history = status_history[name] = [value, status_seq]
+        if since is None or history[1] > since:
+            output[name] = value
     send_json_message(output)
 
 
-send_json_message({"status": "initializing"})
+class ProcessSampler:
+    """Per-process CPU, RSS and IO rates, kept up to date in the background.
 
-try:
-    subprocess.check_output(args=["cloud-init", "status", "--wait"])
-    send_json_message({"status": "initialization_complete"})
-except subprocess.CalledProcessError:
-    send_json_message({"status": "initialization_error"})
-
-send_status()
-
-while True:
-    incoming = ser.readline()
-    command_parsed = json.loads(incoming)
-    if command_parsed["message_type"] == "poweroff":
-        print("Powering off")
-        os.system("poweroff")
-    if command_parsed["message_type"] == "time_update":
-        print("Updating the time")
-        os.system(f'date +%s -s @{command_parsed["time"]}')
-    if command_parsed["message_type"] == "status":
-        print("Sending status")
-        send_status()
+    psutil.Process objects are kept between samples, so a sample only
+    reads each process's counters and the delta to the previous one. The
+    sampling thread starts with the first `top` request and stops after
+    IDLE_TIMEOUT seconds without one. It stretches its interval so sampling
+    never takes more than CPU_BUDGET of a CPU, however many processes there are.
+    """
+
+    INTERVAL = 2.0
+    CPU_BUDGET = 0.01
+    IDLE_TIMEOUT = 60
+    # The first request waits this long for a second sample to compute rates from.
+    WARMUP = 0.5
+    # Command lines are cut to this, k8s processes have enormous ones.
+    COMMAND_LENGTH = 200
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.thread = None
+        # pid -> [Process, name, command line, cpu seconds, read bytes, written bytes]
+        self.processes = {}
+        self.samples = []
+        self.sampled_at = None
+        self.interval = self.INTERVAL
+        self.cost = 0.0
+        self.duration = 0.0
+        self.last_request = 0.0
+
+    def read_counters(self, process):
+        with process.oneshot():
+            cpu_times = process.cpu_times()
+            rss = process.memory_info().rss
+            try:
+                io = process.io_counters()
+                io = io.read_bytes, io.write_bytes
+            except (psutil.AccessDenied, AttributeError):
+                io = None, None
+        return cpu_times.user + cpu_times.system, rss, io
+
+    def sample(self):
+        started, cpu_started = time.monotonic(), time.thread_time()
+        elapsed = started - self.sampled_at if self.sampled_at else None
+        pids = set(psutil.pids())
+        for pid in list(self.processes):
+            if pid not in pids:
+                del self.processes[pid]
+        samples = []
+        for pid in pids:
+            entry = self.processes.get(pid)
+            try:
+                if entry is None:
+                    process = psutil.Process(pid)
+                    entry = [process, process.name(), " ".join(process.cmdline())[:self.COMMAND_LENGTH],
+                             None, None, None]
+                cpu, rss, (read, written) = self.read_counters(entry[0])
+            except psutil.Error:
+                self.processes.pop(pid, None)
+                continue
+            self.processes[pid] = entry
+            sample = {"pid": pid, "name": entry[1], "command": entry[2], "rss": rss,
+                      "cpu": None, "read_rate": None, "write_rate": None}
+            # A process seen for the first time, or a reused pid, has no rates yet.
+            if elapsed and entry[3] is not None and cpu >= entry[3]:
+                sample["cpu"] = round((cpu - entry[3]) / elapsed * 100, 1)
+                if read is not None and entry[4] is not None:
+                    sample["read_rate"] = int(max(read - entry[4], 0) / elapsed)
+                    sample["write_rate"] = int(max(written - entry[5], 0) / elapsed)
+            entry[3:] = cpu, read, written
+            samples.append(sample)
+        with self.lock:
+            self.samples = samples
+            self.sampled_at = started
+            self.duration = time.monotonic() - started
+            self.cost = time.thread_time() - cpu_started
+            self.interval = max(self.INTERVAL, self.cost / self.CPU_BUDGET)
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            with self.lock:
+                if time.monotonic() - self.last_request > self.IDLE_TIMEOUT:
+                    self.thread = None
+                    self.processes, self.samples, self.sampled_at = {}, [], None
+                    return
+            self.sample()
+
+    def top(self, count=10, sort="cpu"):
+        with self.lock:
+            self.last_request = time.monotonic()
+            start = self.thread is None
+            if start:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+        if start:
+            self.sample()
+            time.sleep(self.WARMUP)
+            self.sample()
+            self.thread.start()
+        keys = {
+            "cpu": lambda sample: sample["cpu"] or 0,
+            "rss": lambda sample: sample["rss"],
+            "io": lambda sample: (sample["read_rate"] or 0) + (sample["write_rate"] or 0),
+        }
+        with self.lock:
+            samples = sorted(self.samples, key=keys[sort], reverse=True)
+            return {
+                "message_type": "top",
+                "processes": samples[:count],
+                "total": len(samples),
+                "age": round(time.monotonic() - self.sampled_at, 2),
+                "interval": round(self.interval, 2),
+                "sample_seconds": round(self.duration, 4),
+                "sample_cpu_seconds": round(self.cost, 4),
+            }
+
+
+process_sampler = ProcessSampler()
+
+
+def encode_chunk(data, compress, binary=False):
+    encoding = "raw"
+    if compress:
+        compressed = zlib.compress(data, 1)
+        if len(compressed) < len(data):
+            data, encoding = compressed, "zlib"
+    if binary:
+        return data, encoding
+    return base64.b64encode(data).decode(), encoding
+
+
+def decode_chunk(command):
+    data = command["data"]
+    if not isinstance(data, bytes):
+        data = base64.b64decode(data)
+    if command.get("encoding") == "zlib":
+        data = zlib.decompress(data)
+    return data
+
+
+def handle_poweroff(command):
+    print("Powering off")
+    os.system("poweroff")
+
+
+def handle_time_update(command):
+    print("Updating the time")
+    os.system(f'date +%s -s @{command["time"]}')
+
+
+def handle_status(command):
+    print("Sending status")
+    send_status(command)
+
+
+def handle_file_stat(command):
+    path = command["path"]
+    reply = {"message_type": "file_stat", "path": path, "exists": False}
+    try:
+        st = os.stat(path)
+    except OSError:
+        send_json_message(reply)
+        return
+    reply.update(exists=True, size=st.st_size, is_dir=stat.S_ISDIR(st.st_mode))
+    send_json_message(reply)
+
+
+def handle_file_digest(command):
+    length = command.get("length")
+    digest = hashlib.sha256()
+    with open(command["path"], "rb") as f:
+        remaining = length
+        while remaining is None or remaining > 0:
+            block = f.read(1024 * 1024 if remaining is None else min(remaining, 1024 * 1024))
+            if not block:
+                break
+            digest.update(block)
+            if remaining is not None:
+                remaining -= len(block)
+    send_json_message({"message_type": "file_digest", "path": command["path"],
+                       "sha256": digest.hexdigest()})
+
+
+def handle_file_write(command):
+    data = decode_chunk(command)
+    reply = {"message_type": "file_ack", "seq": command["seq"], "offset": command["offset"]}
+    if zlib.crc32(data) != command["crc32"]:
+        reply.update(ok=False, error="checksum mismatch")
+        send_json_message(reply)
+        return
+    mode = "r+b" if os.path.exists(command["path"]) else "wb"
+    with open(command["path"], mode) as f:
+        if command["offset"] == 0 and command.get("truncate"):
+            f.truncate()
+        f.seek(command["offset"])
+        f.write(data)
+    reply.update(ok=True, length=len(data))
+    send_json_message(reply)
+
+
+def handle_file_read(command):
+    with open(command["path"], "rb") as f:
+        f.seek(command["offset"])
+        data = f.read(command["length"])
+    encoded, encoding = encode_chunk(data, command.get("compress", False),
+                                     reply_framed and command.get("binary", False))
+    send_json_message({
+        "message_type": "file_chunk",
+        "seq": command["seq"],
+        "offset": command["offset"],
+        "data": encoded,
+        "encoding": encoding,
+        "crc32": zlib.crc32(data),
+        "eof": len(data) < command["length"],
+    })
+
+
+def handle_file_commit(command):
+    os.replace(command["source"], command["destination"])
+    send_json_message({"message_type": "file_commit", "path": command["destination"]})
+
+
+def handle_top(command):
+    send_json_message(process_sampler.top(command.get("count", 10), command.get("sort", "cpu")))
+
+
+MB = 1024 * 1024
+
+
+def bench_cpu(command):
+    """SHA-256 throughput of one thread, then of one thread per CPU."""
+    block = os.urandom(MB)
+    result = {}
+    for name, threads in (("single", 1), ("multi", os.cpu_count() or 1)):
+        counts = [0] * threads
+        deadline = time.monotonic() + command["seconds"]
+
+        def spin(index):
+            while time.monotonic() < deadline:
+                hashlib.sha256(block).digest()
+                counts[index] += 1
+
+        workers = [threading.Thread(target=spin, args=(index,)) for index in range(threads)]
+        started = time.monotonic()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        result[f"{name}_mb_per_second"] = round(sum(counts) / (time.monotonic() - started), 1)
+    result["threads"] = os.cpu_count() or 1
+    return result
+
+
+def open_direct(path, flags):
+    """Open bypassing the page cache where the filesystem allows it."""
+    try:
+        return os.open(path, flags | os.O_DIRECT), True
+    except (AttributeError, OSError):
+        return os.open(path, flags), False
+
+
+def timed_io(path, flags, io):
+    """Run io(fd) on `path` opened with `flags`, returning (seconds, O_DIRECT used)."""
+    fd, direct = open_direct(path, flags)
+    try:
+        started = time.monotonic()
+        io(fd, direct)
+        return time.monotonic() - started, direct
+    finally:
+        os.close(fd)
+
+
+def bench_disk(command):
+    """Sequential MB/s and random 4KB IOPS on a scratch file in `path`."""
+    path = os.path.join(command.get("path", "/var/tmp"), ".macos-virt-bench")
+    size, seconds = command["size_mb"], command["seconds"]
+    # mmap buffers are page aligned, as O_DIRECT needs.
+    block, page = mmap.mmap(-1, MB), mmap.mmap(-1, 4096)
+    block.write(os.urandom(MB))
+    pages = size * MB // 4096
+    counts = {}
+
+    def write_sequential(fd, direct):
+        for _ in range(size):
+            os.write(fd, block)
+        os.fsync(fd)
+
+    def read_sequential(fd, direct):
+        if not direct:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        while os.readv(fd, [block]):
+            pass
+
+    def random_io(operation):
+        def io(fd, direct):
+            count = 0
+            deadline = time.monotonic() + seconds
+            while time.monotonic() < deadline:
+                operation(fd, [page], random.randrange(pages) * 4096)
+                count += 1
+            if operation is os.pwritev:
+                os.fsync(fd)
+            counts[operation] = count
+        return io
+
+    result = {}
+    try:
+        elapsed, direct = timed_io(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                                   write_sequential)
+        result["seq_write_mb_per_second"] = round(size / elapsed, 1)
+        elapsed, _ = timed_io(path, os.O_RDONLY, read_sequential)
+        result["seq_read_mb_per_second"] = round(size / elapsed, 1)
+        elapsed, _ = timed_io(path, os.O_RDONLY, random_io(os.preadv))
+        result["random_read_iops"] = int(counts[os.preadv] / elapsed)
+        elapsed, _ = timed_io(path, os.O_WRONLY, random_io(os.pwritev))
+        result["random_write_iops"] = int(counts[os.pwritev] / elapsed)
+        result["direct_io"] = direct
+    finally:
+        if os.path.exists(path):
+            os.unlink(path)
+    return result
+
+
+def bench_files(command):
+    """Sequential MB/s and metadata operations in `path`, typically a mount."""
+    directory = os.path.join(command["path"], f".macos-virt-bench-{uuid.uuid4().hex[:8]}")
+    size, files = command["size_mb"], command.get("files", 500)
+    block = os.urandom(MB)
+    result = {}
+    os.mkdir(directory)
+    try:
+        path = os.path.join(directory, "data")
+        started = time.monotonic()
+        with open(path, "wb") as f:
+            for _ in range(size):
+                f.write(block)
+            os.fsync(f.fileno())
+        result["write_mb_per_second"] = round(size / (time.monotonic() - started), 1)
+        started = time.monotonic()
+        with open(path, "rb") as f:
+            while f.read(MB):
+                pass
+        result["read_mb_per_second"] = round(size / (time.monotonic() - started), 1)
+        os.unlink(path)
+
+        names = [os.path.join(directory, str(number)) for number in range(files)]
+        for name, operation in (("create_per_second", lambda name: open(name, "w").close()),
+                                ("stat_per_second", os.stat),
+                                ("delete_per_second", os.unlink)):
+            started = time.monotonic()
+            for file_name in names:
+                operation(file_name)
+            result[name] = int(files / (time.monotonic() - started))
+    finally:
+        for entry in os.listdir(directory):
+            os.unlink(os.path.join(directory, entry))
+        os.rmdir(directory)
+    return result
+
+
+def bench_network(command):
+    """TCP throughput from the host, which connects after bench_listen, and back.
+
+    The host streams until its time is up and half closes, then reads
+    what is sent back for as long.
+    """
+    listener = socket.create_server(("", 0))
+    listener.settimeout(30)
+    send_json_message({"message_type": "bench_listen", "port": listener.getsockname()[1]})
+    connection, _ = listener.accept()
+    listener.close()
+    with connection:
+        received = 0
+        started = time.monotonic()
+        while True:
+            data = connection.recv(MB)
+            if not data:
+                break
+            received += len(data)
+        upload = received / MB / (time.monotonic() - started)
+        block = bytes(MB)
+        deadline = time.monotonic() + command["seconds"]
+        while time.monotonic() < deadline:
+            connection.sendall(block)
+        connection.shutdown(socket.SHUT_WR)
+    return {"upload_mb_per_second": round(upload, 1)}
+
+
+BENCHMARKS = {
+    "cpu": bench_cpu,
+    "disk": bench_disk,
+    "mount": bench_files,
+    "network": bench_network,
+}
+
+
+def handle_bench(command):
+    print(f"Running {command['test']} benchmark")
+    result = BENCHMARKS[command["test"]](command)
+    send_json_message({"message_type": "bench", "test": command["test"], "result": result})
+
+
+def guest_path(path):
+    return os.path.join(ROOT, path.lstrip("/"))
+
+
+def setup_disk(device, name, mountpoint):
+    """Format `device` if it is blank, then mount it by label at `mountpoint`."""
+    formatted = False
+    if not os.path.exists(guest_path(f"/dev/disk/by-label/{name}")):
+        existing = subprocess.run(["blkid", "-o", "value", "-s", "TYPE", device],
+                                  stdout=subprocess.PIPE).stdout.decode().strip()
+        if existing:
+            raise ValueError(f"{device} already has a {existing} filesystem without label {name}")
+        subprocess.check_output(["mkfs.ext4", "-q", "-L", name, device],
+                                stderr=subprocess.STDOUT)
+        subprocess.run(["udevadm", "settle"])
+        formatted = True
+    os.makedirs(guest_path(mountpoint), exist_ok=True)
+    entry = f"LABEL={name} {mountpoint} ext4 defaults,nofail 0 2\n"
+    with open(guest_path("/etc/fstab"), "a+") as fstab:
+        fstab.seek(0)
+        # cloud-init writes its own entry for disks present at creation.
+        if not any(line.startswith(f"LABEL={name} ") for line in fstab):
+            fstab.write(entry)
+    if not os.path.ismount(guest_path(mountpoint)):
+        subprocess.check_output(["mount", mountpoint], stderr=subprocess.STDOUT)
+    return formatted
+
+
+def handle_setup_disks(command):
+    """Set up data disks attached after the first boot, cloud-init only ran once."""
+    results = []
+    for index, disk in enumerate(command["disks"]):
+        device = f"/dev/vd{chr(ord('c') + index)}"
+        result = {"name": disk["name"], "device": device, "ok": True}
+        try:
+            result["formatted"] = setup_disk(device, disk["name"], disk["mount"])
+        except (OSError, ValueError, subprocess.CalledProcessError) as e:
+            output = getattr(e, "output", None)
+            result.update(ok=False, error=output.decode().strip() if output else str(e))
+        results.append(result)
+    send_json_message({"message_type": "setup_disks", "disks": results})
+
+
+def zero_free_space(path):
+    zero_file = os.path.join(path, ".macos-virt-zero")
+    block = bytes(1024 * 1024)
+    try:
+        with open(zero_file, "wb") as f:
+            while True:
+                f.write(block)
+    except OSError:
+        pass
+    finally:
+        if os.path.exists(zero_file):
+            os.unlink(zero_file)
+        os.sync()
+
+
+def handle_fstrim(command):
+    if command.get("zero_free"):
+        zero_free_space("/")
+    try:
+        output = subprocess.check_output(
+            ["fstrim", "-av"], stderr=subprocess.STDOUT).decode()
+        ok = True
+    except subprocess.CalledProcessError as e:
+        output = e.output.decode()
+        ok = False
+    send_json_message({"message_type": "fstrim", "ok": ok, "output": output})
+
+
+HANDLERS = {
+    "poweroff": handle_poweroff,
+    "time_update": handle_time_update,
+    "status": handle_status,
+    "file_stat": handle_file_stat,
+    "file_digest": handle_file_digest,
+    "file_write": handle_file_write,
+    "file_read": handle_file_read,
+    "file_commit": handle_file_commit,
+    "fstrim": handle_fstrim,
+    "top": handle_top,
+    "bench": handle_bench,
+    "setup_disks": handle_setup_disks,
+}
+
+
+def handle(command_parsed):
+    handler = HANDLERS.get(command_parsed.get("message_type"))
+    if handler is None:
+        return
+    try:
+        handler(command_parsed)
+    except Exception as e:
+        send_json_message({"message_type": "error", "error": str(e)})
+
+
+def serve():
+    global reply_framed, reply_batch
+    while True:
+        try:
+            commands, reply_framed = protocol.read_messages(ser)
+        except (protocol.ProtocolError, ValueError) as e:
+            # A corrupt frame, its length can't be trusted so skip to the next one.
+            print(f"Dropping message: {e}")
+            continue
+        if len(commands) > 1:
+            reply_batch = []
+        for command_parsed in commands:
+            handle(command_parsed)
+        if reply_batch is not None:
+            batch, reply_batch = reply_batch, None
+            if batch:
+                ser.write(protocol.encode_frame(batch, batch=True))
+
+
+CLOUDINIT_LOG = "/var/log/cloud-init.log"
+CLOUDINIT_POLL_INTERVAL = 0.5
+# Matches the reporting events cloud-init logs around each stage and module:
+# 2022-03-21 10:00:01,234 - handlers.py[DEBUG]: finish: modules-final/config-ssh: SUCCESS: ...
+CLOUDINIT_EVENT = re.compile(r"^(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d),(\d{3}) - [^:]*: "
+                             r"(start|finish): ([\w-]+(?:/[\w-]+)?): (?:(SUCCESS|WARN|FAIL): )?")
+
+
+def parse_cloudinit_event(line):
+    match = CLOUDINIT_EVENT.match(line)
+    if match is None:
+        return None
+    date, milliseconds, event, name, result = match.groups()
+    # Cloud images run in UTC.
+    at = calendar.timegm(time.strptime(date, "%Y-%m-%d %H:%M:%S")) + int(milliseconds) / 1000
+    message = {"event": event, "name": name, "at": at}
+    if result:
+        message["result"] = result
+    return message
+
+
+class CloudInitProgress(threading.Thread):
+    """Streams the start and finish of cloud-init's stages and modules from its log."""
+
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.finished = threading.Event()
+
+    def run(self):
+        path = guest_path(CLOUDINIT_LOG)
+        # The log spans every boot, earlier boots' events are old news.
+        since = psutil.boot_time() - 1
+        position = 0
+        pending = b""
+        while True:
+            finishing = self.finished.is_set()
+            try:
+                with open(path, "rb") as f:
+                    if os.fstat(f.fileno()).st_size < position:
+                        position, pending = 0, b""
+                    f.seek(position)
+                    data = f.read()
+            except OSError:
+                data = b""
+            position += len(data)
+            *lines, pending = (pending + data).split(b"\n")
+            for line in lines:
+                event = parse_cloudinit_event(line.decode(errors="replace"))
+                if event and event["at"] >= since:
+                    send_json_message(dict(event, status="initialization_progress"))
+            if finishing:
+                return
+            self.finished.wait(CLOUDINIT_POLL_INTERVAL)
+
+
+def main():
+    global ser
+    ser = serial.Serial(os.environ.get("MACOS_VIRT_AGENT_PORT", "/dev/hvc1"))
+    run()
+
+
+def run():
+    send_json_message({"status": "initializing"})
+    progress = CloudInitProgress()
+    progress.start()
+    try:
+        subprocess.check_output(args=["cloud-init", "status", "--wait"])
+        outcome = "initialization_complete"
+    except subprocess.CalledProcessError:
+        outcome = "initialization_error"
+    progress.finished.set()
+    progress.join()
+    send_json_message({"status": outcome})
+
+    send_status()
+    serve()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,15 @@
+import os
+
+import xdg
+import yaml
+
+SETTINGS_PATH = os.path.join(xdg.xdg_config_home(), "macos-virt/settings.yaml")
+
+
+def get_settings(section, defaults):
+    """Return one section of settings.yaml layered over `defaults`."""
+    try:
+        settings = yaml.safe_load(open(SETTINGS_PATH)) or {}
+    except FileNotFoundError:
+        settings = {}
+    return dict(defaults, **(settings.get(section) or {}))
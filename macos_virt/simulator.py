@@ -0,0 +1,262 @@
+"""A stand in for macos_virt_runner that needs neither macOS nor a guest.
+
+Takes the runner's arguments, writes the pidfile, creates the console and
+control ptys behind their symlinks and runs the real guest agent against
+the control pty. The agent sees a fake psutil, a fake cloud-init writing its
+log, poweroff, date, fstrim and disk commands, and keeps fstab, mount points
+and logs under simulator-root, so it behaves like a booted guest.
+
+Latency and faults come from the simulator section of settings.yaml.
+
+    python -m macos_virt.simulator --pidfile=./pidfile --control-symlink=control ...
+"""
+import argparse
+import contextlib
+import os
+import pty
+import random
+import signal
+import stat
+import sys
+import time
+import tty
+import types
+from collections import namedtuple
+
+from macos_virt.constants import DISK_CACHE_MODES
+from macos_virt.settings import get_settings
+
+DEFAULTS = {
+    # Seconds cloud-init takes to finish.
+    "boot_delay": 1.0,
+    # Added before the agent handles each request.
+    "reply_delay": 0.0,
+    "shutdown_delay": 0.5,
+    # Fraction of requests the agent silently ignores.
+    "drop_rate": 0.0,
+    # crash: exit before the control channel exists, hang: boot then never
+    # answer, init_error: cloud-init fails.
+    "fault": None,
+    "cpu_usage": 5.0,
+    "memory_usage": 30.0,
+    "root_fs_usage": 20.0,
+    "processes": 120,
+    # Activity the idle monitor sees, network_rate is in bytes per second.
+    "network_rate": 0,
+    "ssh_sessions": 0,
+    "users": 0,
+}
+
+Address = namedtuple("Address", "family address netmask")
+Usage = namedtuple("Usage", "percent")
+CPUTimes = namedtuple("CPUTimes", "user system")
+MemoryInfo = namedtuple("MemoryInfo", "rss")
+IOCounters = namedtuple("IOCounters", "read_bytes write_bytes")
+NetIOCounters = namedtuple("NetIOCounters", "bytes_sent bytes_recv")
+Connection = namedtuple("Connection", "laddr status")
+LocalAddress = namedtuple("LocalAddress", "ip port")
+# Modules the fake cloud-init runs in each stage, with their share of boot_delay.
+CLOUDINIT_STAGES = {
+    "init-local": {},
+    "init-network": {"config-write-files": 0.05, "config-ssh": 0.05},
+    "modules-config": {"config-apt-configure": 0.1},
+    "modules-final": {"config-package-update-upgrade-install": 0.5, "config-scripts-user": 0.3},
+}
+LOG_EVENT = ('import sys, time; now = time.time(); open(sys.argv[1], "a").write('
+             'time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(now))'
+             ' + ",%03d - handlers.py[DEBUG]: " % (now % 1 * 1000) + sys.argv[2] + "\\n")')
+PROCESS_NAMES = ["systemd", "containerd", "k3s-server", "kubelet", "sshd", "python3"]
+
+
+class FakeProcess:
+    """A guest process whose counters grow at a steady, per-pid rate."""
+
+    def __init__(self, pid, started):
+        self.pid = pid
+        self.started = started
+        self.rng = random.Random(pid)
+        self.cpu_share = self.rng.choice([0.0, 0.001, 0.01, 0.2])
+        self.io_rate = self.rng.choice([0, 0, 4096, 1024 * 1024])
+        self.rss = self.rng.randint(1, 512) * 1024 * 1024
+
+    def name(self):
+        return PROCESS_NAMES[self.pid % len(PROCESS_NAMES)]
+
+    def cmdline(self):
+        return [f"/usr/bin/{self.name()}", f"--instance={self.pid}"]
+
+    def oneshot(self):
+        return contextlib.nullcontext()
+
+    def cpu_times(self):
+        used = (time.time() - self.started) * self.cpu_share
+        return CPUTimes(used * 0.8, used * 0.2)
+
+    def memory_info(self):
+        return MemoryInfo(self.rss)
+
+    def io_counters(self):
+        done = int((time.time() - self.started) * self.io_rate)
+        return IOCounters(done, done // 2)
+
+
+class PtyPort:
+    """The guest end of a pty, with the read/readline/write the agent uses."""
+
+    def __init__(self, fd):
+        self.reader = os.fdopen(fd, "rb")
+        self.writer = os.fdopen(os.dup(fd), "wb")
+
+    def read(self, size=1):
+        return self.reader.read(size)
+
+    def readline(self):
+        return self.reader.readline()
+
+    def write(self, data):
+        self.writer.write(data)
+        self.writer.flush()
+
+
+def open_pty(symlink):
+    primary, secondary = pty.openpty()
+    tty.setraw(secondary)
+    if os.path.lexists(symlink):
+        os.unlink(symlink)
+    os.symlink(os.ttyname(secondary), symlink)
+    # Keeps the pty alive while the host has it closed.
+    return primary, secondary
+
+
+def guest_address(mac_address):
+    return f"192.168.64.{int(mac_address.split(':')[-1], 16) % 250 + 2}"
+
+
+def fake_psutil(config, cpus, memory, address):
+    boot_time = time.time()
+    module = types.ModuleType("psutil")
+    jitter = lambda value: round(max(0.0, value + random.uniform(-1, 1)), 1)  # noqa: E731
+    module.cpu_count = lambda: cpus
+    module.cpu_percent = lambda: jitter(config["cpu_usage"])
+    module.disk_usage = lambda path: Usage(config["root_fs_usage"])
+    module.virtual_memory = lambda: Usage(jitter(config["memory_usage"]))
+    module.boot_time = lambda: boot_time
+    module.pids = lambda: list(range(1, config["processes"] + 1))
+    module.Process = lambda pid: FakeProcess(pid, boot_time)
+    module.net_io_counters = lambda pernic: {"enp0s1": NetIOCounters(
+        0, int((time.time() - boot_time) * config["network_rate"]))}
+    module.CONN_ESTABLISHED = "ESTABLISHED"
+    module.net_connections = lambda kind: [
+        Connection(LocalAddress(address, 22), "ESTABLISHED")] * config["ssh_sessions"]
+    module.users = lambda: [None] * config["users"]
+    module.Error = type("Error", (Exception,), {})
+    module.AccessDenied = type("AccessDenied", (module.Error,), {})
+    module.net_if_addrs = lambda: {"enp0s1": [
+        Address(types.SimpleNamespace(name="AF_INET"), address, "255.255.255.0")]}
+    return module
+
+
+def write_script(directory, name, body):
+    path = os.path.join(directory, name)
+    with open(path, "w") as f:
+        f.write("#!/bin/sh\n" + body + "\n")
+    os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR)
+
+
+def fake_cloudinit(directory, config):
+    """A cloud-init logging its stages and modules the way the real one does."""
+    log = os.path.abspath("simulator-root/var/log/cloud-init.log")
+    os.makedirs(os.path.dirname(log), exist_ok=True)
+    write_script(directory, "cloud-init-log",
+                 f"exec {sys.executable} -c '{LOG_EVENT}' {log} \"$1\"")
+    failing = config["fault"] == "init_error"
+    lines = []
+    for stage, modules in CLOUDINIT_STAGES.items():
+        lines.append(f'cloud-init-log "start: {stage}: running {stage}"')
+        for module, share in modules.items():
+            result = "FAIL" if failing and module == "config-scripts-user" else "SUCCESS"
+            lines += [f'cloud-init-log "start: {stage}/{module}: running {module}"',
+                      f"sleep {config['boot_delay'] * share}",
+                      f'cloud-init-log "finish: {stage}/{module}: {result}: {module} ran"']
+        lines.append(f'cloud-init-log "finish: {stage}: SUCCESS: {stage} done"')
+    lines.append(f"exit {1 if failing else 0}")
+    write_script(directory, "cloud-init", "\n".join(lines))
+
+
+def fake_commands(directory, config):
+    os.makedirs(directory, exist_ok=True)
+    fake_cloudinit(directory, config)
+    write_script(directory, "poweroff", f"kill -TERM {os.getpid()}")
+    write_script(directory, "date", "true")
+    write_script(directory, "fstrim", "echo '/: 0 B (0 bytes) trimmed'")
+    os.makedirs("simulator-root/etc", exist_ok=True)
+    labels = os.path.abspath("simulator-root/dev/disk/by-label")
+    # Called as mkfs.ext4 -q -L LABEL DEVICE.
+    write_script(directory, "mkfs.ext4", f'mkdir -p {labels} && touch "{labels}/$3"')
+    for command in ("blkid", "udevadm", "mount"):
+        write_script(directory, command, "true")
+    os.environ["PATH"] = directory + os.pathsep + os.environ["PATH"]
+
+
+def wrap_handlers(service, config):
+    def wrap(handler):
+        def simulated(command):
+            if config["fault"] == "hang" or random.random() < config["drop_rate"]:
+                return
+            if config["reply_delay"]:
+                time.sleep(config["reply_delay"])
+            handler(command)
+        return simulated
+
+    for name, handler in list(service.HANDLERS.items()):
+        service.HANDLERS[name] = wrap(handler)
+
+
+def shutdown(config):
+    def handler(signum, frame):
+        time.sleep(config["shutdown_delay"])
+        sys.exit(0)
+    return handler
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pidfile", required=True)
+    parser.add_argument("--console-symlink", required=True)
+    parser.add_argument("--control-symlink", required=True)
+    parser.add_argument("--network", default="52:54:00:00:00:01@nat")
+    parser.add_argument("--cpu-count", type=int, default=1)
+    parser.add_argument("--memory-size", type=int, default=1024)
+    parser.add_argument("--disk", action="append", default=[])
+    args, _ = parser.parse_known_args()
+    config = get_settings("simulator", DEFAULTS)
+    for disk in args.disk:
+        # Like the runner, a caching mode may follow an @, other disks must exist.
+        path, _, mode = disk.rpartition("@")
+        if mode not in DISK_CACHE_MODES:
+            path = disk
+        if not os.path.exists(path):
+            sys.exit(f"Can't open disk {disk}")
+
+    with open(args.pidfile, "w") as f:
+        f.write(str(os.getpid()))
+    signal.signal(signal.SIGTERM, shutdown(config))
+    if config["fault"] == "crash":
+        sys.exit(1)
+
+    console, _ = open_pty(args.console_symlink)
+    os.write(console, b"Simulated guest booting\r\n")
+    control, _ = open_pty(args.control_symlink)
+
+    address = guest_address(args.network.split("@")[0])
+    sys.modules["psutil"] = fake_psutil(config, args.cpu_count, args.memory_size, address)
+    fake_commands(os.path.abspath("simulator-bin"), config)
+    from macos_virt.service import service
+    wrap_handlers(service, config)
+    service.ROOT = os.path.abspath("simulator-root")
+    service.ser = PtyPort(control)
+    service.run()
+
+
+if __name__ == "__main__":
+    main()
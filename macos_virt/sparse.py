@@ -0,0 +1,163 @@
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import os
+import platform
+import struct
+
+SCAN_BUFFER_SIZE = 4 * 1024 * 1024
+BLOCK_SIZE = 64 * 1024
+
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+F_PUNCHHOLE = 99
+
+_libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+
+UNSUPPORTED_ERRNOS = (errno.EOPNOTSUPP, errno.ENOTSUP, errno.EINVAL, errno.ENOSYS)
+
+
+def allocated_bytes(path):
+    return os.stat(path).st_blocks * 512
+
+
+def data_extents(fd, size):
+    """Yield (start, end) ranges of a file that are backed by storage."""
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, os.SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                return
+            yield offset, size
+            return
+        except AttributeError:
+            yield offset, size
+            return
+        end = min(os.lseek(fd, start, os.SEEK_HOLE), size)
+        yield start, end
+        offset = end
+
+
+def zero_extents(fd, size, block_size=BLOCK_SIZE):
+    """Yield merged (offset, length) runs of block aligned zero blocks.
+
+    Whole scan buffers are compared against a zero buffer in one go, which
+    is a single memcmp in C, and are only split into blocks when they hold
+    data.
+    """
+    zero_buffer = bytes(SCAN_BUFFER_SIZE)
+    zero_block = bytes(block_size)
+    run_start = None
+    run_end = None
+    for start, end in data_extents(fd, size):
+        offset = start - start % block_size
+        while offset < end:
+            os.lseek(fd, offset, os.SEEK_SET)
+            buffer = os.read(fd, min(SCAN_BUFFER_SIZE, end - offset))
+            if not buffer:
+                break
+            # startswith is a memcmp against the zeros without slicing a copy of
+            # them, comparing memoryviews would go element by element.
+            if zero_buffer.startswith(buffer):
+                blocks = [(offset, len(buffer))]
+            else:
+                view = memoryview(buffer)
+                blocks = [
+                    (offset + i, min(block_size, len(buffer) - i))
+                    for i in range(0, len(buffer), block_size)
+                    if zero_block.startswith(view[i:i + block_size])
+                ]
+            for block_offset, length in blocks:
+                if run_end == block_offset:
+                    run_end += length
+                    continue
+                if run_start is not None:
+                    yield run_start, run_end - run_start
+                run_start, run_end = block_offset, block_offset + length
+            offset += len(buffer)
+    if run_start is not None:
+        yield run_start, run_end - run_start
+
+
+def punch_hole(fd, offset, length):
+    """Deallocate a range in place, returns False if the platform can't."""
+    if platform.system() == "Darwin":
+        # struct fpunchhole {uint fp_flags; uint reserved; off_t fp_offset; off_t fp_length}
+        try:
+            fcntl.fcntl(fd, F_PUNCHHOLE, struct.pack("IIqq", 0, 0, offset, length))
+        except OSError as e:
+            if e.errno in UNSUPPORTED_ERRNOS:
+                return False
+            raise
+        return True
+    if platform.system() != "Linux":
+        return False
+    result = _libc.fallocate(
+        fd,
+        FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE,
+        ctypes.c_longlong(offset),
+        ctypes.c_longlong(length),
+    )
+    if result != 0:
+        error = ctypes.get_errno()
+        if error in UNSUPPORTED_ERRNOS:
+            return False
+        raise OSError(error, os.strerror(error))
+    return True
+
+
+def preallocate(path, size):
+    """Create `path` with all of its `size` bytes allocated up front."""
+    with open(path, "wb") as f:
+        try:
+            os.posix_fallocate(f.fileno(), 0, size)
+            return
+        except AttributeError:
+            # macOS has no posix_fallocate, writing zeros allocates on APFS.
+            pass
+        except OSError as e:
+            if e.errno not in UNSUPPORTED_ERRNOS:
+                raise
+        block = bytes(SCAN_BUFFER_SIZE)
+        remaining = size
+        while remaining > 0:
+            remaining -= f.write(block[:min(remaining, len(block))])
+
+
+def rewrite_sparse(path):
+    tmp_path = path + ".sparse-tmp"
+    size = os.path.getsize(path)
+    zero_block = bytes(BLOCK_SIZE)
+    with open(path, "rb") as source, open(tmp_path, "wb") as destination:
+        for start, end in data_extents(source.fileno(), size):
+            source.seek(start)
+            destination.seek(start)
+            while source.tell() < end:
+                block = source.read(min(BLOCK_SIZE, end - source.tell()))
+                if block == zero_block[:len(block)]:
+                    destination.seek(len(block), os.SEEK_CUR)
+                else:
+                    destination.write(block)
+        destination.truncate(size)
+    os.replace(tmp_path, path)
+
+
+def compact_file(path):
+    """Return (allocated bytes before, allocated bytes after)."""
+    before = allocated_bytes(path)
+    fd = os.open(path, os.O_RDWR)
+    try:
+        size = os.fstat(fd).st_size
+        supported = True
+        for offset, length in list(zero_extents(fd, size)):
+            if not punch_hole(fd, offset, length):
+                supported = False
+                break
+    finally:
+        os.close(fd)
+    if not supported:
+        rewrite_sparse(path)
+    return before, allocated_bytes(path)
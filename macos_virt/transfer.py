@@ -0,0 +1,207 @@
+import base64
+import hashlib
+import os
+import zlib
+from collections import deque
+
+from rich.progress import Progress
+
+from macos_virt.service.protocol import Channel
+
+CHUNK_SIZE = 256 * 1024
+WINDOW = 4
+PART_SUFFIX = ".macos-virt-part"
+
+
+class TransferError(Exception):
+    pass
+
+
+def local_digest(path, length=None):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        remaining = length
+        while remaining is None or remaining > 0:
+            size = CHUNK_SIZE if remaining is None else min(remaining, CHUNK_SIZE)
+            block = f.read(size)
+            if not block:
+                break
+            digest.update(block)
+            if remaining is not None:
+                remaining -= len(block)
+    return digest.hexdigest()
+
+
+class AgentFileTransfer:
+    """Moves files over the guest agent's control channel.
+
+    Chunks are sent with a CRC32 each and a window of outstanding requests,
+    files are assembled under a part name and verified with SHA256 before
+    being moved into place, so an interrupted copy resumes from the last
+    verified offset.
+    """
+
+    def __init__(self, port, chunk_size=CHUNK_SIZE, window=WINDOW, compress=True,
+                 framed=False):
+        self.channel = Channel(port, framed)
+        # Frames carry chunks as raw bytes instead of base64.
+        self.binary = framed
+        self.chunk_size = chunk_size
+        self.window = window
+        self.compress = compress
+        self.seq = 0
+
+    def send(self, message):
+        self.channel.send(message)
+
+    def receive(self, message_type):
+        while True:
+            message = self.channel.receive()
+            if message is None:
+                raise TransferError("Timed out waiting for the VM agent")
+            if message.get("message_type") == "error":
+                raise TransferError(message["error"])
+            if message.get("message_type") == message_type:
+                return message
+
+    def request(self, message, reply_type):
+        self.send(message)
+        return self.receive(reply_type)
+
+    def remote_stat(self, path):
+        return self.request({"message_type": "file_stat", "path": path}, "file_stat")
+
+    def remote_digest(self, path, length=None):
+        return self.request(
+            {"message_type": "file_digest", "path": path, "length": length},
+            "file_digest",
+        )["sha256"]
+
+    def next_seq(self):
+        self.seq += 1
+        return self.seq
+
+    def encode(self, data):
+        encoding = "raw"
+        if self.compress:
+            compressed = zlib.compress(data, 1)
+            if len(compressed) < len(data):
+                data, encoding = compressed, "zlib"
+        if self.binary:
+            return data, encoding
+        return base64.b64encode(data).decode(), encoding
+
+    @staticmethod
+    def decode(message):
+        data = message["data"]
+        if not isinstance(data, bytes):
+            data = base64.b64decode(data)
+        if message["encoding"] == "zlib":
+            data = zlib.decompress(data)
+        if zlib.crc32(data) != message["crc32"]:
+            raise TransferError(f"Checksum mismatch at offset {message['offset']}")
+        return data
+
+    def upload(self, source, destination):
+        remote = self.remote_stat(destination)
+        if remote["exists"] and remote["is_dir"]:
+            destination = os.path.join(destination, os.path.basename(source))
+        part = destination + PART_SUFFIX
+        size = os.path.getsize(source)
+
+        offset = 0
+        remote_part = self.remote_stat(part)
+        if remote_part["exists"] and 0 < remote_part["size"] <= size:
+            if self.remote_digest(part, remote_part["size"]) == local_digest(
+                    source, remote_part["size"]):
+                offset = remote_part["size"]
+
+        pending = deque()
+        with open(source, "rb") as f, Progress() as progress:
+            task = progress.add_task(f"Uploading {os.path.basename(source)}",
+                                     total=size, completed=offset)
+            f.seek(offset)
+            while True:
+                data = f.read(self.chunk_size)
+                if data or offset == 0:
+                    encoded, encoding = self.encode(data)
+                    seq = self.next_seq()
+                    self.send({
+                        "message_type": "file_write",
+                        "path": part,
+                        "seq": seq,
+                        "offset": offset,
+                        "truncate": offset == 0,
+                        "data": encoded,
+                        "encoding": encoding,
+                        "crc32": zlib.crc32(data),
+                    })
+                    pending.append(seq)
+                    offset += len(data)
+                while pending and (len(pending) >= self.window or not data):
+                    ack = self.receive("file_ack")
+                    if not ack["ok"] or ack["seq"] != pending.popleft():
+                        raise TransferError(
+                            f"Chunk at offset {ack['offset']} rejected: {ack.get('error')}")
+                    progress.update(task, advance=ack["length"])
+                if not data:
+                    break
+
+        if self.remote_digest(part) != local_digest(source):
+            raise TransferError(f"{destination} failed verification, retry to resume")
+        self.request({"message_type": "file_commit", "source": part,
+                      "destination": destination}, "file_commit")
+
+    def download(self, source, destination):
+        remote = self.remote_stat(source)
+        if not remote["exists"] or remote["is_dir"]:
+            raise TransferError(f"{source} is not a file in the VM")
+        if os.path.isdir(destination):
+            destination = os.path.join(destination, os.path.basename(source))
+        part = destination + PART_SUFFIX
+        size = remote["size"]
+
+        offset = 0
+        if os.path.exists(part) and 0 < os.path.getsize(part) <= size:
+            local_size = os.path.getsize(part)
+            if self.remote_digest(source, local_size) == local_digest(part, local_size):
+                offset = local_size
+
+        pending = deque()
+        next_offset = offset
+        with open(part, "r+b" if offset else "wb") as f, Progress() as progress:
+            task = progress.add_task(f"Downloading {os.path.basename(source)}",
+                                     total=size, completed=offset)
+            f.truncate(offset)
+            f.seek(offset)
+            while offset < size:
+                requests = []
+                while len(pending) + len(requests) < self.window and next_offset < size:
+                    requests.append({
+                        "message_type": "file_read",
+                        "path": source,
+                        "seq": self.next_seq(),
+                        "offset": next_offset,
+                        "length": self.chunk_size,
+                        "compress": self.compress,
+                        "binary": self.binary,
+                    })
+                    next_offset += self.chunk_size
+                self.channel.send_batch(requests)
+                pending.extend(request["seq"] for request in requests)
+                chunk = self.receive("file_chunk")
+                if chunk["seq"] != pending.popleft() or chunk["offset"] != offset:
+                    raise TransferError(f"Out of order chunk at offset {chunk['offset']}")
+                data = self.decode(chunk)
+                f.write(data)
+                offset += len(data)
+                progress.update(task, advance=len(data))
+                if chunk["eof"]:
+                    break
+            while pending:
+                self.receive("file_chunk")
+                pending.popleft()
+
+        if self.remote_digest(source) != local_digest(part):
+            raise TransferError(f"{source} changed during the copy, retry to resume")
+        os.replace(part, destination)
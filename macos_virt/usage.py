@@ -0,0 +1,266 @@
+"""Samples what running VMs use and recommends CPUs, memory and disk for them.
+
+The sampler runs in the background and asks every running VM's agent for
+its CPU, memory and root filesystem usage. Each VM's samples are kept as
+histograms in one small file per VM, so months of samples take the same
+space as a day's. They start over whenever the VM is resized.
+
+    python -m macos_virt.usage
+"""
+import json
+import math
+import os
+import pathlib
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import xdg
+from rich.console import Console
+from rich.table import Table
+
+from macos_virt import daemon
+from macos_virt.controller import BaseError, Controller, VMManager, VMDoesntExist, print_records
+from macos_virt.settings import get_settings
+
+console = Console()
+
+DEFAULTS = {
+    # Seconds between samples.
+    "interval": 300,
+    # Recommendations need this many samples, a day's at the default interval.
+    "min_samples": 288,
+    # CPUs are sized so the 95th percentile uses this percentage of them.
+    "cpu_target": 70,
+    # Memory above the peak, in percent.
+    "memory_headroom": 25,
+    # The root filesystem should stay below disk_target percent for this long.
+    "disk_horizon_days": 90,
+    "disk_target": 80,
+    "directory": os.path.join(xdg.xdg_config_home(), "macos-virt/usage"),
+}
+
+USAGE_FIELDS = ["cpu_usage", "memory_usage", "root_fs_usage"]
+RESOURCES = ("cpus", "memory", "disk_size")
+SAMPLE_TIMEOUT = 10
+MIN_MEMORY = 512
+MEMORY_STEP = 256
+DISK_STEP = 1024
+DAY = 24 * 60 * 60
+
+
+def settings():
+    return get_settings("usage", DEFAULTS)
+
+
+def path(config, name):
+    return os.path.join(config["directory"], name)
+
+
+def sizing(vm):
+    return {resource: vm.configuration[resource] for resource in RESOURCES}
+
+
+def new_record(vm):
+    return {"sizing": sizing(vm), "since": time.time(), "samples": 0,
+            "cpu": [0] * 101, "memory": [0] * 101, "memory_peak": 0, "root_fs": None}
+
+
+def load_record(config, name):
+    try:
+        return json.load(open(path(config, f"{name}.json")))
+    except (OSError, ValueError):
+        return None
+
+
+def save_record(config, name, record):
+    record_path = path(config, f"{name}.json")
+    with open(record_path + ".tmp", "w") as f:
+        json.dump(record, f)
+    os.replace(record_path + ".tmp", record_path)
+
+
+def add_sample(record, status, now):
+    record["samples"] += 1
+    record["cpu"][min(round(status["cpu_usage"]), 100)] += 1
+    record["memory"][min(round(status["memory_usage"]), 100)] += 1
+    record["memory_peak"] = max(record["memory_peak"], status["memory_usage"])
+    root_fs = [now, status["root_fs_usage"]]
+    if record["root_fs"] is None:
+        record["root_fs"] = {"first": root_fs, "last": root_fs}
+    else:
+        record["root_fs"]["last"] = root_fs
+
+
+def percentile(histogram, fraction):
+    target = fraction * sum(histogram)
+    seen = 0
+    for value, count in enumerate(histogram):
+        seen += count
+        if count and seen >= target:
+            return value
+    return 0
+
+
+class UsageSampler:
+    def __init__(self, config=None):
+        self.config = config or settings()
+        pathlib.Path(self.config["directory"]).mkdir(parents=True, exist_ok=True)
+
+    def sample(self, name):
+        vm = VMManager(name)
+        try:
+            vm.load_configuration_from_disk()
+            if vm.pending_stages():
+                return
+            status = vm.query_status(fields=USAGE_FIELDS, timeout=SAMPLE_TIMEOUT)
+        except (BaseError, OSError, ValueError, KeyError) as e:
+            # Busy or unreachable, the next sample will do.
+            print(f"Not sampling {name}: {e}", file=sys.stderr)
+            return
+        record = load_record(self.config, name)
+        if record is None or record["sizing"] != sizing(vm):
+            # Usage at another size says little about this one.
+            record = new_record(vm)
+        add_sample(record, status, time.time())
+        save_record(self.config, name, record)
+
+    def run_once(self):
+        names = Controller.list_running_vms()
+        with ThreadPoolExecutor(max_workers=max(len(names), 1)) as pool:
+            list(pool.map(self.sample, names))
+
+    def run(self):
+        while True:
+            self.run_once()
+            time.sleep(self.config["interval"])
+            self.config = settings()
+
+
+def recommend(name, config=None):
+    """Summarize a VM's samples and the resources they call for."""
+    config = config or settings()
+    vm = VMManager(name)
+    if not vm.exists:
+        raise VMDoesntExist(f"🤷 VM {name} does not exist.")
+    vm.load_configuration_from_disk()
+    current = sizing(vm)
+    record = load_record(config, name)
+    if record is None or record["sizing"] != current:
+        record = new_record(vm)
+    summary = {"name": name, "current": current, "samples": record["samples"],
+               "enough_samples": record["samples"] >= config["min_samples"],
+               "recommended": None}
+    if not record["samples"]:
+        return summary
+    cpu_p50 = percentile(record["cpu"], 0.5)
+    cpu_p95 = percentile(record["cpu"], 0.95)
+    memory_peak = round(record["memory_peak"] / 100 * current["memory"])
+    first, last = record["root_fs"]["first"], record["root_fs"]["last"]
+    used = last[1] / 100 * current["disk_size"]
+    days = (last[0] - first[0]) / DAY
+    # Less than a day says more about the day than about a trend.
+    growth = max((last[1] - first[1]) / 100 * current["disk_size"] / days, 0) if days >= 1 else 0
+    summary.update(
+        cpu_p50=cpu_p50,
+        cpu_p95=cpu_p95,
+        memory_p95=round(percentile(record["memory"], 0.95) / 100 * current["memory"]),
+        memory_peak=memory_peak,
+        root_fs_used=round(used),
+        root_fs_growth_per_day=round(growth),
+    )
+    cpus = math.ceil(cpu_p95 / 100 * current["cpus"] / (config["cpu_target"] / 100))
+    memory = math.ceil(memory_peak * (1 + config["memory_headroom"] / 100) / MEMORY_STEP) \
+        * MEMORY_STEP
+    projected = used + growth * config["disk_horizon_days"]
+    disk_size = current["disk_size"]
+    # Disks only grow, a smaller image would cut off the filesystem.
+    if projected > disk_size * config["disk_target"] / 100:
+        disk_size = math.ceil(projected / (config["disk_target"] / 100) / DISK_STEP) * DISK_STEP
+    summary["recommended"] = {
+        "cpus": min(max(cpus, 1), os.cpu_count()),
+        "memory": max(memory, MIN_MEMORY),
+        "disk_size": disk_size,
+    }
+    summary["savings"] = {
+        "cpus": current["cpus"] - summary["recommended"]["cpus"],
+        "memory": current["memory"] - summary["recommended"]["memory"],
+    }
+    return summary
+
+
+def print_recommendations(names=None, apply=False, output="table"):
+    config = settings()
+    summaries = [recommend(name, config) for name in names or Controller.list_all_vms()]
+    applicable = [summary for summary in summaries
+                  if summary["enough_samples"] and summary["recommended"] != summary["current"]]
+    if output != "table":
+        print_records(summaries, output)
+    else:
+        print_table(summaries, config)
+    if not apply:
+        return
+    for summary in applicable:
+        changes = {resource: value for resource, value in summary["recommended"].items()
+                   if value != summary["current"][resource]}
+        VMManager(summary["name"]).schedule_resources(**changes)
+
+
+def print_table(summaries, config):
+    table = Table()
+    table.add_column("VM")
+    table.add_column("Samples", justify="right")
+    table.add_column("CPU p50/p95", justify="right")
+    table.add_column("Memory peak", justify="right")
+    table.add_column("Root FS", justify="right")
+    table.add_column("CPUs", justify="right")
+    table.add_column("Memory", justify="right")
+    table.add_column("Disk", justify="right")
+    totals = {"cpus": 0, "memory": 0}
+    for summary in summaries:
+        current, recommended = summary["current"], summary["recommended"]
+        if recommended is None:
+            table.add_row(summary["name"], "0", "", "", "", str(current["cpus"]),
+                          f"{current['memory']}MB", f"{current['disk_size']}MB")
+            continue
+        if summary["enough_samples"]:
+            for resource in totals:
+                totals[resource] += summary["savings"][resource]
+
+        def change(resource, unit=""):
+            if recommended[resource] == current[resource]:
+                return f"{current[resource]}{unit}"
+            return f"{current[resource]}{unit} -> {recommended[resource]}{unit}"
+
+        samples = str(summary["samples"])
+        if not summary["enough_samples"]:
+            samples += f" (of {config['min_samples']})"
+        table.add_row(
+            summary["name"], samples, f"{summary['cpu_p50']}%/{summary['cpu_p95']}%",
+            f"{summary['memory_peak']}MB",
+            f"{summary['root_fs_used']}MB +{summary['root_fs_growth_per_day']}MB/day",
+            change("cpus"), change("memory", "MB"), change("disk_size", "MB"))
+    console.print(table)
+    console.print(f":chart_with_downwards_trend: Projected host savings: {totals['cpus']} CPUs, "
+                  f"{totals['memory']}MB memory, from VMs with enough samples")
+
+
+def pidfile(config):
+    return path(config, "usage.pid")
+
+
+def is_running(config=None):
+    return daemon.is_running(pidfile(config or settings()))
+
+
+def start():
+    config = settings()
+    return daemon.start("macos_virt.usage", pidfile(config), path(config, "sampler.log"))
+
+
+def stop():
+    daemon.stop(pidfile(settings()))
+
+
+if __name__ == "__main__":
+    UsageSampler().run()
@@ -0,0 +1,64 @@
+"""Runs the tests against the simulator runner in a throwaway config home.
+
+macos_virt resolves its paths when imported, so the environment is set up
+here, before any test module imports it.
+"""
+import os
+import shutil
+import tempfile
+
+import pytest
+import yaml
+
+CONFIG_HOME = tempfile.mkdtemp(prefix="macos-virt-tests-")
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+os.environ["XDG_CONFIG_HOME"] = CONFIG_HOME
+os.environ["MACOS_VIRT_RUNNER"] = "simulator"
+# The simulator runs as `python -m macos_virt.simulator` from the VM's directory.
+os.environ["PYTHONPATH"] = os.pathsep.join(
+    filter(None, [REPO_ROOT, os.environ.get("PYTHONPATH")]))
+os.makedirs(os.path.join(CONFIG_HOME, "macos-virt"))
+with open(os.path.join(CONFIG_HOME, "macos-virt/settings.yaml"), "w") as f:
+    yaml.dump({
+        "simulator": {"boot_delay": 0.3},
+        "admission": {"policy": "warn", "host_cpus": 1000, "host_memory_mb": 1024 * 1024},
+        "locks": {"timeout": 30},
+    }, f)
+
+PROFILE = "ubuntu-20.04"
+
+
+@pytest.fixture(scope="session", autouse=True)
+def config_home():
+    from macos_virt.controller import Controller, VMManager
+
+    # Generated once up front, VMs created at once would race to generate it.
+    VMManager("tests").get_ssh_public_key()
+    yield CONFIG_HOME
+    for name in Controller.list_running_vms():
+        VMManager(name).stop(force=True)
+    shutil.rmtree(CONFIG_HOME, ignore_errors=True)
+
+
+@pytest.fixture
+def make_vm(request):
+    """Create stopped VMs named after the test, deleted afterwards."""
+    from macos_virt.controller import VMManager
+
+    names = []
+
+    def make(suffix=""):
+        name = f"{request.node.name}{suffix}".replace("[", "-").replace("]", "")
+        VMManager(name).create(PROFILE, 1, 512, 100)
+        VMManager(name).stop(wait=True, timeout=30)
+        names.append(name)
+        return VMManager(name)
+
+    yield make
+    for name in names:
+        vm = VMManager(name)
+        if vm.is_running():
+            vm.stop(wait=True, timeout=30)
+        if os.path.exists(vm.vm_directory):
+            vm.delete()
@@ -0,0 +1,124 @@
+import json
+import multiprocessing
+import os
+import time
+
+import pytest
+
+from macos_virt.admission import RESERVATIONS_PATH, AdmissionController
+from macos_virt.controller import VMManager
+
+CONFIG = {
+    "host_cpus": 4,
+    "host_memory_mb": 4096,
+    "reserved_memory_mb": 0,
+    "cpu_overcommit": 1.0,
+    "memory_overcommit": 1.0,
+    "policy": "reject",
+    "queue_timeout": 5,
+}
+
+
+@pytest.fixture(autouse=True)
+def no_reservations():
+    os.makedirs(RESERVATIONS_PATH, exist_ok=True)
+    for entry in os.scandir(RESERVATIONS_PATH):
+        os.unlink(entry.path)
+    yield
+    for entry in os.scandir(RESERVATIONS_PATH):
+        os.unlink(entry.path)
+
+
+class SlowToReserve(AdmissionController):
+    def reserve(self, name, cpus, memory):
+        # Widens the window between checking and reserving.
+        time.sleep(0.2)
+        super().reserve(name, cpus, memory)
+
+
+def admit_and_hold(name, go, results):
+    controller = SlowToReserve(lambda: [], CONFIG)
+    go.wait(10)
+    admitted, _ = controller.admit(name, 2, 100)
+    results.put(admitted)
+    time.sleep(1)
+
+
+def release_later(name):
+    time.sleep(0.5)
+    AdmissionController(lambda: [], CONFIG).release(name)
+
+
+def test_reserve_and_release():
+    controller = AdmissionController(lambda: [], CONFIG)
+    controller.reserve("one", 3, 1024)
+    headroom = controller.headroom()
+    assert headroom["reserved_cpus"] == 3
+    assert headroom["free_memory"] == 3072
+    assert "2 CPUs requested, 1 of 4 available" in controller.check("two", 2, 512)
+    # A VM's own reservation doesn't count against it.
+    assert controller.check("one", 3, 1024) == ""
+    controller.release("one")
+    assert controller.headroom()["reserved_cpus"] == 0
+    controller.release("one")
+
+
+def test_running_vms_and_reservations_are_counted_once():
+    controller = AdmissionController(lambda: [{"name": "one", "cpus": 2, "memory": 512}],
+                                     CONFIG)
+    controller.reserve("one", 2, 512)
+    assert controller.headroom()["reserved_cpus"] == 2
+
+
+def test_reservations_of_exited_processes_expire():
+    process = multiprocessing.Process(target=time.sleep, args=(0,))
+    process.start()
+    process.join()
+    with open(os.path.join(RESERVATIONS_PATH, "orphan.json"), "w") as f:
+        json.dump({"name": "orphan", "cpus": 4, "memory": 4096, "pid": process.pid}, f)
+    controller = AdmissionController(lambda: [], CONFIG)
+    assert controller.headroom()["reserved_cpus"] == 0
+    assert not os.path.exists(os.path.join(RESERVATIONS_PATH, "orphan.json"))
+
+
+def test_admit_policies():
+    controller = AdmissionController(lambda: [], CONFIG)
+    assert controller.admit("fits", 4, 1024) == (True, "")
+    admitted, problem = controller.admit("rejected", 1, 512)
+    assert not admitted and "CPUs requested" in problem
+    admitted, problem = controller.admit("warned", 1, 512, policy="warn")
+    assert admitted and problem
+    assert os.path.exists(os.path.join(RESERVATIONS_PATH, "warned.json"))
+
+
+def test_queued_admission_waits_for_a_release(monkeypatch):
+    monkeypatch.setattr("macos_virt.admission.QUEUE_POLL_INTERVAL", 0.1)
+    controller = AdmissionController(lambda: [], CONFIG)
+    controller.reserve("first", 4, 1024)
+    releaser = multiprocessing.Process(target=release_later, args=("first",))
+    releaser.start()
+    assert controller.admit("second", 2, 512, policy="queue") == (True, "")
+    releaser.join()
+
+
+def test_concurrent_admissions_dont_overcommit():
+    go, results = multiprocessing.Event(), multiprocessing.Queue()
+    admitters = [multiprocessing.Process(target=admit_and_hold,
+                                         args=(f"vm{number}", go, results))
+                 for number in range(6)]
+    for admitter in admitters:
+        admitter.start()
+    go.set()
+    admitted = [results.get(timeout=30) for _ in admitters]
+    for admitter in admitters:
+        admitter.join()
+    assert admitted.count(True) == 2
+
+
+def test_failed_creates_release_their_reservation():
+    vm = VMManager("unreachable")
+    # Something in the way of the VM's directory.
+    vm.vm_directory = "/dev/null/unreachable"
+    with pytest.raises(OSError):
+        vm.create("ubuntu-20.04", 1, 512, 100)
+    assert not os.path.exists(os.path.join(RESERVATIONS_PATH, "unreachable.json"))
@@ -0,0 +1,171 @@
+import os
+import struct
+
+import pytest
+
+from macos_virt.archive import (CHUNK_SIZE, FLAG_BASE, FLAG_END, MAGIC, ArchiveError,
+                                export_archive, import_archive, read_index)
+from macos_virt.controller import Controller, InternalErrorException, VMManager
+
+MB = 1024 * 1024
+
+
+def write_file(path, size, data_at=()):
+    with open(path, "wb") as f:
+        f.truncate(size)
+        for offset in data_at:
+            f.seek(offset)
+            f.write(os.urandom(4096))
+
+
+def read(path):
+    return open(path, "rb").read()
+
+
+def test_round_trip(tmp_path):
+    (tmp_path / "in").mkdir()
+    (tmp_path / "out").mkdir()
+    write_file(tmp_path / "in/disk.img", 3 * CHUNK_SIZE + 100, [0, CHUNK_SIZE + 10, 3 * CHUNK_SIZE])
+    write_file(tmp_path / "in/boot.img", MB)
+    configuration = {"cpus": 1, "memory": 512}
+    export_archive(str(tmp_path / "vm.tar"), configuration,
+                   {name: str(tmp_path / "in" / name) for name in ("disk.img", "boot.img")},
+                   workers=2)
+    index = read_index(str(tmp_path / "vm.tar"))
+    assert index["configuration"] == configuration
+    import_archive(str(tmp_path / "vm.tar"), str(tmp_path / "out"), index)
+    for name in ("disk.img", "boot.img"):
+        assert read(tmp_path / "out" / name) == read(tmp_path / "in" / name)
+
+
+def test_chunks_matching_the_base_image_are_not_stored(tmp_path):
+    write_file(tmp_path / "base.img", 2 * CHUNK_SIZE, [0, CHUNK_SIZE])
+    disk = bytearray(read(tmp_path / "base.img"))
+    disk[CHUNK_SIZE:CHUNK_SIZE + 4] = b"diff"
+    (tmp_path / "disk.img").write_bytes(disk)
+    export_archive(str(tmp_path / "vm.tar"), {}, {"disk.img": str(tmp_path / "disk.img")},
+                   base_image=str(tmp_path / "base.img"), workers=1)
+    index = read_index(str(tmp_path / "vm.tar"))
+    chunks = index["files"][0]["chunks"]
+    assert [bool(chunk["flags"] & FLAG_BASE) for chunk in chunks] == [True, False]
+    assert os.path.getsize(tmp_path / "vm.tar") < 2 * CHUNK_SIZE
+
+    (tmp_path / "out").mkdir()
+    with pytest.raises(ArchiveError):
+        import_archive(str(tmp_path / "vm.tar"), str(tmp_path / "out"), index)
+    import_archive(str(tmp_path / "vm.tar"), str(tmp_path / "out"), index,
+                   base_image=str(tmp_path / "base.img"))
+    assert read(tmp_path / "out/disk.img") == bytes(disk)
+
+
+def test_corrupted_chunks_fail_verification(tmp_path):
+    write_file(tmp_path / "disk.img", MB, [0])
+    export_archive(str(tmp_path / "vm.tar"), {}, {"disk.img": str(tmp_path / "disk.img")},
+                   level=0, workers=1)
+    index = read_index(str(tmp_path / "vm.tar"))
+    chunk = index["files"][0]["chunks"][0]
+    with open(tmp_path / "vm.tar", "r+b") as f:
+        f.seek(chunk["archive_offset"] + chunk["archive_length"] // 2)
+        f.write(b"\xff" * 16)
+    (tmp_path / "out").mkdir()
+    with pytest.raises(ArchiveError, match="failed verification"):
+        import_archive(str(tmp_path / "vm.tar"), str(tmp_path / "out"), index)
+
+
+def test_vm_export_import(make_vm, tmp_path):
+    vm = make_vm()
+    disk = vm.file_locations()[0]
+    with open(disk, "r+b") as f:
+        f.seek(MB)
+        f.write(b"written by the guest")
+    vm.export(str(tmp_path / "vm.tar"), dedupe_base=True)
+    names = [f"{vm.name}-imported", f"{vm.name}-again"]
+    for name in names:
+        Controller.import_vm(str(tmp_path / "vm.tar"), name)
+    try:
+        copies = [VMManager(name) for name in names]
+        for copy in copies:
+            copy.load_configuration_from_disk()
+            assert read(copy.file_locations()[0]) == read(disk)
+        # Each import is a machine of its own.
+        identities = {(copy.configuration["mac_address"], copy.configuration["instance_id"])
+                      for copy in copies + [vm]}
+        assert len(identities) == 3
+        VMManager(names[0]).start()
+        assert VMManager(names[0]).is_running()
+        VMManager(names[0]).stop(wait=True, timeout=30)
+    finally:
+        for name in names:
+            VMManager(name).delete()
+
+
+def test_failed_import_leaves_no_vm(make_vm, tmp_path):
+    vm = make_vm()
+    with open(vm.file_locations()[0], "r+b") as f:
+        f.write(os.urandom(4096))
+    vm.export(str(tmp_path / "vm.tar"))
+    index = read_index(str(tmp_path / "vm.tar"))
+    chunk = index["files"][0]["chunks"][0]
+    with open(tmp_path / "vm.tar", "r+b") as f:
+        f.seek(chunk["archive_offset"])
+        f.write(b"\xff" * chunk["archive_length"])
+    with pytest.raises(InternalErrorException):
+        VMManager(f"{vm.name}-imported").import_archive(str(tmp_path / "vm.tar"), index)
+    assert not os.path.exists(VMManager(f"{vm.name}-imported").vm_directory)
+
+
+def damage(path, offset, data):
+    with open(path, "r+b") as f:
+        f.seek(offset)
+        f.write(data)
+
+
+@pytest.fixture
+def archive(tmp_path):
+    write_file(tmp_path / "disk.img", 2 * CHUNK_SIZE, [0, CHUNK_SIZE])
+    export_archive(str(tmp_path / "vm.tar"), {}, {"disk.img": str(tmp_path / "disk.img")},
+                   workers=1)
+    (tmp_path / "out").mkdir()
+    return tmp_path / "vm.tar"
+
+
+def test_short_files_arent_archives(tmp_path):
+    (tmp_path / "short.tar").write_bytes(b"MVIRTAR1")
+    with pytest.raises(ArchiveError):
+        read_index(str(tmp_path / "short.tar"))
+
+
+def test_damaged_trailer(archive):
+    damage(archive, os.path.getsize(archive) - 24, b"\xff" * 8)
+    with pytest.raises(ArchiveError):
+        read_index(str(archive))
+
+
+def test_truncated_archive(archive):
+    index = read_index(str(archive))
+    with open(archive, "r+b") as f:
+        f.truncate(index["files"][0]["chunks"][1]["archive_offset"] - 10)
+    with pytest.raises(ArchiveError):
+        import_archive(str(archive), str(archive.parent / "out"), index)
+
+
+@pytest.mark.parametrize("header", [
+    # File number out of range, then a chunk past the end of its file.
+    struct.pack(">H", 7),
+    struct.pack(">HQ", 0, 10 * CHUNK_SIZE),
+    # An end marker in place of the first chunk.
+    struct.pack(">HQIIB", 0, 0, 0, 0, FLAG_END),
+], ids=["file-number", "offset", "early-end"])
+def test_damaged_chunk_headers(archive, header):
+    index = read_index(str(archive))
+    damage(archive, len(MAGIC), header)
+    with pytest.raises(ArchiveError):
+        import_archive(str(archive), str(archive.parent / "out"), index)
+
+
+def test_files_outside_the_vm_are_refused(archive):
+    index = read_index(str(archive))
+    index["files"][0]["name"] = "../escaped.img"
+    with pytest.raises(ArchiveError):
+        import_archive(str(archive), str(archive.parent / "out"), index)
+    assert not os.path.exists(archive.parent / "escaped.img")
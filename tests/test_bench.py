@@ -0,0 +1,68 @@
+import json
+
+import pytest
+
+from macos_virt import bench
+from macos_virt.controller import VMManager, VMNotRunning
+
+
+def record(vm, run_id, timestamp, results):
+    return {
+        "id": run_id,
+        "vm": vm,
+        "timestamp": timestamp,
+        "configuration": {"profile": "ubuntu-20.04", "cpus": 1, "memory": 512,
+                          "disk_size": 100, "runner": "simulator", "mount_path": None},
+        "parameters": {"seconds": 1, "size_mb": 4},
+        "results": results,
+        "skipped": {},
+    }
+
+
+def test_runs_are_stored_with_the_configuration(make_vm):
+    vm = make_vm()
+    VMManager(vm.name).start()
+    run = bench.run(vm.name, seconds=0.2, size_mb=4)
+    assert set(run["results"]) == {"cpu", "disk", "network"}
+    assert "mount" in run["skipped"]
+    assert run["results"]["disk"]["seq_write_mb_per_second"] > 0
+    assert run["results"]["network"]["upload_mb_per_second"] > 0
+    assert run["results"]["network"]["download_mb_per_second"] > 0
+    assert run["configuration"]["cpus"] == 1
+    assert run["configuration"]["memory"] == 512
+    assert bench.load_run(vm.name) == run
+    assert bench.load_run(f"{vm.name}/{run['id']}") == run
+
+
+def test_stopped_vms_cant_be_benchmarked(make_vm):
+    vm = make_vm()
+    with pytest.raises(VMNotRunning):
+        bench.run(vm.name)
+
+
+def test_compare(capsys):
+    bench.save_run(record("compared", "first", 1, {
+        "cpu": {"single_mb_per_second": 100.0, "threads": 1},
+        "disk": {"random_read_iops": 0, "seq_read_mb_per_second": 50.0},
+    }))
+    bench.save_run(record("compared", "second", 2, {
+        "cpu": {"single_mb_per_second": 150.0, "threads": 4},
+        "disk": {"random_read_iops": 10},
+    }))
+    bench.compare("compared/first", "compared", output="json")
+    compared = json.loads(capsys.readouterr().out)
+    assert [run["id"] for run in (compared["before"], compared["after"])] == ["first", "second"]
+    # Details like the thread count and metrics missing from a run are left out.
+    assert compared["metrics"] == [
+        {"metric": "cpu.single_mb_per_second", "before": 100.0, "after": 150.0,
+         "change_percent": 50.0},
+        {"metric": "disk.random_read_iops", "before": 0, "after": 10, "change_percent": None},
+    ]
+
+
+def test_unknown_runs():
+    with pytest.raises(bench.UnknownRun):
+        bench.load_run("never-benchmarked")
+    bench.save_run(record("benchmarked", "only", 1, {}))
+    with pytest.raises(bench.UnknownRun):
+        bench.load_run("benchmarked/other")
@@ -0,0 +1,125 @@
+import http.client
+import ipaddress
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from macos_virt.cache_proxy import Cache, ProxyHandler
+
+PACKAGE = b"package" * 1000
+RELEASE = b"Release file"
+
+
+class Origin(BaseHTTPRequestHandler):
+    """Stands in for a mirror: a versioned package and a revalidated index."""
+
+    requests = []
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.requests.append((self.path, self.headers.get("If-None-Match")))
+        if self.path.endswith(".deb"):
+            self.reply(200, PACKAGE, {})
+        elif self.path == "/dists/Release":
+            if self.headers.get("If-None-Match") == '"v1"':
+                self.reply(304, b"", {"ETag": '"v1"'})
+            else:
+                self.reply(200, RELEASE, {"ETag": '"v1"', "Cache-Control": "no-cache"})
+        else:
+            self.reply(404, b"", {})
+
+    def reply(self, status, body, headers):
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def serve(handler):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+@pytest.fixture
+def proxy(tmp_path):
+    origin = serve(type("TestOrigin", (Origin,), {"requests": []}))
+    cache = Cache(str(tmp_path), 3 * len(PACKAGE) // 2)
+    server = serve(type("TestProxy", (ProxyHandler,), {
+        "cache": cache, "allowed_networks": [ipaddress.ip_network("127.0.0.0/8")]}))
+
+    def get(path):
+        connection = http.client.HTTPConnection(*server.server_address, timeout=10)
+        connection.request("GET", f"http://127.0.0.1:{origin.server_address[1]}{path}")
+        response = connection.getresponse()
+        body = response.read()
+        connection.close()
+        # Clients get the body before the proxy stores it and evicts.
+        deadline = time.time() + 10
+        while any(name.endswith(".tmp") for name in os.listdir(cache.directory)):
+            assert time.time() < deadline
+            time.sleep(0.01)
+        return response.status, body
+
+    yield get, cache, origin
+    server.shutdown()
+    server.server_close()
+    origin.shutdown()
+    origin.server_close()
+
+
+def test_fresh_entries_are_served_from_the_cache(proxy):
+    get, cache, origin = proxy
+    assert get("/pool/a.deb") == (200, PACKAGE)
+    assert get("/pool/a.deb") == (200, PACKAGE)
+    assert [path for path, _ in origin.RequestHandlerClass.requests] == ["/pool/a.deb"]
+    assert cache.stats_snapshot()["misses"] == 1
+    assert cache.stats_snapshot()["hits"] == 1
+
+
+def test_stale_entries_are_revalidated(proxy):
+    get, cache, origin = proxy
+    assert get("/dists/Release") == (200, RELEASE)
+    assert get("/dists/Release") == (200, RELEASE)
+    assert origin.RequestHandlerClass.requests == [
+        ("/dists/Release", None), ("/dists/Release", '"v1"')]
+    assert cache.stats_snapshot()["revalidated"] == 1
+
+
+def test_stale_entries_are_served_when_the_origin_is_down(proxy):
+    get, cache, origin = proxy
+    assert get("/dists/Release") == (200, RELEASE)
+    origin.shutdown()
+    origin.server_close()
+    assert get("/dists/Release") == (200, RELEASE)
+    assert cache.stats_snapshot()["stale"] == 1
+    assert get("/dists/Other")[0] == 502
+
+
+def test_least_recently_used_entries_are_evicted(proxy):
+    get, cache, origin = proxy
+    get("/pool/a.deb")
+    get("/pool/b.deb")
+    assert cache.stats_snapshot()["evicted"] == 1
+    assert cache.size() <= cache.max_size
+    get("/pool/b.deb")
+    get("/pool/a.deb")
+    assert [path for path, _ in origin.RequestHandlerClass.requests] == [
+        "/pool/a.deb", "/pool/b.deb", "/pool/a.deb"]
+
+
+def test_concurrent_hits_are_all_counted(proxy):
+    get, cache, _ = proxy
+    get("/pool/a.deb")
+    with ThreadPoolExecutor(8) as executor:
+        assert set(executor.map(lambda _: get("/pool/a.deb"), range(40))) == {(200, PACKAGE)}
+    assert cache.stats_snapshot()["hits"] == 40
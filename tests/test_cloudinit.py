@@ -0,0 +1,51 @@
+import io
+import threading
+import time
+
+from rich.console import Console
+from rich.progress import Progress
+
+from macos_virt import cloudinit
+
+
+def test_stopping_while_events_refresh(monkeypatch):
+    monkeypatch.setattr(cloudinit, "console", Console(file=io.StringIO(), force_terminal=True))
+    update = Progress.update
+
+    def slow_update(self, *args, **kwargs):
+        # Widens the window between looking up the task and updating it.
+        time.sleep(0.001)
+        update(self, *args, **kwargs)
+
+    monkeypatch.setattr(Progress, "update", slow_update)
+    errors = []
+
+    for _ in range(20):
+        progress = cloudinit.InitializationProgress("vm", "profile", "first_boot")
+        progress.__enter__()
+
+        def send_events():
+            try:
+                for number in range(50):
+                    progress.event({"name": f"modules-config/config-{number}",
+                                    "event": "start", "at": number})
+            except Exception as e:
+                errors.append(e)
+
+        sender = threading.Thread(target=send_events)
+        sender.start()
+        time.sleep(0.01)
+        progress.stop()
+        sender.join()
+    assert errors == []
+    assert cloudinit.display is None
+
+
+def test_plain_lines_without_a_terminal(monkeypatch):
+    output = io.StringIO()
+    monkeypatch.setattr(cloudinit, "console", Console(file=output, force_terminal=False))
+    with cloudinit.InitializationProgress("vm", "profile", "first_boot") as progress:
+        progress.event({"name": "modules-config", "event": "start", "at": 1})
+        progress.event({"name": "modules-config", "event": "finish", "at": 2})
+    assert "vm: modules-config" in output.getvalue()
+    assert "vm: between stages" in output.getvalue()
@@ -0,0 +1,23 @@
+import os
+
+import pytest
+
+from macos_virt.controller import InternalErrorException, VMManager
+
+
+@pytest.mark.parametrize("cache", ["automatic", "cached", "uncached"])
+def test_data_disks_boot_with_any_cache_mode(make_vm, cache):
+    vm = make_vm()
+    vm.add_disk("data", 16, cache=cache)
+    VMManager(vm.name).start()
+    assert VMManager(vm.name).is_running()
+    VMManager(vm.name).stop(wait=True, timeout=30)
+
+
+def test_missing_data_disk_fails_boot(make_vm):
+    vm = make_vm()
+    vm.add_disk("data", 16, cache="uncached")
+    vm.load_configuration_from_disk()
+    os.unlink(vm.data_disk_file(vm.data_disks()[0]))
+    with pytest.raises(InternalErrorException):
+        VMManager(vm.name).start()
@@ -0,0 +1,48 @@
+import threading
+import time
+
+import yaml
+
+from macos_virt.admission import DEFAULTS as ADMISSION_DEFAULTS, host_capacity
+from macos_virt.fleet import Action, Scheduler, load_manifest
+from macos_virt.settings import get_settings
+
+
+def write_manifest(tmp_path, manifest):
+    path = tmp_path / "fleet.yaml"
+    path.write_text(yaml.dump(manifest))
+    return str(path)
+
+
+def test_budget_defaults_to_host_capacity(tmp_path):
+    _, budget = load_manifest(write_manifest(tmp_path, {"vms": [{"name": "one"}]}))
+    admission = get_settings("admission", ADMISSION_DEFAULTS)
+    cpus, memory = host_capacity(admission)
+    assert budget["cpus"] == cpus
+    assert budget["memory"] == memory - admission["reserved_memory_mb"]
+
+
+def test_manifest_budget_overrides_defaults(tmp_path):
+    _, budget = load_manifest(write_manifest(
+        tmp_path, {"budget": {"memory": 4096}, "vms": [{"name": "one"}]}))
+    assert budget["memory"] == 4096
+    assert budget["io"] == 2
+
+
+def test_scheduler_keeps_booting_vms_within_the_memory_budget():
+    lock = threading.Lock()
+    in_flight = []
+    peak = []
+
+    def boot():
+        with lock:
+            in_flight.append(1)
+            peak.append(len(in_flight))
+        time.sleep(0.1)
+        with lock:
+            in_flight.pop()
+
+    actions = [Action("create", f"vm{number}", boot, memory=2048, cpus=1)
+               for number in range(4)]
+    assert Scheduler(actions, {"cpus": 8, "memory": 4096}).run()
+    assert max(peak) == 2
@@ -0,0 +1,137 @@
+import asyncio
+import json
+import os
+import socket
+
+import pytest
+
+from macos_virt import forward
+from macos_virt.controller import InternalErrorException, VMManager
+
+
+class Guest:
+    def get(self):
+        return "127.0.0.1"
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def echo(reader, writer):
+    while data := await reader.read(65536):
+        writer.write(data)
+        await writer.drain()
+    writer.close()
+
+
+async def exchange(port, payload):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(payload)
+    writer.write_eof()
+    received = await reader.read()
+    writer.close()
+    return received
+
+
+def listening_port(server):
+    return server.sockets[0].getsockname()[1]
+
+
+def test_forward_relays_both_ways():
+    async def run():
+        guest = await asyncio.start_server(echo, "127.0.0.1", 0)
+        relay = forward.Forward(Guest(), 0, listening_port(guest))
+        server = await relay.start()
+        payload = os.urandom(3 * forward.BUFFER_SIZE + 7)
+        results = await asyncio.gather(
+            *(exchange(listening_port(server), payload) for _ in range(4)))
+        server.close()
+        guest.close()
+        return payload, results, relay.stats()
+
+    payload, results, stats = asyncio.run(run())
+    assert results == [payload] * 4
+    assert stats["connections_total"] == 4
+    assert stats["bytes_in"] == stats["bytes_out"] == 4 * len(payload)
+
+
+def test_half_closed_pooled_connections_arent_reused():
+    connections = []
+
+    async def guest_handler(reader, writer):
+        connections.append(writer)
+        if len(connections) <= forward.POOL_SIZE:
+            # Greets, then goes away while the connection idles in the pool.
+            writer.write(b"bye")
+            writer.write_eof()
+            return
+        await echo(reader, writer)
+
+    async def run():
+        guest = await asyncio.start_server(guest_handler, "127.0.0.1", 0)
+        relay = forward.Forward(Guest(), 0, listening_port(guest))
+        server = await relay.start()
+        while len(relay.pool) < forward.POOL_SIZE:
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.2)
+        received = await exchange(listening_port(server), b"ping")
+        server.close()
+        guest.close()
+        return received
+
+    assert asyncio.run(run()) == b"ping"
+
+
+def write_vm(vm_directory, host_port, guest_port):
+    with open(vm_directory / "vm.json", "w") as f:
+        # Without a pool the guest's first connection is the client's.
+        json.dump({"ip_address": "127.0.0.1", "forwards": [
+            {"host_port": host_port, "guest_port": guest_port, "bind": "127.0.0.1",
+             "pool": 0}]}, f)
+    # The forwarder runs while this process, standing in for the VM, does.
+    (vm_directory / "pidfile").write_text(str(os.getpid()))
+
+
+def test_forwarder_listens_before_start_returns(tmp_path):
+    host_port = free_port()
+    with socket.socket() as guest:
+        guest.settimeout(5)
+        guest.bind(("127.0.0.1", 0))
+        guest.listen()
+        write_vm(tmp_path, host_port, guest.getsockname()[1])
+        forward.start_forwarder(str(tmp_path))
+        try:
+            with socket.create_connection(("127.0.0.1", host_port), timeout=5) as client:
+                upstream, _ = guest.accept()
+                upstream.settimeout(5)
+                client.sendall(b"ping")
+                assert upstream.recv(4) == b"ping"
+                upstream.close()
+        finally:
+            forward.stop_forwarder(str(tmp_path))
+
+
+def test_forwarder_reports_ports_in_use(tmp_path):
+    with socket.socket() as taken:
+        taken.bind(("127.0.0.1", 0))
+        taken.listen()
+        write_vm(tmp_path, taken.getsockname()[1], 22)
+        with pytest.raises(forward.ForwarderFailed, match="Can't listen on 127.0.0.1"):
+            forward.start_forwarder(str(tmp_path))
+    assert not forward.is_forwarder_running(str(tmp_path))
+
+
+def test_add_forward_fails_on_ports_in_use(make_vm):
+    vm = make_vm()
+    VMManager(vm.name).start()
+    with socket.socket() as taken:
+        taken.bind(("127.0.0.1", 0))
+        taken.listen()
+        with pytest.raises(InternalErrorException):
+            VMManager(vm.name).add_forward(taken.getsockname()[1], 22)
+    vm = VMManager(vm.name)
+    vm.load_configuration_from_disk()
+    assert vm.configuration.get("forwards") == []
@@ -0,0 +1,81 @@
+import multiprocessing
+import os
+import time
+from collections import Counter
+
+import pytest
+
+from macos_virt.controller import BaseError, VMManager
+from macos_virt.locking import LockTimeout, lock
+
+
+def hold_lock(name, ready, release):
+    with lock(name, command="holder"):
+        ready.set()
+        release.wait(30)
+
+
+def start_vm(name):
+    try:
+        VMManager(name).start()
+    except BaseError:
+        pass
+
+
+def runners_by_vm():
+    running = Counter()
+    for pid in filter(str.isdigit, os.listdir("/proc")):
+        try:
+            cmdline = open(f"/proc/{pid}/cmdline", "rb").read()
+            if b"macos_virt.simulator" in cmdline:
+                running[os.path.basename(os.readlink(f"/proc/{pid}/cwd"))] += 1
+        except OSError:
+            continue
+    return running
+
+
+def test_lock_is_reentrant_within_a_thread():
+    with lock("reentrant"):
+        with lock("reentrant"):
+            # An exclusive lock covers shared requests too.
+            with lock("reentrant", exclusive=False):
+                pass
+        with lock("reentrant", timeout=0):
+            pass
+
+
+def test_shared_lock_cant_be_upgraded():
+    with lock("upgrade", exclusive=False):
+        with pytest.raises(RuntimeError):
+            with lock("upgrade"):
+                pass
+
+
+def test_lock_times_out_naming_the_holder():
+    ready, release = multiprocessing.Event(), multiprocessing.Event()
+    holder = multiprocessing.Process(target=hold_lock, args=("contended", ready, release))
+    holder.start()
+    try:
+        assert ready.wait(10)
+        started = time.time()
+        with pytest.raises(LockTimeout, match=f"held by process {holder.pid} \\(holder\\)"):
+            with lock("contended", timeout=0.3):
+                pass
+        assert time.time() - started < 5
+    finally:
+        release.set()
+        holder.join()
+    with lock("contended", timeout=1):
+        pass
+
+
+@pytest.mark.skipif(not os.path.isdir("/proc"), reason="counts runners through /proc")
+def test_concurrent_starts_launch_one_runner(make_vm):
+    vm = make_vm()
+    starters = [multiprocessing.Process(target=start_vm, args=(vm.name,)) for _ in range(6)]
+    for starter in starters:
+        starter.start()
+    for starter in starters:
+        starter.join(60)
+    assert VMManager(vm.name).is_running()
+    assert runners_by_vm()[vm.name] == 1
@@ -0,0 +1,54 @@
+import pytest
+
+from macos_virt.controller import InternalErrorException, VMManager
+
+
+def configuration(vm):
+    vm = VMManager(vm.name)
+    vm.load_configuration_from_disk()
+    return vm.configuration
+
+
+def test_resizes_of_a_running_vm_wait_for_it_to_stop(make_vm):
+    vm = make_vm()
+    VMManager(vm.name).start()
+    VMManager(vm.name).schedule_resources(memory=1024, disk_size=200)
+    assert configuration(vm)["pending_resources"] == {"memory": 1024, "disk_size": 200}
+    assert configuration(vm)["memory"] == 512
+    VMManager(vm.name).stop(wait=True, timeout=30)
+    assert configuration(vm)["memory"] == 1024
+    assert configuration(vm)["disk_size"] == 200
+    assert "pending_resources" not in configuration(vm)
+
+
+def test_scheduling_a_smaller_disk_is_refused(make_vm):
+    vm = make_vm()
+    VMManager(vm.name).start()
+    with pytest.raises(InternalErrorException):
+        VMManager(vm.name).schedule_resources(disk_size=50)
+    assert "pending_resources" not in configuration(vm)
+
+
+def test_updating_directly_replaces_the_scheduled_update(make_vm):
+    vm = make_vm()
+    VMManager(vm.name).start()
+    VMManager(vm.name).schedule_resources(memory=1024)
+    VMManager(vm.name).stop()
+    VMManager(vm.name).wait_for_stop(30)
+    VMManager(vm.name).update_resources(2048, None)
+    assert "pending_resources" not in configuration(vm)
+    VMManager(vm.name).start()
+    assert configuration(vm)["memory"] == 2048
+
+
+def test_updates_that_cant_apply_dont_block_starting(make_vm):
+    vm = make_vm()
+    vm.load_configuration_from_disk()
+    # Scheduled while running, then the disk was grown past it by hand.
+    vm.configuration["pending_resources"] = {"memory": 1024, "disk_size": 50}
+    vm.save_configuration_to_disk()
+    VMManager(vm.name).start()
+    assert VMManager(vm.name).is_running()
+    assert configuration(vm)["memory"] == 1024
+    assert configuration(vm)["disk_size"] == 100
+    assert "pending_resources" not in configuration(vm)
@@ -0,0 +1,66 @@
+import os
+
+from macos_virt.sparse import (BLOCK_SIZE, SCAN_BUFFER_SIZE, allocated_bytes, compact_file,
+                               preallocate, zero_extents)
+
+MB = 1024 * 1024
+
+
+def expected_zero_extents(data, block_size=BLOCK_SIZE):
+    extents = []
+    for offset in range(0, len(data), block_size):
+        length = min(block_size, len(data) - offset)
+        if any(data[offset:offset + length]):
+            continue
+        if extents and sum(extents[-1]) == offset:
+            extents[-1] = (extents[-1][0], extents[-1][1] + length)
+        else:
+            extents.append((offset, length))
+    return extents
+
+
+def test_zero_extents(tmp_path):
+    data = bytearray(2 * SCAN_BUFFER_SIZE + 3 * BLOCK_SIZE + 100)
+    for offset in (0, BLOCK_SIZE * 5 + 1, SCAN_BUFFER_SIZE, len(data) - 1):
+        data[offset] = 1
+    (tmp_path / "disk.img").write_bytes(data)
+    fd = os.open(tmp_path / "disk.img", os.O_RDONLY)
+    try:
+        assert list(zero_extents(fd, len(data))) == expected_zero_extents(data)
+    finally:
+        os.close(fd)
+
+
+def test_zero_extents_skip_holes(tmp_path):
+    with open(tmp_path / "disk.img", "wb") as f:
+        f.truncate(16 * MB)
+        f.seek(8 * MB)
+        f.write(b"data")
+    fd = os.open(tmp_path / "disk.img", os.O_RDONLY)
+    try:
+        extents = list(zero_extents(fd, 16 * MB))
+    finally:
+        os.close(fd)
+    assert all(not offset <= 8 * MB < offset + length for offset, length in extents)
+
+
+def test_compact_file(tmp_path):
+    path = tmp_path / "disk.img"
+    data = bytearray(8 * MB)
+    data[3 * MB:3 * MB + 4] = b"keep"
+    data[-4:] = b"tail"
+    path.write_bytes(data)
+    before, after = compact_file(str(path))
+    assert before >= 8 * MB
+    assert after < before
+    assert after == allocated_bytes(str(path))
+    assert os.path.getsize(path) == 8 * MB
+    assert path.read_bytes() == bytes(data)
+
+
+def test_preallocate(tmp_path):
+    path = tmp_path / "disk.img"
+    preallocate(str(path), 4 * MB)
+    assert os.path.getsize(path) == 4 * MB
+    assert allocated_bytes(str(path)) >= 4 * MB
+    assert path.read_bytes() == bytes(4 * MB)
@@ -69,11 +69,37 @@ func quit(_ code: Int32) -> Never {
   return exit(code)
 }
 
+let diskCachingModes = ["automatic", "cached", "uncached"]
+
 func openDisk(path: String, readOnly: Bool) throws -> VZVirtioBlockDeviceConfiguration {
-  let vmDiskURL = URL(fileURLWithPath: path)
+  // A disk may name its host caching mode after an @, e.g. data.img@uncached.
+  var diskPath = path
+  var cachingMode = "automatic"
+  if let separator = path.lastIndex(of: "@"),
+    diskCachingModes.contains(String(path[path.index(after: separator)...]))
+  {
+    diskPath = String(path[..<separator])
+    cachingMode = String(path[path.index(after: separator)...])
+  }
+  let vmDiskURL = URL(fileURLWithPath: diskPath)
   let vmDisk: VZDiskImageStorageDeviceAttachment
   do {
-    vmDisk = try VZDiskImageStorageDeviceAttachment(url: vmDiskURL, readOnly: readOnly)
+    if cachingMode == "automatic" {
+      vmDisk = try VZDiskImageStorageDeviceAttachment(url: vmDiskURL, readOnly: readOnly)
+    } else {
+      #if EXTRA_WORKAROUND_FOR_BIG_SUR
+        throw ValidationError("Disk caching modes need macOS 12: \(path)")
+      #else
+        if #available(macOS 12, *) {
+          vmDisk = try VZDiskImageStorageDeviceAttachment(
+            url: vmDiskURL, readOnly: readOnly,
+            cachingMode: cachingMode == "cached" ? .cached : .uncached,
+            synchronizationMode: .full)
+        } else {
+          throw ValidationError("Disk caching modes need macOS 12: \(path)")
+        }
+      #endif
+    }
   } catch {
     throw error
   }
@@ -107,7 +133,12 @@ struct VMCLI: ParsableCommand {
   @Option(name: .long, help: "Memory Size Suffix")
   var memorySizeSuffix: SizeSuffix = SizeSuffix.MiB
 
-  @Option(name: [.short, .customLong("disk")], help: "Disks to use")
+  @Option(
+    name: [.short, .customLong("disk")],
+    help: """
+      Disks to use. e.g. data.img@uncached to choose the host caching mode, \
+      automatic, cached or uncached.
+      """)
   var disks: [String] = []
 
   @Option(name: [.customLong("cdrom")], help: "CD-ROMs to use")